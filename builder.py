@@ -30,15 +30,21 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import collections
+import hashlib
+import heapq
 import os
 import threading
 import time
 
 from sebs.core import Rule, Test, Action, Artifact, DefinitionError
-from sebs.filesystem import Directory
+from sebs.filesystem import Directory, StatCache
 from sebs.helpers import typecheck
 from sebs.command import ArtifactEnumerator
+from sebs.depfile import DepFileCache
+from sebs.includes import IncludeCache
+from sebs.kvstore import KeyValueStore
 from sebs.console import Console, ColoredText
+from sebs.eventloop import EventLoop
 from sebs.runner import ActionRunner
 
 class _ArtifactEnumeratorImpl(ArtifactEnumerator):
@@ -55,9 +61,21 @@ class _ArtifactEnumeratorImpl(ArtifactEnumerator):
     self.inputs = []
     self.outputs = []
     self.disk_inputs = []
+    # Set of |inputs|.  Commands may add the same input more than once, e.g.
+    # by both scanning and adding a header.
+    self.__input_set = set()
+    # Artifacts read while they were still dirty.  The enumeration may come
+    # out differently once they're built.
+    self.dirty_reads = []
+    # Set if a read failed because the artifact, though clean, has to be
+    # materialized first (see _StateMap.defer_materialize).  The enumeration
+    # is then incomplete and must be redone.
+    self.deferred = False
 
   def add_input(self, artifact):
-    self.inputs.append(artifact)
+    if artifact not in self.__input_set:
+      self.__input_set.add(artifact)
+      self.inputs.append(artifact)
 
   def add_output(self, artifact):
     self.outputs.append(artifact)
@@ -66,8 +84,15 @@ class _ArtifactEnumeratorImpl(ArtifactEnumerator):
     self.disk_inputs.append(filename)
 
   def read(self, artifact):
-    self.inputs.append(artifact)
-    return self.__state_map.read_if_clean(self.__config, artifact)
+    self.add_input(artifact)
+    result = self.__state_map.read_if_clean(self.__config, artifact)
+    if result is None:
+      state = self.__state_map.artifact_state(self.__config, artifact)
+      if state.is_dirty:
+        self.dirty_reads.append(state)
+      else:
+        self.deferred = True
+    return result
 
   def read_previous_output(self, artifact):
     if artifact.action is not self.__action:
@@ -80,6 +105,99 @@ class _ArtifactEnumeratorImpl(ArtifactEnumerator):
     else:
       return None
 
+  def read_previous_dependencies(self, artifact):
+    return _read_previous_dependencies(
+        self, self.__state_map.depfile_cache, self.__config, self.__action,
+        artifact)
+
+  def scan_includes(self, file):
+    if not isinstance(file, Artifact):
+      return _scan_source_includes(self.__state_map.include_cache,
+                                   self.__config, file)
+
+    disk_path = self.__state_map.disk_path_if_clean(self.__config, file)
+    if disk_path is None:
+      # Dirty, or not on disk.  read() handles both.
+      return ArtifactEnumerator.scan_includes(self, file)
+    self.add_input(file)
+    return self.__state_map.include_cache.read(disk_path)
+
+def _scan_source_includes(include_cache, config, filename):
+  """Shared implementation of scan_includes() on source files for the
+  Builder's enumerators."""
+
+  disk_path = config.root_dir.get_disk_path(filename)
+  if disk_path is None:
+    return None
+  return include_cache.read(disk_path)
+
+def _read_previous_dependencies(enumerator, depfile_cache, config, action,
+                                artifact):
+  """Shared implementation of read_previous_dependencies() for the Builder's
+  enumerators.  Depfiles on disk are read through |depfile_cache|."""
+
+  if artifact.action is not action:
+    raise DefinitionError("%s is not an output of %s." % (artifact, action))
+
+  real_name = artifact.real_name(enumerator.read)
+  if real_name is None:
+    return None
+  disk_path = config.root_dir.get_disk_path(real_name)
+  if disk_path is None:
+    return ArtifactEnumerator.read_previous_dependencies(enumerator, artifact)
+  return depfile_cache.read(disk_path)
+
+class _PrefetchEnumerator(ArtifactEnumerator):
+  """Collects an action's artifacts for Builder.prefetch(), without knowing
+  which of them are dirty.  Reads of memory artifacts return whatever they
+  held after the last build, and reads of anything else return None, so some
+  inputs may be missed or wrong; that's fine for a prefetch."""
+
+  def __init__(self, config, action, depfile_cache):
+    self.__config = config
+    self.__action = action
+    self.__depfile_cache = depfile_cache
+    self.artifacts = []
+    self.disk_inputs = []
+
+  def add_input(self, artifact):
+    self.artifacts.append(artifact)
+
+  def add_output(self, artifact):
+    self.artifacts.append(artifact)
+
+  def add_disk_input(self, filename):
+    self.disk_inputs.append(filename)
+
+  def read(self, artifact):
+    self.artifacts.append(artifact)
+    real_name = artifact.real_name(self.read)
+    if real_name is not None and \
+       self.__config.root_dir.get_disk_path(real_name) is None and \
+       self.__config.root_dir.exists(real_name):
+      return self.__config.root_dir.read(real_name)
+    return None
+
+  def read_previous_output(self, artifact):
+    if artifact.action is not self.__action:
+      raise DefinitionError("%s is not an output of %s." %
+                            (artifact, self.__action))
+
+    real_name = artifact.real_name(self.read)
+    if real_name is not None and self.__config.root_dir.exists(real_name):
+      return self.__config.root_dir.read(real_name)
+    else:
+      return None
+
+  def read_previous_dependencies(self, artifact):
+    return _read_previous_dependencies(
+        self, self.__depfile_cache, self.__config, self.__action, artifact)
+
+  def scan_includes(self, file):
+    # Following includes would mean reading sources one at a time, which is
+    # what prefetching is meant to avoid.
+    return []
+
 class _ArtifactState(object):
   def __init__(self, artifact, root_dir, state_map, config):
     typecheck(artifact, Artifact)
@@ -88,6 +206,11 @@ class _ArtifactState(object):
 
     self.artifact = artifact
     self.config = config
+    # Set when the action which builds this artifact ran during this build and
+    # changed its content.  Artifacts which were rebuilt but came out the same
+    # don't set it, so their dependents are checked against |timestamp|, which
+    # still describes the old file, as if they had never been dirty.
+    self.is_changed = False
 
     real_name = state_map.real_name(config, artifact)
     if real_name is None:
@@ -112,6 +235,15 @@ class _ArtifactState(object):
       raise DefinitionError(
         "The required source file '%s' does not exist." % artifact.filename)
 
+  def is_still_dirty(self, state_map):
+    """Called once the creating action is ready to run, after some of its
+    inputs have been rebuilt.  Returns false if the artifact is up-to-date
+    after all, because every input that was rebuilt came out unchanged."""
+
+    if self.timestamp < 0:
+      return True
+    return self.__decide_if_dirty(state_map)
+
   def __decide_if_dirty(self, state_map):
     if self.artifact.action is None:
       # Source artifact; can't be dirty.
@@ -144,23 +276,40 @@ class _ArtifactState(object):
       # afterwards but some sort of rounding error lead to the difference.
       # (For example, the disk filesystem may round timestamps to the
       # nearest second while the mem filesystem keeps exact times.)
-      if input_state.is_dirty or \
+      if input_state.is_dirty or input_state.is_changed or \
          self.timestamp + 1 < input_state.timestamp:
         return True
 
     # Check disk inputs, too.
     for disk_input in action_state.disk_inputs:
-      if not os.path.exists(disk_input):
+      try:
+        disk_timestamp = state_map.stat_cache.getmtime(disk_input)
+      except OSError:
         return True
-      disk_timestamp = os.path.getmtime(disk_input)
       # See above comment about rounding error.
       if self.timestamp + 1 < disk_timestamp:
         return True
 
-    # Also mark dirty if the build definition file has changed.  (Since build
-    # def files cannot be derived files we don't need to worry about rounding
-    # error on this one.)
-    if self.timestamp < self.artifact.action.rule.context.timestamp:
+    action_keys = state_map.action_keys
+    if action_keys is None:
+      # Without recorded definitions, mark dirty if the build definition file
+      # has changed.  (Since build def files cannot be derived files we don't
+      # need to worry about rounding error on this one.)
+      return self.timestamp < self.artifact.action.rule.context.timestamp
+
+    # Mark dirty if the action that built this artifact was defined
+    # differently from how it is now.
+    key = (self.config.name, state_map.real_name(self.config, self.artifact))
+    definition = action_state.definition(state_map)
+    old_definition = action_keys.get(key)
+    if old_definition is None:
+      # Built before we started recording definitions.  Fall back to the
+      # build definition file's timestamp, and if that says we're clean,
+      # record the current definition so that next time we needn't.
+      if self.timestamp < self.artifact.action.rule.context.timestamp:
+        return True
+      action_keys[key] = definition
+    elif old_definition != definition:
       return True
 
     return False
@@ -177,8 +326,17 @@ class _ActionState(object):
     # If this is a test action, |test| is the test rule.
     self.test = None
 
-    # Has the Builder decided that this action needs to be built?
+    # Has the Builder decided that this action needs to be built?  Stays true
+    # once the action has started, so that nothing adds it again.
     self.is_pending = False
+    # Has the action started running, or been cut off?  If so, it can no
+    # longer be skipped.
+    self.is_started = False
+    # Did the action run and fail?
+    self.is_failed = False
+    # Did the Builder give up on this action because something it depends on
+    # failed to build?  (Only happens in keep-going mode.)
+    self.is_skipped = False
     # Is this action ready to be built now?  (I.e. inputs are not dirty.)
     self.is_ready = False
 
@@ -188,14 +346,26 @@ class _ActionState(object):
     self.inputs = None
     self.outputs = None
 
-    # ActionStates which must be completed before this one can be.  Updated by
-    # update_readiness().
+    # ActionStates which must be completed before this one can be, in the order
+    # of the inputs that need them.  Updated by update_readiness(), which
+    # replaces the list only when it enumerates the inputs again; otherwise
+    # blockers which have completed are left in it.  (They stay pending, so
+    # nobody tries to add them again.)
     self.blocking = None
 
+    # The last enumeration of this action's artifacts, kept until something it
+    # read changes, and the states of the inputs which were dirty as of the
+    # last update_readiness(), in input order.
+    self.__enumerator = None
+    self.__dirty_inputs = None
+
     # As other ActionStates discover that they are blocked by this, they add
     # themselves to this set.
     self.blocked = set()
 
+    # Cached result of definition().
+    self.__definition = None
+
     self.update_readiness(state_map)
 
   def update_readiness(self, state_map):
@@ -210,14 +380,42 @@ class _ActionState(object):
       # Already ready.  No change is possible.
       return False
 
+    enumerator = self.__enumerator
+    if enumerator is not None and \
+       all([state.is_dirty for state in enumerator.dirty_reads]):
+      # Same inputs as last time, so only those which were dirty then need
+      # checking.  Stop at the first one that still is; we'll be called again
+      # when it's built.  This keeps a link with thousands of objects from
+      # rescanning all of them as each one is compiled.
+      while len(self.__dirty_inputs) > 0 and \
+            not self.__dirty_inputs[0].is_dirty:
+        self.__dirty_inputs.popleft()
+      if len(self.__dirty_inputs) > 0:
+        return False
+      return self.__become_ready(enumerator)
+
     enumerator = _ArtifactEnumeratorImpl(state_map, self.config, self.action)
     self.action.command.enumerate_artifacts(enumerator)
+    if enumerator.deferred:
+      # Something it read has to be materialized first.  The Builder will do
+      # that once it can release its lock, then call us again.
+      state_map.deferred_actions.append(self)
+      self.__enumerator = None
+      if self.blocking is None:
+        self.blocking = []
+      return False
+    self.__enumerator = enumerator
+    self.__dirty_inputs = collections.deque()
 
-    self.blocking = set()
+    # A list rather than a set so that blockers are scheduled in a repeatable
+    # order.
+    self.blocking = []
+    blocking_set = set()
     for input in enumerator.inputs:
       input_state = state_map.artifact_state(self.config, input)
 
       if input_state.is_dirty:
+        self.__dirty_inputs.append(input_state)
         # Input is dirty, therefore it must have an action.
         blocking_state = state_map.action_state(
             input_state.config, input_state.artifact.action)
@@ -227,22 +425,76 @@ class _ActionState(object):
               "%s is needed, but %s didn't generate it." %
               (input_state.config, input_state.artifact.action))
         blocking_state.blocked.add(self)
-        self.blocking.add(blocking_state)
+        if blocking_state not in blocking_set:
+          blocking_set.add(blocking_state)
+          self.blocking.append(blocking_state)
 
     if len(self.blocking) > 0:
       # At least one input is still dirty.
       return False
 
+    return self.__become_ready(enumerator)
+
+  def __become_ready(self, enumerator):
     self.is_ready = True
     self.inputs = enumerator.inputs
     self.disk_inputs = enumerator.disk_inputs
     self.outputs = enumerator.outputs
+    self.__enumerator = None
+    self.__dirty_inputs = None
     return True
 
+  def definition(self, state_map):
+    """Returns a hex digest of what this action is defined to do:  its command
+    and the real names of its inputs and outputs.  If this differs from the
+    digest recorded when an output was built, the output is out-of-date.  Only
+    valid once is_ready is true."""
+
+    assert self.is_ready
+    if self.__definition is None:
+      hasher = hashlib.md5()
+      self.action.command.hash(hasher)
+      for artifacts in [self.inputs, self.outputs]:
+        names = [state_map.real_name(self.config, artifact)
+                 for artifact in artifacts]
+        names.sort()
+        hasher.update("%d\0%s\0" % (len(names), "\0".join(names)))
+      self.__definition = hasher.hexdigest()
+    return self.__definition
+
 class _StateMap(object):
   def __init__(self):
     self.__artifacts = {}
     self.__actions = {}
+    # The ActionRunner currently building, if any.  Clean outputs are only
+    # guaranteed to exist on disk once the runner has materialized them.
+    self.action_runner = None
+    # Maps (config name, real name) of each built artifact to the definition()
+    # of the action that built it, or None to rely on timestamps instead.
+    self.action_keys = None
+    # Maps (config, artifact) to real names computed so far.  Real names only
+    # depend on clean artifacts, which don't change during a build, so they
+    # can be remembered once known.
+    self.__real_names = {}
+    # The StatCache through which disk inputs are checked.
+    self.stat_cache = None
+    # The DepFileCache through which depfiles are read.
+    self.depfile_cache = None
+    # The IncludeCache through which source files are scanned.
+    self.include_cache = None
+    # Set by the Builder while it updates actions with its lock held during a
+    # build.  Materializing an output may mean fetching it from a cache, which
+    # mustn't hold up every other thread, so reads which would need to do so
+    # fail instead, adding (config, real name) to |deferred_materializations|
+    # and the enumerating ActionState to |deferred_actions|.  The Builder
+    # then materializes them without the lock and updates the actions again.
+    self.defer_materialize = False
+    self.deferred_materializations = []
+    self.deferred_actions = []
+    # (config, real name) of outputs materialized so far, and of those which
+    # some thread is materializing right now.
+    self.materialized = set()
+    self.materializing = set()
 
   def artifact_state(self, config, artifact):
     typecheck(artifact, Artifact)
@@ -271,49 +523,399 @@ class _StateMap(object):
     return result
 
   def real_name(self, config, artifact):
-    return artifact.real_name(
-      lambda sub_artifact: self.read_if_clean(config, sub_artifact))
+    if artifact.configured_name is None:
+      return artifact.filename
+    result = self.__real_names.get((config, artifact))
+    if result is None:
+      # Never deferred:  an artifact whose name can't be computed would be
+      # considered dirty for the rest of the build.  Names are normally
+      # computed from memory artifacts, which never need materializing.
+      result = artifact.real_name(
+        lambda sub_artifact: self.read_if_clean(config, sub_artifact,
+                                                defer = False))
+      if result is not None:
+        self.__real_names[(config, artifact)] = result
+    return result
+
+  def read_if_clean(self, config, artifact, defer = True):
+    """Returns the artifact's contents, or None if it is dirty or (when
+    |defer| is true) materializing it has been deferred."""
 
-  def read_if_clean(self, config, artifact):
     state = self.artifact_state(config, artifact)
     if state.is_dirty:
       return None
     real_name = self.real_name(state.config, state.artifact)
     if real_name is None:
       return None
+    if not self.__materialize(state, real_name, defer):
+      return None
     return state.config.root_dir.read(real_name)
 
+  def disk_path_if_clean(self, config, artifact):
+    """Like read_if_clean(), but returns the artifact's on-disk path instead
+    of its contents.  Also returns None if it's clean but not on disk."""
+
+    state = self.artifact_state(config, artifact)
+    if state.is_dirty:
+      return None
+    real_name = self.real_name(state.config, state.artifact)
+    if real_name is None:
+      return None
+    disk_path = state.config.root_dir.get_disk_path(real_name)
+    if disk_path is None:
+      return None
+    if not self.__materialize(state, real_name, True):
+      return None
+    return disk_path
+
+  def __materialize(self, state, real_name, defer):
+    """Makes sure the clean artifact |state| exists on disk.  Returns false if
+    that has been deferred."""
+
+    if state.artifact.action is None or self.action_runner is None:
+      return True
+    key = (state.config, real_name)
+    if key in self.materialized:
+      return True
+    if defer and self.defer_materialize:
+      self.deferred_materializations.append(key)
+      return False
+    self.action_runner.materialize(state.config, [real_name])
+    self.materialized.add(key)
+    return True
+
+class ActionTimings(object):
+  """Remembers how long each action took to run the last time it was built, so
+  that the Builder can estimate how much work remains behind each action.
+  Actions are identified by rule name, verb, and name, since Action objects
+  themselves do not survive between runs.  If |database| (a KeyValueStore) is
+  given, timings are kept in it across builds."""
+
+  # Estimate used for all actions when nothing has been recorded yet.
+  DEFAULT_ESTIMATE = 1.0
+
+  def __init__(self, database = None):
+    typecheck(database, KeyValueStore)
+
+    if database is None:
+      database = KeyValueStore()
+    self.__table = database.table("timings")
+    # The whole table, read up front since estimate() needs the average, and
+    # the sum of its values, which record() keeps up-to-date.
+    self.__durations = dict(self.__table.items())
+    self.__total = float(sum(self.__durations.values()))
+
+  def import_state(self, durations):
+    """Adds the timings from a timings.pickle written by older versions of
+    SEBS."""
+
+    typecheck(durations, dict)
+    self.__table.update(durations)
+    for key, seconds in durations.items():
+      self.__set(key, seconds)
+
+  def record(self, action, seconds):
+    typecheck(action, Action)
+    key = self.__key(action)
+    self.__set(key, seconds)
+    self.__table[key] = seconds
+
+  def estimate(self, action):
+    """Returns the expected run time of the action, in seconds.  Actions which
+    have never been run are assumed to take the average time of those which
+    have."""
+
+    typecheck(action, Action)
+    result = self.__durations.get(self.__key(action))
+    if result is None:
+      if len(self.__durations) == 0:
+        result = ActionTimings.DEFAULT_ESTIMATE
+      else:
+        result = self.__total / len(self.__durations)
+    return result
+
+  def __set(self, key, seconds):
+    self.__total = self.__total + seconds - self.__durations.get(key, 0)
+    self.__durations[key] = seconds
+
+  def __key(self, action):
+    return (action.rule.name, action.verb, action.name)
+
+class _LocalityQueue(object):
+  """Queue of ready ActionStates which runs actions in the order they were
+  added, except that actions made ready by a just-completed action go to the
+  front of the queue so that local work tends to be grouped together.  For
+  example, if we're building C++ libraries A and B, we'd like to compile the
+  sources of A, then link A, then compile the sources of B, then link B.  If we
+  added newly-ready stuff to the end of the queue, we'd end up compiling all
+  sources of both libraries before linking either one."""
+
+  def __init__(self):
+    self.__queue = collections.deque()
+
+  def __len__(self):
+    return len(self.__queue)
+
+  def add(self, action_state):
+    self.__queue.append(action_state)
+
+  def add_newly_ready(self, action_states):
+    for action_state in reversed(action_states):
+      self.__queue.appendleft(action_state)
+
+  def pop(self, accept = None):
+    """Remove and return the first action for which accept(action_state) is
+    true, or None if there is no such action.  If accept is None, any action
+    will do."""
+
+    for i, action_state in enumerate(self.__queue):
+      if accept is None or accept(action_state):
+        del self.__queue[i]
+        return action_state
+    return None
+
+class _CriticalPathQueue(object):
+  """Queue of ready ActionStates which always returns the action with the
+  longest estimated chain of pending work behind it (its own run time plus the
+  longest path through the actions it blocks), so that long chains like
+  codegen -> compile -> link -> test start as early as possible.  Ties are
+  broken using the same ordering as _LocalityQueue."""
+
+  def __init__(self, timings):
+    typecheck(timings, ActionTimings)
+    self.__timings = timings
+    self.__heap = []
+    # Locality tiebreakers.  Newly-ready actions count down from zero so they
+    # sort ahead of everything added before them; other actions count up.
+    self.__front = 0
+    self.__back = 0
+    # Maps ActionState to its estimated remaining critical path length.
+    self.__remaining = {}
+
+  def __len__(self):
+    return len(self.__heap)
+
+  def add(self, action_state):
+    self.__back = self.__back + 1
+    self.__push(action_state, self.__back)
+
+  def add_newly_ready(self, action_states):
+    self.__front = self.__front - len(action_states)
+    for i, action_state in enumerate(action_states):
+      self.__push(action_state, self.__front + i)
+
+  def pop(self, accept = None):
+    """Like _LocalityQueue.pop()."""
+
+    rejected = []
+    result = None
+    while len(self.__heap) > 0:
+      entry = heapq.heappop(self.__heap)
+      if accept is None or accept(entry[2]):
+        result = entry[2]
+        break
+      rejected.append(entry)
+    for entry in rejected:
+      heapq.heappush(self.__heap, entry)
+    return result
+
+  def __push(self, action_state, order):
+    heapq.heappush(self.__heap,
+        (-self.__remaining_time(action_state), order, action_state))
+
+  def __remaining_time(self, root):
+    # Walk the graph of pending dependents depth-first without recursion,
+    # since chains of actions can be deeper than Python's stack.
+    stack = [root]
+    while len(stack) > 0:
+      action_state = stack[-1]
+      if action_state in self.__remaining:
+        stack.pop()
+        continue
+
+      unknown = [dependent for dependent in action_state.blocked
+                 if dependent.is_pending and dependent not in self.__remaining]
+      if len(unknown) > 0:
+        stack.extend(unknown)
+        continue
+
+      longest = 0
+      for dependent in action_state.blocked:
+        if dependent.is_pending:
+          longest = max(longest, self.__remaining[dependent])
+      self.__remaining[action_state] = \
+          self.__timings.estimate(action_state.action) + longest
+      stack.pop()
+
+    return self.__remaining[root]
+
 class Builder(object):
-  def __init__(self, console):
+  # Names of the policies which may be passed as Builder's |schedule|.
+  SCHEDULES = ("critical-path", "locality")
+
+  # When holding back actions because the load average is too high, how long
+  # to wait (in seconds) before checking it again.
+  LOAD_CHECK_INTERVAL = 0.5
+
+  def __init__(self, console, timings = None, schedule = "critical-path",
+               keep_going = False, max_load = None, pools = None,
+               action_keys = None, stat_cache = None, depfile_cache = None,
+               include_cache = None):
+    """If |action_keys| is given, it is a dict-like object (e.g. a
+    KeyValueStore table) in which the Builder records how each artifact's
+    action was defined when it was built.  Outputs are then out-of-date only
+    if their own action's definition changed, rather than whenever the SEBS
+    file defining it (or anything it imports) is modified.
+
+    |stat_cache| is the StatCache used for this build, if the caller shares
+    one with other components.  The Builder invalidates each action's outputs
+    in it when the action completes.  Likewise, |depfile_cache| is the
+    DepFileCache through which dependency files are read, and
+    |include_cache| the IncludeCache through which sources are scanned."""
+
     typecheck(console, Console)
+    typecheck(timings, ActionTimings)
+    typecheck(schedule, basestring)
+    typecheck(max_load, [int, float])
+    typecheck(pools, dict)
+    typecheck(stat_cache, StatCache)
+    typecheck(depfile_cache, DepFileCache)
+    typecheck(include_cache, IncludeCache)
+
+    if timings is None:
+      timings = ActionTimings()
 
     self.__state_map = _StateMap()
+    self.__state_map.action_keys = action_keys
+    if stat_cache is None:
+      stat_cache = StatCache()
+    self.__state_map.stat_cache = stat_cache
+    if depfile_cache is None:
+      depfile_cache = DepFileCache(stat_cache = stat_cache)
+    self.__state_map.depfile_cache = depfile_cache
+    if include_cache is None:
+      include_cache = IncludeCache(stat_cache = stat_cache)
+    self.__state_map.include_cache = include_cache
     self.__console = console
+    self.__timings = timings
+    # Protects the state map, the queue, and the counters below.  It is *not*
+    # held while an action runs, so runners must do their own locking for any
+    # state they share between threads.
     self.__lock = threading.Lock()
+    # Signaled whenever the queue gains actions, the last pending action is
+    # started, or the build fails, so that idle threads can re-check state.
+    self.__condition = threading.Condition(self.__lock)
     self.__num_pending = 0
+    self.__num_running = 0
+
+    # If not None, don't start new actions while the system load average is
+    # above this (unless nothing is running at all).
+    self.__max_load = max_load
+
+    # Maps pool names to the total weight of actions they can run at once.
+    # Pools not listed here are unlimited.
+    if pools is None:
+      pools = {}
+    self.__pool_capacity = pools
+    # Maps pool names to the total weight of the actions currently using them.
+    self.__pool_usage = collections.defaultdict(int)
 
     # ActionStates which are ready but haven't been started.
-    self.__action_queue = collections.deque()
+    if schedule == "critical-path":
+      self.__action_queue = _CriticalPathQueue(timings)
+    elif schedule == "locality":
+      self.__action_queue = _LocalityQueue()
+    else:
+      raise ValueError("Unknown schedule: %s" % schedule)
 
     self.__tests = []
 
+    # (config, artifact) pairs which were explicitly requested, and so must
+    # end up on disk even if the runner would rather not write them.
+    self.__requested = set()
+
+    # If true, a failed action only stops the actions which depend on it.
+    self.__keep_going = keep_going
+    # Set when the build should stop starting new actions.
+    self.__stopped = False
+    # ActionStates which failed, in the order that they failed.
+    self.__failures = []
+    self.__num_skipped = 0
+
     self.failed = False
 
+  def prefetch(self, config, rules, threads = None):
+    """Stats, in parallel, the files that adding |rules| is likely to look at:
+    source files, existing outputs, and the disk inputs listed in depfiles.
+    Call this before add_rule() or add_test(), whose dirty checks then find the
+    results in the StatCache rather than stat'ing files one at a time.  This
+    is only an optimization; anything it misses is stat'ed later as usual."""
+
+    typecheck(rules, list, Rule)
+
+    paths = []
+    seen = set()
+    actions = []
+
+    def add_artifact(config, artifact):
+      while artifact.alt_artifact is not None:
+        config = config.alt_configs.get(artifact.alt_config)
+        if config is None:
+          return   # The real dirty check will complain.
+        artifact = artifact.alt_artifact
+      if (config, artifact) in seen:
+        return
+      seen.add((config, artifact))
+
+      real_name = artifact.real_name(lambda sub_artifact: None)
+      if real_name is not None:
+        disk_path = config.root_dir.get_disk_path(real_name)
+        if disk_path is not None:
+          paths.append(disk_path)
+      if artifact.action is not None:
+        actions.append((config, artifact.action))
+
+    for rule in rules:
+      rule.expand_once()
+      for artifact in rule.outputs:
+        add_artifact(config, artifact)
+      if isinstance(rule, Test):
+        add_artifact(config, rule.test_result_artifact)
+        add_artifact(config, rule.test_output_artifact)
+
+    visited = set()
+    while len(actions) > 0:
+      action_config, action = actions.pop()
+      if (action_config, action) in visited:
+        continue
+      visited.add((action_config, action))
+
+      enumerator = _PrefetchEnumerator(action_config, action,
+                                       self.__state_map.depfile_cache)
+      try:
+        action.command.enumerate_artifacts(enumerator)
+      except DefinitionError:
+        continue   # Will be reported when the rule is added.
+      for artifact in enumerator.artifacts:
+        add_artifact(action_config, artifact)
+      paths.extend(enumerator.disk_inputs)
+
+    self.__state_map.stat_cache.prefetch(paths, threads)
+
   def add_action(self, config, action):
     typecheck(action, Action)
 
     action_state = self.__state_map.action_state(config, action)
-    if action_state.is_pending:
-      # Already pending.
+    if action_state.is_pending or action_state.is_skipped:
+      # Already pending, or can't be built.
       return
 
     action_state.is_pending = True
     self.__num_pending = self.__num_pending + 1
     if action_state.is_ready:
-      self.__action_queue.append(action_state)
+      self.__action_queue.add(action_state)
     else:
-      for blocker in action_state.blocking:
-        self.add_action(blocker.config, blocker.action)
+      self.__add_blockers(action_state)
 
   def add_artifact(self, config, artifact):
     typecheck(artifact, Artifact)
@@ -322,6 +924,8 @@ class Builder(object):
     if not artifact_state.is_dirty:
       return   # Source file; nothing to do.
 
+    self.__requested.add((artifact_state.config, artifact_state.artifact))
+
     # The artifact is dirty, therefore it must have an action.  Note that
     # artifact_state.artifact and artifact_state.config may differ from
     # the local artifact and config if the artifact is a reference to one
@@ -356,33 +960,145 @@ class Builder(object):
     self.__lock.acquire()
     try:
       typecheck(action_runner, ActionRunner)
+      self.__state_map.action_runner = action_runner
+      # From here on, only __finish_action() updates actions.
+      self.__state_map.defer_materialize = True
 
-      while self.__num_pending > 0 and not self.failed:
+      while self.__num_pending > 0 and not self.__stopped:
         if len(self.__action_queue) == 0:
-          # wait for actions
-          # TODO(kenton):  Use a semaphore or something?
-          self.__lock.release()
-          try:
-            time.sleep(1)
-          finally:
-            self.__lock.acquire()
+          # Wait for some other thread to finish an action and make its
+          # dependents ready (or to finish the build).
+          self.__condition.wait()
+          continue
+
+        if self.__is_overloaded():
+          # The load average doesn't change in response to anything we can
+          # wait for, so just check back later.
+          self.__condition.wait(Builder.LOAD_CHECK_INTERVAL)
+          continue
+
+        action_state = self.__action_queue.pop(self.__has_pool_capacity)
+        if action_state is None:
+          # Everything that's ready is waiting for a pool that is full.  Wait
+          # for a running action to finish.
+          self.__condition.wait()
           continue
 
-        action_state = self.__action_queue.popleft()
         self.do_one_action(
             action_state.config, action_state.action, action_runner)
     except KeyboardInterrupt:
       if not self.failed:
         self.__console.write(ColoredText(ColoredText.RED, "INTERRUPTED"))
       self.failed = True
+      self.__stopped = True
     except:
       self.failed = True
+      self.__stopped = True
+      raise
+    finally:
+      # Wake up any idle threads so they notice that the build is done.
+      self.__condition.notify_all()
+      self.__lock.release()
+
+  def cancel(self):
+    """Called (from any thread) to make all threads executing build() return
+    as soon as the actions they are currently running complete."""
+
+    self.__lock.acquire()
+    try:
+      self.failed = True
+      self.__stopped = True
+      self.__condition.notify_all()
+    finally:
+      self.__lock.release()
+
+  def build_event_loop(self, action_runner, event_loop, max_jobs):
+    """Like build(), but rather than tying up a thread per running action, runs
+    up to |max_jobs| actions at once from the calling thread.  Actions are run
+    using action_runner.run_async(), and |event_loop| (an EventLoop) waits on
+    their subprocesses.  Do not call build() on the same Builder at the same
+    time."""
+
+    self.__lock.acquire()
+    try:
+      typecheck(action_runner, ActionRunner)
+      typecheck(event_loop, EventLoop)
+      self.__state_map.action_runner = action_runner
+      self.__state_map.defer_materialize = True
+
+      while True:
+        timeout = None
+        while not self.__stopped and len(event_loop) < max_jobs and \
+              len(self.__action_queue) > 0:
+          if self.__is_overloaded():
+            timeout = Builder.LOAD_CHECK_INTERVAL
+            break
+          action_state = self.__action_queue.pop(self.__has_pool_capacity)
+          if action_state is None:
+            break   # Waiting for room in a pool.
+          event_loop.add(self.__run_action_async(action_state, action_runner))
+
+        if len(event_loop) == 0:
+          # Nothing is running and nothing more can start, so we're done.
+          break
+
+        event_loop.run_once(timeout)
+    except KeyboardInterrupt:
+      # Either the user hit ctrl+C, or an action failed and the others were
+      # cancelled.  Let the actions which are still running shut down.
+      if not self.failed:
+        self.__console.write(ColoredText(ColoredText.RED, "INTERRUPTED"))
+      self.failed = True
+      self.__stopped = True
+      action_runner.cancel()
+      while len(event_loop) > 0:
+        try:
+          event_loop.run_once()
+        except KeyboardInterrupt:
+          pass
+    except:
+      self.failed = True
+      self.__stopped = True
+      event_loop.cancel()
       raise
     finally:
       self.__lock.release()
 
   def do_one_action(self, config, action, action_runner):
     action_state = self.__state_map.action_state(config, action)
+    run_args, start_time, requested = self.__start_action(action_state)
+
+    self.__lock.release()
+    try:
+      succeeded = action_runner.run(*run_args)
+      if succeeded and len(requested) > 0:
+        succeeded = action_runner.materialize(config, requested)
+    finally:
+      self.__lock.acquire()
+      self.__end_action(action_state)
+
+    self.__finish_action(action_state, succeeded, start_time, action_runner)
+
+  def __run_action_async(self, action_state, action_runner):
+    run_args, start_time, requested = self.__start_action(action_state)
+
+    try:
+      succeeded = yield action_runner.run_async(*run_args)
+      if succeeded and len(requested) > 0:
+        succeeded = action_runner.materialize(action_state.config, requested)
+    finally:
+      self.__end_action(action_state)
+
+    self.__finish_action(action_state, succeeded, start_time, action_runner)
+    yield succeeded
+
+  def __start_action(self, action_state):
+    """Does the bookkeeping for starting an action.  Returns the arguments to
+    pass to ActionRunner.run(), the start time, and the real names of the
+    requested outputs, which must be materialized afterwards."""
+
+    config = action_state.config
+    action = action_state.action
     test_result = None
     if action_state.test is not None:
       test_result = action_state.test.test_result_artifact
@@ -390,49 +1106,283 @@ class Builder(object):
     real_name_map = {}
     for artifact in action_state.inputs + action_state.outputs:
       real_name_map[artifact] = self.__state_map.real_name(config, artifact)
+    requested = [real_name_map[output] for output in action_state.outputs
+                 if (config, output) in self.__requested]
 
+    action_state.is_started = True
     self.__num_pending = self.__num_pending - 1
-    if not action_runner.run(action, action_state.inputs,
-                                     action_state.disk_inputs,
-                                     action_state.outputs,
-                                     test_result,
-                                     config,
-                                     real_name_map,
-                                     self.__lock):
-      if not self.failed:
+    if self.__num_pending == 0:
+      # Let idle threads exit.
+      self.__condition.notify_all()
+    self.__num_running = self.__num_running + 1
+    if action.pool is not None:
+      self.__pool_usage[action.pool] = \
+          self.__pool_usage[action.pool] + action.weight
+
+    run_args = (action, action_state.inputs, action_state.disk_inputs,
+                action_state.outputs, test_result, config, real_name_map)
+    return (run_args, time.time(), requested)
+
+  def __end_action(self, action_state):
+    """Undoes the bookkeeping done by __start_action(), whether or not the
+    action succeeded."""
+
+    action = action_state.action
+    self.__num_running = self.__num_running - 1
+    if action.pool is not None:
+      self.__pool_usage[action.pool] = \
+          self.__pool_usage[action.pool] - action.weight
+      if len(self.__action_queue) > 0:
+        # Threads may be waiting for room in this pool.
+        self.__condition.notify_all()
+
+  def __finish_action(self, action_state, succeeded, start_time,
+                      action_runner):
+    """Updates the build state after an action has run."""
+
+    config = action_state.config
+    action = action_state.action
+
+    # Whether or not it succeeded, the action may have written its outputs
+    # behind the StatCache's back.
+    for output in action_state.outputs:
+      disk_path = config.root_dir.get_disk_path(
+          self.__state_map.real_name(config, output))
+      if disk_path is not None:
+        self.__state_map.stat_cache.invalidate(disk_path)
+
+    if not succeeded:
+      if self.__state_map.action_keys is not None:
+        # The outputs may be half-written, so they must not match the old
+        # definition any more.
+        for output in action_state.outputs:
+          self.__state_map.action_keys.pop(
+              (config.name, self.__state_map.real_name(config, output)), None)
+      action_state.is_failed = True
+      self.__failures.append(action_state)
+      if self.__keep_going:
+        self.__skip(list(action_state.blocked))
+      elif not self.failed:
         self.__console.write(ColoredText(ColoredText.RED, "BUILD FAILED"))
-        self.failed = True
+        self.__stopped = True
+        # Don't wait for the other running actions to finish.
+        action_runner.cancel()
+      self.failed = True
       return
 
+    self.__timings.record(action, time.time() - start_time)
+
+    real_names = [self.__state_map.real_name(config, output)
+                  for output in action_state.outputs]
+    unchanged = set(action_runner.unchanged_outputs(config, real_names))
+    for output, real_name in zip(action_state.outputs, real_names):
+      output_state = self.__state_map.artifact_state(config, output)
+      output_state.is_dirty = False
+      # An output which didn't exist before can't have come out the same.
+      output_state.is_changed = \
+          output_state.timestamp < 0 or real_name not in unchanged
+    self.__record_definition(action_state, real_names)
+
     newly_ready = []
 
-    for output in action_state.outputs:
-      self.__state_map.artifact_state(config, output).is_dirty = False
+    # Actions completed without running because all of their outputs turned
+    # out to be up-to-date.  Their dependents need updating just like ours.
+    completed = [action_state]
+    while len(completed) > 0 or len(self.__state_map.deferred_actions) > 0:
+      while len(completed) > 0:
+        self.__update_dependents(completed.pop(), newly_ready, completed)
+      # Some dependents may not have been able to read their inputs yet.  They
+      # may defer again if what they read leads them to read something else.
+      for dependent in self.__materialize_deferred(action_runner):
+        self.__update_dependent(dependent, newly_ready, completed)
+
+    self.__action_queue.add_newly_ready(newly_ready)
+
+    # Wake up idle threads to handle the newly-ready actions, including any
+    # that add_action() queued above.
+    if len(self.__action_queue) > 0:
+      self.__condition.notify(len(self.__action_queue))
+    elif self.__num_pending == 0:
+      # Let idle threads exit.
+      self.__condition.notify_all()
+
+  def __update_dependents(self, action_state, newly_ready, completed):
+    """Updates the readiness of the actions blocked by the given (completed)
+    action.  Dependents which become ready are added to |newly_ready|, unless
+    none of their inputs actually changed, in which case they are marked
+    complete without running and added to |completed|."""
 
     for dependent in action_state.blocked:
-      became_ready = dependent.update_readiness(self.__state_map)
-      if dependent.is_pending:
-        if became_ready:
-          newly_ready.append(dependent)
+      self.__update_dependent(dependent, newly_ready, completed)
+
+  def __update_dependent(self, dependent, newly_ready, completed):
+    old_blocking = dependent.blocking
+    became_ready = dependent.update_readiness(self.__state_map)
+    if dependent.is_pending:
+      if became_ready:
+        if self.__is_up_to_date(dependent):
+          self.__cut_off(dependent)
+          completed.append(dependent)
         else:
-          # This action is still blocked on something else.  It's possible
-          # that completion of the current action caused this dependent to
-          # realize that it needs some other inputs that it didn't know
-          # about before.  Thus its blocking list may now contain actions
-          # that didn't previously know we needed to build.  We must scan
-          # through the list and add any such actions to the pending list.
-          for blocker in dependent.blocking:
-            if not blocker.is_pending:
-              self.add_action(blocker.config, blocker.action)
-
-    # Stick newly-ready stuff at the beginning of the queue so that local
-    # work tends to be grouped together.  For example, if we're building
-    # C++ libraries A and B, we'd like to compile the sources of A, then
-    # link A, then compile the sources of B, then link B.  If we added
-    # newly-ready stuff to the end of the queue, we'd end up compiling all
-    # sources of both libraries before linking either one.
-    newly_ready.reverse()
-    self.__action_queue.extendleft(newly_ready)
+          newly_ready.append(dependent)
+      else:
+        # This action is still blocked on something else.  It's possible
+        # that completion of the current action caused this dependent to
+        # realize that it needs some other inputs that it didn't know
+        # about before.  Thus its blocking list may now contain actions
+        # that didn't previously know we needed to build.  We must scan
+        # through the list and add any such actions to the pending list.
+        # (If the list wasn't replaced, it can't contain anything new.)
+        if dependent.blocking is not old_blocking:
+          self.__add_blockers(dependent)
+
+  def __add_blockers(self, action_state):
+    """Adds the actions blocking the given pending action to the pending list.
+    If any of them has already failed or been skipped, the action can never
+    become ready, so it is skipped instead."""
+
+    for blocker in action_state.blocking:
+      if blocker.is_failed or blocker.is_skipped:
+        self.__skip([action_state])
+        return
+    for blocker in action_state.blocking:
+      if not blocker.is_pending:
+        self.add_action(blocker.config, blocker.action)
+
+  def __materialize_deferred(self, action_runner):
+    """Materializes the outputs which updating actions had to defer (see
+    _StateMap.defer_materialize), with the lock released.  Returns the
+    ActionStates which deferred them, which need updating again."""
+
+    state_map = self.__state_map
+    keys = set(state_map.deferred_materializations)
+    actions = []
+    for action_state in state_map.deferred_actions:
+      if action_state not in actions:
+        actions.append(action_state)
+    state_map.deferred_materializations = []
+    state_map.deferred_actions = []
+    if len(keys) == 0:
+      return actions
+
+    # Other threads may already be materializing some of these.
+    mine = [key for key in keys if key not in state_map.materializing]
+    state_map.materializing.update(mine)
+    self.__lock.release()
+    try:
+      for config, real_name in mine:
+        action_runner.materialize(config, [real_name])
+    finally:
+      self.__lock.acquire()
+      state_map.materializing.difference_update(mine)
+      state_map.materialized.update(mine)
+      self.__condition.notify_all()
+
+    while len(keys & state_map.materializing) > 0:
+      self.__condition.wait()
+    return actions
+
+  def __is_up_to_date(self, action_state):
+    """Checks whether a newly-ready action has nothing to do, because every
+    input that was rebuilt came out the same as before."""
+
+    if len(action_state.outputs) == 0:
+      return False
+    for output in action_state.outputs:
+      output_state = self.__state_map.artifact_state(action_state.config,
+                                                     output)
+      if output_state.is_still_dirty(self.__state_map):
+        return False
+    return True
+
+  def __cut_off(self, action_state):
+    """Marks an up-to-date action as complete without running it."""
+
+    # Like an action that ran, it stays pending so that nothing adds it again.
+    config = action_state.config
+    action_state.is_started = True
+    self.__num_pending = self.__num_pending - 1
+    for output in action_state.outputs:
+      output_state = self.__state_map.artifact_state(config, output)
+      output_state.is_dirty = False
+      # Make the outputs newer than the rebuilt inputs, so that they don't
+      # look dirty next time.
+      config.root_dir.touch(self.__state_map.real_name(config, output))
+    # Their recorded definitions must already match, or we wouldn't be here.
+
+  def __record_definition(self, action_state, real_names):
+    """Remembers the definition of an action whose outputs, with the given
+    real names, are now up-to-date."""
+
+    action_keys = self.__state_map.action_keys
+    if action_keys is None:
+      return
+    definition = action_state.definition(self.__state_map)
+    action_keys.update([((action_state.config.name, real_name), definition)
+                        for real_name in real_names])
+
+  def __has_pool_capacity(self, action_state):
+    pool = action_state.action.pool
+    if pool is None or pool not in self.__pool_capacity:
+      return True
+    usage = self.__pool_usage[pool]
+    # An action heavier than the whole pool may still run on its own, or it
+    # could never run at all.
+    return usage == 0 or \
+           usage + action_state.action.weight <= self.__pool_capacity[pool]
+
+  def __is_overloaded(self):
+    # Like make, we always allow at least one action to run, since otherwise
+    # a busy machine could stall the build forever.
+    if self.__max_load is None or self.__num_running == 0:
+      return False
+    return os.getloadavg()[0] > self.__max_load
+
+  def __skip(self, action_states):
+    """Marks the given actions, which can't be built because something they
+    depend on failed, as skipped, along with every action which transitively
+    depends on them, so that the rest of the build can continue without
+    them.  Actions which aren't pending, are ready (so no longer depend on
+    anything that failed), or have already started are left alone; a
+    |blocked| set may be stale after its members re-enumerated their inputs.
+    """
+
+    stack = list(action_states)
+    while len(stack) > 0:
+      action_state = stack.pop()
+      if action_state.is_pending and not action_state.is_ready and \
+         not action_state.is_started:
+        action_state.is_pending = False
+        action_state.is_skipped = True
+        self.__num_pending = self.__num_pending - 1
+        self.__num_skipped = self.__num_skipped + 1
+        stack.extend(action_state.blocked)
+
+    if self.__num_pending == 0:
+      # Let idle threads exit.
+      self.__condition.notify_all()
+
+  def print_failures(self):
+    """Prints a summary listing every action that failed.  Returns true if
+    there were no failures."""
+
+    if len(self.__failures) == 0:
+      return True
+
+    print "\nBuild failures:"
+    for action_state in self.__failures:
+      action = action_state.action
+      message = ["  ", ColoredText(ColoredText.RED, "FAILED: ")]
+      if action_state.config.name is not None:
+        message.append(ColoredText(ColoredText.FUCHSIA,
+                                   [action_state.config.name, ": "]))
+      message.extend([ColoredText(ColoredText.BLUE, [action.verb, ": "]),
+                      action.name])
+      self.__console.write(message)
+    if self.__num_skipped > 0:
+      self.__console.write(
+          "  %d dependent action(s) skipped." % self.__num_skipped)
+    return False
 
   def print_test_results(self):
     self.__tests.sort()
@@ -441,6 +1391,16 @@ class Builder(object):
 
     had_failure = False
     for name, config, test, cached in self.__tests:
+      result_state = self.__state_map.artifact_state(
+          config, test.test_result_artifact)
+      if result_state.is_dirty:
+        # The test never ran, because it or something it depends on failed
+        # to build.  (Only possible in keep-going mode.)
+        self.__console.write(["  %-70s " % name,
+                              ColoredText(ColoredText.YELLOW, "SKIPPED")])
+        had_failure = True
+        continue
+
       result = config.root_dir.read(
           self.__state_map.real_name(config, test.test_result_artifact))
 
@@ -0,0 +1,165 @@
+#! /usr/bin/python
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Measures the scheduling overhead of Builder.build().
+
+Usage:
+  builder_benchmark.py [-j THREADS] [-d DEPTH] [-c COST_MS]
+
+Builds a deep chain of cheap actions.  The chain has DEPTH layers, each of
+which contains THREADS actions that all depend on every action in the previous
+layer, so the ready queue drains completely each time a layer finishes.  Each
+action just sleeps for COST_MS milliseconds, as a real subprocess would.  The ideal wall time is therefore DEPTH * COST_MS; the
+difference between that and the measured time is time the worker threads
+spent idle even though work was available.
+"""
+
+import cStringIO
+import getopt
+import sys
+import threading
+import time
+
+from sebs.core import Artifact, Action, Rule, Context
+from sebs.filesystem import VirtualDirectory
+from sebs.builder import Builder
+from sebs.command import Command
+from sebs.console import make_console
+from sebs.runner import ActionRunner
+
+class UsageError(Exception):
+  pass
+
+class _SleepRunner(ActionRunner):
+  def __init__(self, cost):
+    self.__cost = cost
+
+  def run(self, action, inputs, disk_inputs, outputs, test_result, config,
+          real_name_map):
+    time.sleep(self.__cost)
+    return True
+
+class _BenchmarkContext(Context):
+  def __init__(self):
+    super(_BenchmarkContext, self).__init__()
+    self.filename = "benchmark.sebs"
+    self.full_filename = "src/benchmark.sebs"
+    self.timestamp = 0
+
+class _BenchmarkCommand(Command):
+  def __init__(self, inputs, outputs):
+    self.__inputs = inputs
+    self.__outputs = outputs
+
+  def enumerate_artifacts(self, artifact_enumerator):
+    for input in self.__inputs:
+      artifact_enumerator.add_input(input)
+    for output in self.__outputs:
+      artifact_enumerator.add_output(output)
+
+class _BenchmarkConfiguration(object):
+  def __init__(self, dir):
+    self.root_dir = dir
+    self.name = None
+
+def _make_chain(rule, depth, width):
+  """Builds the action graph and returns the final layer's artifacts."""
+
+  layer = []
+  for i in range(depth):
+    next_layer = []
+    for j in range(width):
+      action = Action(rule, "step", "%d.%d" % (i, j))
+      output = Artifact("tmp/%d/%d" % (i, j), action)
+      action.command = _BenchmarkCommand(layer, [output])
+      next_layer.append(output)
+    layer = next_layer
+  return layer
+
+def run_benchmark(threads, depth, cost):
+  """Returns the wall time, in seconds, taken to build the chain."""
+
+  rule = Rule(_BenchmarkContext())
+  config = _BenchmarkConfiguration(VirtualDirectory())
+  builder = Builder(make_console(cStringIO.StringIO()))
+  for artifact in _make_chain(rule, depth, threads):
+    builder.add_artifact(config, artifact)
+
+  runner = _SleepRunner(cost)
+  thread_objects = []
+  start = time.time()
+  for i in range(threads):
+    thread_objects.append(
+      threading.Thread(target = builder.build, args = [runner]))
+    thread_objects[-1].start()
+  for thread in thread_objects:
+    thread.join()
+  return time.time() - start
+
+def main(argv):
+  try:
+    opts, args = getopt.getopt(argv[1:], "hj:d:c:", ["help"])
+  except getopt.error, message:
+    raise UsageError(message)
+
+  threads = 4
+  depth = 20
+  cost = 0.005
+
+  for name, value in opts:
+    if name in ("-h", "--help"):
+      print __doc__
+      return 0
+    elif name == "-j":
+      threads = int(value)
+    elif name == "-d":
+      depth = int(value)
+    elif name == "-c":
+      cost = float(value) / 1000
+
+  elapsed = run_benchmark(threads, depth, cost)
+  ideal = depth * cost
+  print "%d actions in %d layers with %d threads:" % \
+      (depth * threads, depth, threads)
+  print "  wall time:  %8.3fs" % elapsed
+  print "  ideal:      %8.3fs" % ideal
+  print "  idle:       %8.3fs" % (elapsed - ideal)
+  return 0
+
+if __name__ == "__main__":
+  try:
+    sys.exit(main(sys.argv))
+  except UsageError, error:
+    print >>sys.stderr, error.message
+    print >>sys.stderr, "for help use --help"
+    sys.exit(2)
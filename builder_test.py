@@ -32,23 +32,42 @@
 
 # TODO(kenton): Test DryRunner and SubprocessRunner.
 
+import os
+import threading
+import time
 import unittest
 import cStringIO
 
 from sebs.core import Artifact, Action, Rule, Context, DefinitionError
 from sebs.filesystem import VirtualDirectory
-from sebs.builder import Builder
+from sebs.builder import Builder, ActionTimings
 from sebs.command import Command
 from sebs.console import make_console
+from sebs.eventloop import EventLoop
+from sebs.kvstore import KeyValueStore
 from sebs.runner import ActionRunner
 
 class MockRunner(ActionRunner):
-  def __init__(self):
+  def __init__(self, failing_actions = None, unchanged = None):
+    if failing_actions is None:
+      failing_actions = []
+    if unchanged is None:
+      unchanged = []
     self.actions = []
+    # Maps each action run to its inputs.
+    self.inputs = {}
+    self.failing_actions = failing_actions
+    self.unchanged = unchanged
+    self.cancelled = False
+    self.materialized = []
 
   def run(self, action, inputs, disk_inputs, outputs, test_result, config,
-          real_name_map, lock):
+          real_name_map):
     self.actions.append(action)
+    self.inputs[action] = inputs
+
+    if action in self.failing_actions:
+      return False
 
     # Hack for testDerivedCondition:  If the action is condition_builder then
     # copy cond_dep to cond.
@@ -64,6 +83,73 @@ class MockRunner(ActionRunner):
 
     return True
 
+  def cancel(self):
+    self.cancelled = True
+
+  def materialize(self, config, names):
+    self.materialized.extend(names)
+    return True
+
+  def unchanged_outputs(self, config, names):
+    return [name for name in names if name in self.unchanged]
+
+class ConcurrencyRunner(ActionRunner):
+  """Runs each action for a short time and records the most actions that were
+  ever running at once, per pool."""
+
+  def __init__(self):
+    self.running = {}
+    self.max_running = {}
+    self.lock = threading.Lock()
+
+  def run(self, action, inputs, disk_inputs, outputs, test_result, config,
+          real_name_map):
+    self.lock.acquire()
+    self.running[action.pool] = self.running.get(action.pool, 0) + 1
+    self.max_running[action.pool] = max(self.max_running.get(action.pool, 0),
+                                        self.running[action.pool])
+    self.lock.release()
+    time.sleep(0.02)
+    self.lock.acquire()
+    self.running[action.pool] = self.running[action.pool] - 1
+    self.lock.release()
+    return True
+
+class LoadRunner(ActionRunner):
+  """Stands in for os.getloadavg() as well as running actions.  The load is
+  high until |load_drops_after| actions have finished.  Records the most
+  actions that were ever running at once while the load was high and low."""
+
+  def __init__(self, load_drops_after):
+    self.load = 100.0
+    self.load_drops_after = load_drops_after
+    self.finished = 0
+    self.running = 0
+    self.max_running_loaded = 0
+    self.max_running_unloaded = 0
+    self.lock = threading.Lock()
+
+  def getloadavg(self):
+    return (self.load, self.load, self.load)
+
+  def run(self, action, inputs, disk_inputs, outputs, test_result, config,
+          real_name_map):
+    self.lock.acquire()
+    self.running = self.running + 1
+    if self.load > 0:
+      self.max_running_loaded = max(self.max_running_loaded, self.running)
+    else:
+      self.max_running_unloaded = max(self.max_running_unloaded, self.running)
+    self.lock.release()
+    time.sleep(0.05)
+    self.lock.acquire()
+    self.running = self.running - 1
+    self.finished = self.finished + 1
+    if self.finished == self.load_drops_after:
+      self.load = 0.0
+    self.lock.release()
+    return True
+
 class MockContext(Context):
   def __init__(self, filename, full_filename):
     super(MockContext, self).__init__()
@@ -72,9 +158,10 @@ class MockContext(Context):
     self.timestamp = 0
 
 class MockCommand(Command):
-  def __init__(self, inputs, outputs):
+  def __init__(self, inputs, outputs, flags = ""):
     self.__inputs = inputs
     self.__outputs = outputs
+    self.__flags = flags
 
   def enumerate_artifacts(self, artifact_enumerator):
     for input in self.__inputs:
@@ -82,6 +169,10 @@ class MockCommand(Command):
     for output in self.__outputs:
       artifact_enumerator.add_output(output)
 
+  def hash(self, hasher):
+    hasher.update("MockCommand:")
+    hasher.update(self.__flags)
+
 class ConditionalMockCommand(Command):
   def __init__(self, condition, inputs, conditional_inputs, outputs):
     self.__condition = condition
@@ -98,9 +189,24 @@ class ConditionalMockCommand(Command):
     for output in self.__outputs:
       artifact_enumerator.add_output(output)
 
+class ChainedConditionMockCommand(Command):
+  """Reads each condition in turn for as long as they come out "true"."""
+
+  def __init__(self, conditions, outputs):
+    self.__conditions = conditions
+    self.__outputs = outputs
+
+  def enumerate_artifacts(self, artifact_enumerator):
+    for condition in self.__conditions:
+      if artifact_enumerator.read(condition) != "true":
+        break
+    for output in self.__outputs:
+      artifact_enumerator.add_output(output)
+
 class MockConfiguration(object):
   def __init__(self, dir):
     self.root_dir = dir
+    self.name = None
 
 class BuilderTest(unittest.TestCase):
   def setUp(self):
@@ -109,9 +215,9 @@ class BuilderTest(unittest.TestCase):
     self.rule = Rule(self.context)
     self.console = make_console(cStringIO.StringIO())  # ignore output
 
-  def doBuild(self, *artifacts):
-    builder = Builder(self.console)
-    runner = MockRunner()
+  def doBuild(self, *artifacts, **kwargs):
+    runner = MockRunner(unchanged = kwargs.pop("unchanged", []))
+    builder = Builder(self.console, **kwargs)
     config = MockConfiguration(self.dir)
     for artifact in artifacts:
       builder.add_artifact(config, artifact)
@@ -179,6 +285,19 @@ class BuilderTest(unittest.TestCase):
     self.dir.add("out2", 50, "")
     self.assertEqual([], self.doBuild(out1, out2))
 
+  def testDuplicateInputs(self):
+    input = Artifact("input", None)
+    action = Action(self.rule, "", "action")
+    output = Artifact("output", action)
+    action.command = ConditionalMockCommand(input, [input], [input], [output])
+
+    self.dir.add("input", 20, "true")
+    builder = Builder(self.console)
+    runner = MockRunner()
+    builder.add_artifact(MockConfiguration(self.dir), output)
+    builder.build(runner)
+    self.assertEqual([input], runner.inputs[action])
+
   def testActionWithDependency(self):
     input = Artifact("input", None)
     action1 = Action(self.rule, "")
@@ -218,6 +337,84 @@ class BuilderTest(unittest.TestCase):
     self.assertEqual([action1, action2], self.doBuild(output))
     self.assertEqual([action1], self.doBuild(temp))
 
+  def testActionKeys(self):
+    input = Artifact("input", None)
+    action = Action(self.rule, "")
+    output = Artifact("output", action)
+    action.command = MockCommand([input], [output])
+    action_keys = {}
+
+    # Built before definitions were recorded; the SEBS file's timestamp is
+    # used, and the current definition recorded.
+    self.dir.add("input", 20, "")
+    self.dir.add("output", 40, "")
+    self.assertEqual([], self.doBuild(output, action_keys = action_keys))
+    self.assertEqual([(None, "output")], action_keys.keys())
+
+    # SEBS file is newer than output, but the action didn't change.
+    self.context.timestamp = 50
+    self.assertEqual([], self.doBuild(output, action_keys = action_keys))
+
+    # The action changed.
+    action.command = MockCommand([input], [output], "-O2")
+    self.assertEqual([action], self.doBuild(output, action_keys = action_keys))
+    self.assertEqual([], self.doBuild(output, action_keys = action_keys))
+
+    # A failed build forgets the definition.
+    action.command = MockCommand([input], [output], "-O3")
+    builder = Builder(self.console, action_keys = action_keys)
+    builder.add_artifact(MockConfiguration(self.dir), output)
+    builder.build(MockRunner(failing_actions = [action]))
+    self.assertEqual({}, action_keys)
+
+  def testEarlyCutoff(self):
+    input = Artifact("input", None)
+    action1 = Action(self.rule, "")
+    temp = Artifact("temp", action1)
+    action1.command = MockCommand([input], [temp])
+    action2 = Action(self.rule, "")
+    output = Artifact("output", action2)
+    action2.command = MockCommand([temp], [output])
+
+    # temp is outdated, but comes out the same, so output is left alone.
+    self.dir.add("input", 20, "")
+    self.dir.add("temp", 10, "")
+    self.dir.add("output", 15, "")
+    self.assertEqual([action1], self.doBuild(output, unchanged = ["temp"]))
+    # output was touched so that it is newer than temp next time.
+    self.assertTrue(self.dir.getmtime("output") > 20)
+
+    # temp changes.
+    self.dir.add("temp", 10, "")
+    self.dir.add("output", 15, "")
+    self.assertEqual([action1, action2], self.doBuild(output))
+
+    # temp comes out the same, but output was already outdated.
+    self.dir.add("output", 5, "")
+    self.assertEqual([action1, action2],
+                     self.doBuild(output, unchanged = ["temp"]))
+
+  def testEnumerationReused(self):
+    class CountingCommand(MockCommand):
+      def enumerate_artifacts(self, artifact_enumerator):
+        self.count = getattr(self, "count", 0) + 1
+        MockCommand.enumerate_artifacts(self, artifact_enumerator)
+
+    input = Artifact("input", None)
+    self.dir.add("input", 20, "")
+    objects = []
+    for i in range(20):
+      action = Action(self.rule, "", "compile%d" % i)
+      objects.append(Artifact("obj%d" % i, action))
+      action.command = MockCommand([input], [objects[-1]])
+    link = Action(self.rule, "", "link")
+    output = Artifact("output", link)
+    link.command = CountingCommand(objects, [output])
+
+    self.assertEqual(21, len(self.doBuild(output)))
+    # Only when the link is first seen, not again as each object is built.
+    self.assertEqual(1, link.command.count)
+
   def testDiamondDependency(self):
     input = Artifact("input", None)
     action1 = Action(self.rule, "")
@@ -339,5 +536,316 @@ class BuilderTest(unittest.TestCase):
     self.assertEqual([condition_builder, conditional_action, action],
                      self.doBuild(output))
 
+  def testMaterialize(self):
+    # Only requested outputs, and outputs the Builder itself reads, need to be
+    # materialized.
+    condition_dep = Artifact("cond_dep", None)
+    condition_builder = Action(self.rule, "", "condition_builder")
+    condition = Artifact("cond", condition_builder)
+    condition_builder.command = MockCommand([condition_dep], [condition])
+
+    action1 = Action(self.rule, "", "action1")
+    temp = Artifact("temp", action1)
+    action1.command = MockCommand([], [temp])
+
+    action2 = Action(self.rule, "", "action2")
+    output = Artifact("output", action2)
+    action2.command = ConditionalMockCommand(condition, [temp], [], [output])
+
+    self.dir.add("cond_dep", 20, "false")
+    builder = Builder(self.console)
+    runner = MockRunner()
+    builder.add_artifact(MockConfiguration(self.dir), output)
+
+    # Materializing may mean fetching from a remote cache, so the Builder
+    # must not hold its lock while doing it.
+    lock = builder._Builder__lock
+    locked = []
+    def materialize(config, names):
+      if lock.acquire(False):
+        lock.release()
+      else:
+        locked.extend(names)
+      return MockRunner.materialize(runner, config, names)
+    runner.materialize = materialize
+
+    builder.build(runner)
+    self.assertEqual(3, len(runner.actions))
+    self.assertEqual(["cond", "output"], runner.materialized)
+    self.assertEqual([], locked)
+
+  def testDeferredMaterialize(self):
+    # Once "cond" is rebuilt, the action reads it and then "cond2", each of
+    # which has to be materialized (without the lock) before it can be read.
+    condition_dep = Artifact("cond_dep", None)
+    condition_builder = Action(self.rule, "", "condition_builder")
+    condition = Artifact("cond", condition_builder)
+    condition_builder.command = MockCommand([condition_dep], [condition])
+
+    condition2_dep = Artifact("cond2_dep", None)
+    condition2_builder = Action(self.rule, "", "condition2_builder")
+    condition2 = Artifact("cond2", condition2_builder)
+    condition2_builder.command = MockCommand([condition2_dep], [condition2])
+
+    action = Action(self.rule, "", "action")
+    output = Artifact("output", action)
+    action.command = ChainedConditionMockCommand([condition, condition2],
+                                                 [output])
+
+    self.dir.add("cond_dep", 30, "true")
+    self.dir.add("cond", 20, "false")
+    self.dir.add("cond2_dep", 10, "")
+    self.dir.add("cond2", 20, "true")
+    builder = Builder(self.console)
+    runner = MockRunner()
+    builder.add_artifact(MockConfiguration(self.dir), output)
+    builder.build(runner)
+    self.assertEqual([condition_builder, action], runner.actions)
+    self.assertEqual(["cond", "cond2", "output"], runner.materialized)
+
+  def testCriticalPathSchedule(self):
+    input = Artifact("input", None)
+    short_action = Action(self.rule, "", "short")
+    short_output = Artifact("short_output", short_action)
+    short_action.command = MockCommand([input], [short_output])
+
+    chain = []
+    previous = input
+    for i in range(3):
+      action = Action(self.rule, "", "chain%d" % i)
+      output = Artifact("chain_output%d" % i, action)
+      action.command = MockCommand([previous], [output])
+      chain.append(action)
+      previous = output
+
+    self.dir.add("input", 20, "")
+
+    # Locality order builds things in the order they were requested.
+    self.assertEqual([short_action] + chain,
+                     self.doBuild(short_output, previous, schedule="locality"))
+
+    # The chain has more work behind it, so it goes first.
+    self.assertEqual(chain + [short_action],
+                     self.doBuild(short_output, previous))
+
+  def testRecordedTimings(self):
+    input = Artifact("input", None)
+    fast_action = Action(self.rule, "", "fast")
+    fast_output = Artifact("fast_output", fast_action)
+    fast_action.command = MockCommand([input], [fast_output])
+    slow_action = Action(self.rule, "", "slow")
+    slow_output = Artifact("slow_output", slow_action)
+    slow_action.command = MockCommand([input], [slow_output])
+
+    self.dir.add("input", 20, "")
+
+    database = KeyValueStore()
+    timings = ActionTimings(database)
+    self.assertEqual(ActionTimings.DEFAULT_ESTIMATE,
+                     timings.estimate(slow_action))
+
+    # With equal estimates, requested order is the tiebreaker.
+    self.assertEqual([fast_action, slow_action],
+                     self.doBuild(fast_output, slow_output, timings=timings))
+
+    timings.record(fast_action, 1.0)
+    timings.record(slow_action, 9.0)
+
+    # Unknown actions are assumed to take the average time.
+    self.assertEqual(5.0, timings.estimate(Action(self.rule, "", "unknown")))
+    # A new timing replaces the old one in the average.
+    timings.record(slow_action, 3.0)
+    self.assertEqual(2.0, timings.estimate(Action(self.rule, "", "unknown")))
+    timings.record(slow_action, 9.0)
+
+    self.assertEqual([slow_action, fast_action],
+                     self.doBuild(fast_output, slow_output, timings=timings))
+
+    # Timings are kept in the database.
+    estimate = timings.estimate(slow_action)
+    timings = ActionTimings(database)
+    self.assertEqual(estimate, timings.estimate(slow_action))
+    timings.import_state({(self.rule.name, "", "slow"): 3.0})
+    self.assertEqual(3.0, ActionTimings(database).estimate(slow_action))
+
+  def testKeepGoing(self):
+    input = Artifact("input", None)
+    action1 = Action(self.rule, "", "action1")
+    temp1 = Artifact("temp1", action1)
+    action1.command = MockCommand([input], [temp1])
+    action2 = Action(self.rule, "", "action2")
+    temp2 = Artifact("temp2", action2)
+    action2.command = MockCommand([temp1], [temp2])
+    action3 = Action(self.rule, "", "action3")
+    output1 = Artifact("output1", action3)
+    action3.command = MockCommand([temp2], [output1])
+    action4 = Action(self.rule, "", "action4")
+    output2 = Artifact("output2", action4)
+    action4.command = MockCommand([input], [output2])
+
+    self.dir.add("input", 20, "")
+
+    def build(keep_going):
+      builder = Builder(self.console, keep_going = keep_going,
+                        schedule = "locality")
+      runner = MockRunner(failing_actions = [action1])
+      config = MockConfiguration(self.dir)
+      builder.add_artifact(config, output1)
+      builder.add_artifact(config, output2)
+      builder.build(runner)
+      self.assertTrue(builder.failed)
+      self.assertFalse(builder.print_failures())
+      # Other running actions are cancelled only if the build is stopping.
+      self.assertEqual(not keep_going, runner.cancelled)
+      return runner.actions
+
+    # Without keep-going, the build stops at the first failure.
+    self.assertEqual([action1], build(False))
+
+    # With keep-going, independent actions still run, but those which depend
+    # on the failure are skipped.
+    self.assertEqual([action1, action4], build(True))
+
+  def testKeepGoingDiscoveredFailure(self):
+    # The action only finds out that it needs the failed action's output once
+    # the condition is rebuilt, after the failure.  It must then be skipped
+    # rather than wait forever.
+    failing_action = Action(self.rule, "", "failing")
+    generated = Artifact("generated", failing_action)
+    failing_action.command = MockCommand([], [generated])
+
+    condition_dep = Artifact("cond_dep", None)
+    condition_builder = Action(self.rule, "", "condition_builder")
+    condition = Artifact("cond", condition_builder)
+    condition_builder.command = MockCommand([condition_dep], [condition])
+
+    action = Action(self.rule, "", "action")
+    output = Artifact("output", action)
+    action.command = ConditionalMockCommand(condition, [], [generated],
+                                            [output])
+
+    self.dir.add("cond_dep", 30, "true")
+    self.dir.add("cond", 20, "false")
+
+    builder = Builder(self.console, keep_going = True, schedule = "locality")
+    runner = MockRunner(failing_actions = [failing_action])
+    config = MockConfiguration(self.dir)
+    builder.add_artifact(config, generated)
+    builder.add_artifact(config, output)
+    builder.build(runner)
+    self.assertTrue(builder.failed)
+    self.assertEqual([failing_action, condition_builder], runner.actions)
+
+  def testMaxLoad(self):
+    input = Artifact("input", None)
+    self.dir.add("input", 20, "")
+
+    outputs = []
+    for i in range(6):
+      action = Action(self.rule, "", "action%d" % i)
+      outputs.append(Artifact("output%d" % i, action))
+      action.command = MockCommand([input], [outputs[-1]])
+
+    builder = Builder(self.console, max_load = 4)
+    runner = LoadRunner(load_drops_after = 2)
+    config = MockConfiguration(self.dir)
+    for output in outputs:
+      builder.add_artifact(config, output)
+
+    old_getloadavg = os.getloadavg
+    old_interval = Builder.LOAD_CHECK_INTERVAL
+    os.getloadavg = runner.getloadavg
+    Builder.LOAD_CHECK_INTERVAL = 0.01
+    try:
+      threads = [threading.Thread(target = builder.build, args = [runner])
+                 for i in range(4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    finally:
+      os.getloadavg = old_getloadavg
+      Builder.LOAD_CHECK_INTERVAL = old_interval
+
+    self.assertFalse(builder.failed)
+    self.assertEqual(6, runner.finished)
+    # While the machine was busy, only one action ran at a time -- but one
+    # always could.
+    self.assertEqual(1, runner.max_running_loaded)
+    # Once the load dropped, the other threads joined in.
+    self.assertTrue(runner.max_running_unloaded > 1)
+
+  def testPools(self):
+    input = Artifact("input", None)
+    self.dir.add("input", 20, "")
+
+    outputs = []
+    for i in range(3):
+      action = Action(self.rule, "link", "link%d" % i, pool = "link")
+      outputs.append(Artifact("linked%d" % i, action))
+      action.command = MockCommand([input], [outputs[-1]])
+    for i in range(2):
+      action = Action(self.rule, "compile", "compile%d" % i)
+      outputs.append(Artifact("compiled%d" % i, action))
+      action.command = MockCommand([input], [outputs[-1]])
+
+    builder = Builder(self.console, pools = {"link": 1})
+    runner = ConcurrencyRunner()
+    config = MockConfiguration(self.dir)
+    for output in outputs:
+      builder.add_artifact(config, output)
+
+    threads = [threading.Thread(target = builder.build, args = [runner])
+               for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertFalse(builder.failed)
+    self.assertEqual(1, runner.max_running["link"])
+    # Other work still ran alongside the links.
+    self.assertEqual(2, runner.max_running[None])
+
+  def testEventLoop(self):
+    input = Artifact("input", None)
+    action1 = Action(self.rule, "")
+    temp = Artifact("temp", action1)
+    action1.command = MockCommand([input], [temp])
+    action2 = Action(self.rule, "")
+    output = Artifact("output", action2)
+    action2.command = MockCommand([temp], [output])
+    action3 = Action(self.rule, "")
+    other = Artifact("other", action3)
+    action3.command = MockCommand([input], [other])
+
+    self.dir.add("input", 20, "")
+
+    builder = Builder(self.console)
+    runner = MockRunner(failing_actions = [action3])
+    config = MockConfiguration(self.dir)
+    builder.add_artifact(config, output)
+    builder.add_artifact(config, other)
+    event_loop = EventLoop()
+    try:
+      builder.build_event_loop(runner, event_loop, 4)
+    finally:
+      event_loop.close()
+
+    self.assertTrue(builder.failed)
+    self.assertTrue(action3 in runner.actions)
+
+    runner = MockRunner()
+    builder = Builder(self.console)
+    builder.add_artifact(config, output)
+    event_loop = EventLoop()
+    try:
+      builder.build_event_loop(runner, event_loop, 4)
+    finally:
+      event_loop.close()
+
+    self.assertFalse(builder.failed)
+    self.assertEqual([action1, action2], runner.actions)
+
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,321 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+A content-addressed store of action outputs, so that an action whose inputs
+match some earlier run can have its outputs restored instead of re-running.
+
+The store is a directory containing:
+  actions/XX/KEY:   A pickled dict mapping each output's name to the digest of
+                    its contents, for the action whose key (as computed by
+                    CachingRunner) is KEY.
+  blobs/XX/DIGEST:  File contents, named by digest.
+where XX is the first two characters of the name.  Keys and digests are
+written in hex.
+
+Outputs are restored by hard-linking the blob into place, or copying it if
+that fails (e.g. across filesystems).  Since a hard link shares its contents
+with the blob, a command must never write to an output in place while it is
+still linked; CachingRunner unlinks such outputs before running anything.
+
+Action entries are touched whenever they are used.  When the store outgrows
+its size limit, close() removes the least-recently-used entries along with any
+blobs which nothing refers to anymore.
+"""
+
+import binascii
+import cPickle
+import errno
+import os
+import shutil
+import tempfile
+
+from sebs.digest import DigestCache
+from sebs.helpers import typecheck
+
+def _makedirs(path):
+  try:
+    os.makedirs(path)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+
+def _remove(path):
+  try:
+    os.remove(path)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+def link_or_copy(source, path):
+  """Replaces the file at |path| with a hard link to |source|, or a copy if
+  linking fails (e.g. across filesystems).  The replacement is atomic."""
+
+  # rename() does nothing at all if both names already refer to the same file,
+  # which would strand our temporary link.
+  if os.path.exists(path) and os.path.samefile(source, path):
+    return
+
+  dir = os.path.dirname(path) or "."
+  _makedirs(dir)
+  # Put the temporary file next to the destination so that the rename can't
+  # cross filesystems.
+  fd, temp_path = tempfile.mkstemp(dir = dir, prefix = ".sebs_cas_")
+  os.close(fd)
+  try:
+    os.remove(temp_path)
+    try:
+      os.link(source, temp_path)
+    except OSError:
+      shutil.copy2(source, temp_path)
+    os.rename(temp_path, path)
+  except:
+    _remove(temp_path)
+    raise
+
+class ContentStore(object):
+  """A content-addressed store in the given directory.  Thread-safe, and may be
+  shared by several SEBS processes at once:  everything is written to a
+  temporary file first and then renamed into place."""
+
+  # Default size limit, in bytes.
+  DEFAULT_MAX_SIZE = 1 << 30
+
+  def __init__(self, path, digest_cache, max_size = DEFAULT_MAX_SIZE):
+    typecheck(path, basestring)
+    typecheck(digest_cache, DigestCache)
+    typecheck(max_size, (int, long))
+
+    self.__path = path
+    self.__digest_cache = digest_cache
+    self.__max_size = max_size
+    self.__temp_dir = os.path.join(path, "temp")
+    _makedirs(self.__temp_dir)
+
+  def close(self):
+    """Evicts old entries if the store is over its size limit."""
+    self.__evict()
+
+  # ------------------------------------------------------------------
+  # Actions
+
+  def get_action(self, key):
+    """Returns the dict of output names to digests recorded for the given
+    action key, or None if there is none or any of its blobs are missing."""
+
+    typecheck(key, str)
+
+    path = self.__action_path(key)
+    try:
+      file = open(path, "rb")
+      try:
+        outputs = cPickle.load(file)
+      finally:
+        file.close()
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+      return None
+
+    for digest in outputs.values():
+      if not self.has_blob(digest):
+        return None
+
+    # Mark the entry as recently used.
+    try:
+      os.utime(path, None)
+    except OSError:
+      pass
+    return outputs
+
+  def put_action(self, key, outputs):
+    """Records the outputs (a dict of names to digests, as returned by
+    put_file() or put_content()) of the action with the given key."""
+
+    typecheck(key, str)
+    typecheck(outputs, dict)
+
+    temp_path = self.__temp_path()
+    file = open(temp_path, "wb")
+    try:
+      cPickle.dump(outputs, file, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      file.close()
+    self.__rename_into_place(temp_path, self.__action_path(key))
+
+  # ------------------------------------------------------------------
+  # Blobs
+
+  def put_file(self, path):
+    """Adds the file's contents to the store, if not already present, and
+    returns their digest.  Hard-links the file into the store if possible."""
+
+    typecheck(path, basestring)
+
+    digest = binascii.hexlify(self.__digest_cache.digest(path))
+    blob_path = self.__blob_path(digest)
+    if not os.path.exists(blob_path):
+      temp_path = self.__temp_path()
+      self.__link_or_copy(path, temp_path)
+      self.__rename_into_place(temp_path, blob_path)
+    return digest
+
+  def put_content(self, content):
+    """Like put_file(), but for a string."""
+
+    typecheck(content, str)
+
+    hasher = self.__digest_cache.new_hasher()
+    hasher.update(content)
+    digest = binascii.hexlify(hasher.digest())
+    blob_path = self.__blob_path(digest)
+    if not os.path.exists(blob_path):
+      temp_path = self.__temp_path()
+      file = open(temp_path, "wb")
+      try:
+        file.write(content)
+      finally:
+        file.close()
+      self.__rename_into_place(temp_path, blob_path)
+    return digest
+
+  def has_blob(self, digest):
+    """Returns true if the given blob is in the store."""
+
+    return os.path.exists(self.__blob_path(digest))
+
+  def read(self, digest):
+    """Returns the contents of the given blob."""
+
+    file = open(self.__blob_path(digest), "rb")
+    try:
+      return file.read()
+    finally:
+      file.close()
+
+  def materialize(self, digest, path):
+    """Replaces the file at |path| with the given blob, hard-linking it if
+    possible."""
+
+    link_or_copy(self.__blob_path(digest), path)
+
+  # ------------------------------------------------------------------
+
+  def __action_path(self, key):
+    name = binascii.hexlify(key)
+    return os.path.join(self.__path, "actions", name[:2], name)
+
+  def __blob_path(self, digest):
+    return os.path.join(self.__path, "blobs", digest[:2], digest)
+
+  def __temp_path(self):
+    fd, path = tempfile.mkstemp(dir = self.__temp_dir)
+    os.close(fd)
+    return path
+
+  def __link_or_copy(self, source, dest):
+    _remove(dest)
+    try:
+      os.link(source, dest)
+    except OSError:
+      shutil.copy2(source, dest)
+
+  def __rename_into_place(self, temp_path, path):
+    try:
+      _makedirs(os.path.dirname(path))
+      os.rename(temp_path, path)
+    except:
+      _remove(temp_path)
+      raise
+
+  def __evict(self):
+    # Sizes of all blobs, by digest.
+    blob_sizes = {}
+    for digest, path in self.__list("blobs"):
+      try:
+        blob_sizes[digest] = os.path.getsize(path)
+      except OSError:
+        pass
+
+    # (mtime, path, size, outputs) for each action entry.
+    actions = []
+    for name, path in self.__list("actions"):
+      try:
+        stat = os.stat(path)
+        file = open(path, "rb")
+        try:
+          outputs = cPickle.load(file)
+        finally:
+          file.close()
+      except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        _remove(path)
+        continue
+      actions.append((stat.st_mtime, path, stat.st_size, outputs))
+
+    references = {}
+    for mtime, path, size, outputs in actions:
+      for digest in outputs.values():
+        references[digest] = references.get(digest, 0) + 1
+
+    total = sum(blob_sizes.values()) + \
+            sum([size for mtime, path, size, outputs in actions])
+
+    # Blobs which no action refers to are garbage (e.g. left over from an
+    # interrupted put_action()).  They go first, but only when we need space,
+    # since another process may be about to refer to them.
+    if total <= self.__max_size:
+      return
+    for digest, size in blob_sizes.items():
+      if digest not in references:
+        _remove(self.__blob_path(digest))
+        total = total - size
+
+    actions.sort()
+    for mtime, path, size, outputs in actions:
+      if total <= self.__max_size:
+        break
+      _remove(path)
+      total = total - size
+      for digest in outputs.values():
+        references[digest] = references[digest] - 1
+        if references[digest] == 0 and digest in blob_sizes:
+          _remove(self.__blob_path(digest))
+          total = total - blob_sizes[digest]
+
+  def __list(self, kind):
+    """Yields (name, path) for each file under the given subdirectory."""
+
+    top = os.path.join(self.__path, kind)
+    if not os.path.isdir(top):
+      return
+    for prefix in os.listdir(top):
+      dir = os.path.join(top, prefix)
+      for name in os.listdir(dir):
+        yield (name, os.path.join(dir, name))
@@ -0,0 +1,139 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from sebs.cas import ContentStore, link_or_copy
+from sebs.digest import DigestCache
+
+class ContentStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.store_dir = os.path.join(self.tempdir, "store")
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def write(self, name, content):
+    path = os.path.join(self.tempdir, name)
+    file = open(path, "wb")
+    file.write(content)
+    file.close()
+    return path
+
+  def read(self, path):
+    file = open(path, "rb")
+    result = file.read()
+    file.close()
+    return result
+
+  def testBlobs(self):
+    store = ContentStore(self.store_dir, DigestCache())
+    path = self.write("foo", "foo content")
+    digest = store.put_file(path)
+    self.assertEqual(digest, store.put_content("foo content"))
+    self.assertEqual("foo content", store.read(digest))
+
+    # Restoring replaces whatever was there, using a hard link.
+    self.write("bar", "old content")
+    bar = os.path.join(self.tempdir, "bar")
+    store.materialize(digest, bar)
+    self.assertEqual("foo content", self.read(bar))
+    self.assertTrue(os.stat(bar).st_nlink > 1)
+
+    # Directories are created as needed.
+    baz = os.path.join(self.tempdir, "sub", "baz")
+    store.materialize(store.put_content("baz content"), baz)
+    self.assertEqual("baz content", self.read(baz))
+
+  def testActions(self):
+    store = ContentStore(self.store_dir, DigestCache())
+    self.assertEqual(None, store.get_action("key"))
+
+    outputs = { "foo": store.put_content("foo"),
+                "bar": store.put_content("bar") }
+    store.put_action("key", outputs)
+    self.assertEqual(outputs, store.get_action("key"))
+
+    # Shared with other stores in the same directory.
+    self.assertEqual(outputs,
+        ContentStore(self.store_dir, DigestCache()).get_action("key"))
+
+    # An entry whose blobs are gone is useless.
+    store.put_action("key2", { "foo": "0123456789abcdef" })
+    self.assertEqual(None, store.get_action("key2"))
+
+  def testEviction(self):
+    store = ContentStore(self.store_dir, DigestCache(), max_size = 2500)
+    store.put_action("old", { "a": store.put_content("a" * 1000),
+                              "shared": store.put_content("s" * 1000) })
+    store.put_action("new", { "b": store.put_content("b" * 1000),
+                              "shared": store.put_content("s" * 1000) })
+    store.put_content("garbage" * 100)
+
+    # Make "old" the least recently used, even though it was used last.
+    store.get_action("old")
+    past = time.time() - 100
+    os.utime(os.path.join(self.store_dir, "actions", "6f", "6f6c64"),
+             (past, past))
+
+    store.close()
+    self.assertEqual(None, store.get_action("old"))
+    self.assertNotEqual(None, store.get_action("new"))
+    self.assertEqual("s" * 1000, store.read(store.get_action("new")["shared"]))
+
+    # Nothing is evicted while under the limit.
+    store = ContentStore(self.store_dir, DigestCache(), max_size = 1 << 20)
+    store.put_action("old", { "a": store.put_content("a" * 1000) })
+    store.close()
+    self.assertNotEqual(None, store.get_action("old"))
+    self.assertNotEqual(None, store.get_action("new"))
+
+  def testLinkOrCopy(self):
+    source = self.write("source", "content")
+    dest = os.path.join(self.tempdir, "sub", "dest")
+    link_or_copy(source, dest)
+    self.assertEqual("content", self.read(dest))
+    self.assertEqual(2, os.stat(source).st_nlink)
+
+    # Linking again is harmless and leaves no temporary files behind.
+    link_or_copy(source, dest)
+    self.assertEqual(2, os.stat(source).st_nlink)
+    self.assertEqual(["dest"], os.listdir(os.path.dirname(dest)))
+
+if __name__ == "__main__":
+  unittest.main()
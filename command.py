@@ -34,6 +34,7 @@ Commands define exactly what an Action does.
 """
 
 import cStringIO
+import hashlib
 import os
 import pipes
 import shutil
@@ -41,7 +42,10 @@ import subprocess
 
 from sebs.core import Artifact, Action, DefinitionError, ContentToken, \
                       CommandBase, Context
+from sebs.depfile import parse_depfile
+from sebs.eventloop import SubprocessRequest, run_synchronously
 from sebs.helpers import typecheck
+from sebs.includes import parse_includes
 
 class CommandContext(object):
   def get_disk_path(self, artifact, use_temporary=True):
@@ -76,6 +80,23 @@ class CommandContext(object):
     corresponding parameters, or None otherwise."""
     raise NotImplementedError
 
+  def subprocess_async(self, args, **kwargs):
+    """For use by Command.run_async():  returns a SubprocessRequest which
+    run_async() should yield in order to run the subprocess.  The generator
+    will be resumed with the same triplet that subprocess() returns.  The
+    parameters are the same as subprocess()'s."""
+    return SubprocessRequest(self, args, kwargs)
+
+  def worker_request(self, args, inputs, env=None, cwd=None):
+    """Runs the tool args[0] as a persistent worker (see workers.py), handing
+    it args[1:] and the list of on-disk input paths.  Returns a pair:
+    (exit_code, output), where output combines stdout and stderr.  The
+    default implementation just runs args as an ordinary subprocess."""
+    exit_code, stdout, stderr = self.subprocess(
+        args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+        env = env, cwd = cwd)
+    return (exit_code, stdout)
+
   def message(self, text):
     """Provides a message to be printed to the console reporting the result
     of this action."""
@@ -117,6 +138,43 @@ class ArtifactEnumerator(object):
     need to be recompiled."""
     raise NotImplementedError
 
+  def read_previous_dependencies(self, artifact):
+    """Like read_previous_output(), but the artifact is a Makefile-style
+    dependency file (such as GCC's -MD writes), and the list of files it says
+    its targets depend on is returned instead of its text.  Implementations
+    may avoid re-parsing files which haven't changed.  The default
+    implementation parses the result of read_previous_output()."""
+
+    text = self.read_previous_output(artifact)
+    if text is None:
+      return None
+    return parse_depfile(text)
+
+  def scan_includes(self, file):
+    """Returns the operands of the #include directives in |file|, as
+    returned by includes.parse_includes().  |file| is either an Artifact,
+    which is then an input as with read() and gives None if it isn't
+    up-to-date, or the name of a source file in the same form as an
+    Artifact's filename (e.g. "src/foo/bar.h"), which gives None if no such
+    file exists.  Implementations may avoid re-scanning files which haven't
+    changed.  The default implementation scans the result of read(), or
+    reads source files relative to the working directory."""
+
+    if isinstance(file, Artifact):
+      text = self.read(file)
+    else:
+      try:
+        f = open(file, "rU")
+        try:
+          text = f.read()
+        finally:
+          f.close()
+      except IOError:
+        text = None
+    if text is None:
+      return None
+    return parse_includes(text)
+
 class ScriptWriter(object):
   def add_command(self, text):
     """Add a command which should be executed as part of the current action."""
@@ -206,8 +264,23 @@ class Command(CommandBase):
   def run(self, context, log):
     """Run the command.  Returns True if the command succeeded or False if some
     error occurred -- error details should already have been written to |log|,
-    which is a file-like object."""
-    raise NotImplementedError
+    which is a file-like object.
+
+    Commands must override either this or run_async().  The default
+    implementation runs run_async() to completion."""
+    return run_synchronously(self.run_async(context, log))
+
+  def run_async(self, context, log):
+    """Like run(), but written as a generator so that an EventLoop can run many
+    commands at once from one thread (see the eventloop module).  To run a
+    subprocess, yield context.subprocess_async(...).  To run a sub-command,
+    yield its run_async().  The last value yielded is the result.
+
+    The default implementation simply calls run(), which is fine for commands
+    that never wait on subprocesses."""
+    if self.run.im_func is Command.run.im_func:
+      raise NotImplementedError
+    yield self.run(context, log)
 
   def print_(self, output):
     """Print a human-readable representation of what the command does.  The
@@ -382,12 +455,13 @@ class DoAllCommand(Command):
     for command in self.__subcommands:
       command.enumerate_artifacts(artifact_enumerator)
 
-  def run(self, context, log):
+  def run_async(self, context, log):
     typecheck(context, CommandContext)
     for command in self.__subcommands:
-      if not command.run(context, log):
-        return False
-    return True
+      if not (yield command.run_async(context, log)):
+        yield False
+        return
+    yield True
 
   def print_(self, output):
     for command in self.__subcommands:
@@ -428,20 +502,22 @@ class ConditionalCommand(Command):
     elif value == "false" and self.__false_command is not None:
       self.__false_command.enumerate_artifacts(artifact_enumerator)
 
-  def run(self, context, log):
+  def run_async(self, context, log):
     typecheck(context, CommandContext)
     value = context.read(self.__condition_artifact)
     if value == "true":
-      return self.__true_command.run(context, log)
+      result = yield self.__true_command.run_async(context, log)
+      yield result
     elif value == "false":
       if self.__false_command is not None:
-        return self.__false_command.run(context, log)
+        result = yield self.__false_command.run_async(context, log)
+        yield result
       else:
-        return True
+        yield True
     else:
       log.write("Condition artifact was not true or false: %s\n" %
                 self.__condition_artifact)
-      return False
+      yield False
 
   def print_(self, output):
     output.write("if %s {\n" % self.__condition_artifact.filename)
@@ -507,7 +583,8 @@ class SubprocessCommand(Command):
 
   def __init__(self, action, args, implicit = [],
                capture_stdout=None, capture_stderr=None,
-               capture_exit_status=None, working_dir=None):
+               capture_exit_status=None, working_dir=None,
+               persistent_worker=False):
     typecheck(action, Action)
     typecheck(args, list)
     typecheck(implicit, list, Artifact)
@@ -515,9 +592,19 @@ class SubprocessCommand(Command):
     typecheck(capture_stderr, Artifact)
     typecheck(capture_exit_status, Artifact)
     typecheck(working_dir, basestring)
+    typecheck(persistent_worker, bool)
 
     self.__verify_args(args)
 
+    if persistent_worker:
+      if capture_stdout is not None or capture_stderr is not None or \
+         capture_exit_status is not None:
+        raise DefinitionError(
+            "Persistent workers cannot capture stdout, stderr, or exit status.")
+      if len(args) == 0 or not isinstance(args[0], (basestring, Artifact)):
+        raise DefinitionError(
+            "Persistent worker commands must start with the tool to run.")
+
     self.__args = args
     self.__implicit_artifacts = implicit
     self.__action = action
@@ -525,6 +612,9 @@ class SubprocessCommand(Command):
     self.__capture_stderr = capture_stderr
     self.__capture_exit_status = capture_exit_status
     self.__working_dir = working_dir
+    self.__persistent_worker = persistent_worker
+    # Computed by __artifacts() the first time it's needed.
+    self.__artifact_set = None
 
   def enumerate_artifacts(self, artifact_enumerator):
     if self.__capture_stdout is not None:
@@ -537,10 +627,24 @@ class SubprocessCommand(Command):
     # All other inputs and outputs are listed in the arguments, or in
     # __implicit_artifacts.  We can identify outputs as the artifacts which are
     # generated by the action which runs this command.  The rest are inputs.
+    for artifact in self.__artifacts():
+      if self.__action is not None and artifact.action is self.__action:
+        artifact_enumerator.add_output(artifact)
+      else:
+        artifact_enumerator.add_input(artifact)
+
+  def __artifacts(self):
+    """Returns the set of artifacts mentioned in the arguments, plus the
+    implicit artifacts.  This doesn't depend on any file contents, so it is
+    only computed once; enumerate_artifacts() is called often."""
+
+    if self.__artifact_set is not None:
+      return self.__artifact_set
+
     class DummyContext(CommandContext):
       def __init__(self):
         self.artifacts = set()
-      def get_disk_path(self, artifact):
+      def get_disk_path(self, artifact, use_temporary=True):
         self.artifacts.add(artifact)
         return ""
       def get_disk_directory_path(self, dirname):
@@ -555,14 +659,10 @@ class SubprocessCommand(Command):
       # We must actually iterate through the results because __format_args()
       # is a generator function.
       pass
+    self.__artifact_set = context.artifacts
+    return self.__artifact_set
 
-    for artifact in context.artifacts:
-      if self.__action is not None and artifact.action is self.__action:
-        artifact_enumerator.add_output(artifact)
-      else:
-        artifact_enumerator.add_input(artifact)
-
-  def run(self, context, log):
+  def run_async(self, context, log):
     formatted_args = list(self.__format_args(self.__args, context))
 
     # Capture stdout/stderr if requested.
@@ -605,10 +705,30 @@ class SubprocessCommand(Command):
       cwd = os.path.join(os.getcwd(),
                          context.get_disk_directory_path(self.__working_dir))
 
+    if self.__persistent_worker:
+      inputs = []
+      for artifact in self.__artifacts():
+        if artifact.action is not self.__action:
+          disk_path = context.get_disk_path(artifact, use_temporary = False)
+          if disk_path is not None:
+            inputs.append(disk_path)
+      inputs.sort()
+
+      exit_code, output = context.worker_request(formatted_args, inputs,
+                                                 env = env, cwd = cwd)
+      log.write(output)
+      if exit_code == 0:
+        yield True
+      else:
+        log.write("Command failed with exit code %d: %s\n" %
+            (exit_code, " ".join(formatted_args)))
+        yield False
+      return
+
     exit_code, stdout_text, stderr_text = \
-        context.subprocess(formatted_args,
-                           stdout = stdout, stderr = stderr,
-                           env = env, cwd = cwd)
+        yield context.subprocess_async(formatted_args,
+                                       stdout = stdout, stderr = stderr,
+                                       env = env, cwd = cwd)
 
     if stdout == subprocess.PIPE:
       if self.__capture_stdout is None:
@@ -626,14 +746,14 @@ class SubprocessCommand(Command):
         context.write(self.__capture_exit_status, "true")
       else:
         context.write(self.__capture_exit_status, "false")
-      return True
+      yield True
     else:
       if exit_code == 0:
-        return True
+        yield True
       else:
         log.write("Command failed with exit code %d: %s\n" %
             (exit_code, " ".join(formatted_args)))
-        return False
+        yield False
 
   def print_(self, output):
     if self.__working_dir is not None:
@@ -818,31 +938,47 @@ class SubprocessCommand(Command):
 class DepFileCommand(Command):
   """A Command which produces a dependency list as part of its execution, e.g.
   as GCC does when given the -MD command-line flag.  Wraps some other command
-  that does the actual work."""
+  that does the actual work.
 
-  def __init__(self, real_command, dep_artifact):
+  If |toolchain| is given, it is the output of a ToolchainCommand for the
+  compiler.  Dependencies in the toolchain's system include directories are
+  then left out of the inputs, and the toolchain artifact stands in for all
+  of them."""
+
+  def __init__(self, real_command, dep_artifact, toolchain=None):
     typecheck(real_command, Command)
     typecheck(dep_artifact, Artifact)
+    typecheck(toolchain, Artifact)
     self.__command = real_command
     self.__dep_artifact = dep_artifact
+    self.__toolchain = toolchain
 
   def enumerate_artifacts(self, artifact_enumerator):
     self.__command.enumerate_artifacts(artifact_enumerator)
 
-    dep_text = artifact_enumerator.read_previous_output(self.__dep_artifact)
-    if dep_text is not None:
-      # Parse text that looks like:
-      #   foo.o: foo.h bar.h \
-      #     baz.h qux.h
-      dep_text = dep_text.replace("\\\n", " ")  # remove escaped newlines
-      parts = dep_text.split()
-      for part in parts:
-        # Skip tokens like "foo.o:".  The rest are files.
-        if not part.endswith(":"):
-          artifact_enumerator.add_disk_input(part)
-
-  def run(self, context, log):
-    return self.__command.run(context, log)
+    system_dirs = ()
+    if self.__toolchain is not None:
+      artifact_enumerator.add_input(self.__toolchain)
+      toolchain = artifact_enumerator.read(self.__toolchain)
+      if toolchain is None:
+        # We'll be called again once the toolchain has been fingerprinted, and
+        # until then we're dirty anyway.
+        return
+      system_dirs = tuple([os.path.join(dir, "")
+                           for dir in _system_include_dirs(toolchain)])
+
+    dependencies = artifact_enumerator.read_previous_dependencies(
+        self.__dep_artifact)
+    if dependencies is not None:
+      for dependency in dependencies:
+        if len(system_dirs) > 0 and os.path.isabs(dependency) and \
+           os.path.normpath(dependency).startswith(system_dirs):
+          continue
+        artifact_enumerator.add_disk_input(dependency)
+
+  def run_async(self, context, log):
+    result = yield self.__command.run_async(context, log)
+    yield result
 
   def print_(self, output):
     self.__command.print_(output)
@@ -850,6 +986,9 @@ class DepFileCommand(Command):
   def hash(self, hasher):
     hasher.update("DepFileCommand:")
     self.__command.hash(hasher)
+    if self.__toolchain is not None:
+      hasher.update("t")
+      _hash_string_and_length(self.__toolchain.filename, hasher)
 
   def write_script(self, script_writer):
     # TODO(kenton):  Maybe generate the depfile at the time the script is
@@ -861,6 +1000,356 @@ class DepFileCommand(Command):
 
 # ====================================================================
 
+class IncludeScanCommand(Command):
+  """Wraps a command which compiles the C/C++ source |source| and needs some
+  of the generated headers |headers|.  Rather than making every such header
+  an input, scans the source's #include directives, transitively, and adds
+  only the headers it reaches.  Includes are resolved like the preprocessor
+  does:  "quoted" names relative to the including file's directory and then
+  |include_dirs|, <bracketed> names in |include_dirs| only.  |include_dirs|
+  are virtual directory names, e.g. "src" and "tmp".
+
+  The scan ignores conditional compilation, so it may find headers that
+  aren't really used, but it won't miss any unless an include directive
+  names a macro, in which case all of |headers| are added.  If
+  |dep_artifact| is given, it is the depfile which the compile writes, and
+  any of |headers| listed there by the previous compile are added too, to
+  cover includes found through directories the scan doesn't know about.
+
+  Before there is such a depfile, the scan can't see headers which are only
+  reachable through include directories added by the compiler flags.  So if
+  |flags| (an artifact containing the flags) adds any (-I, -iquote, -isystem
+  or -idirafter), all of |headers| are added until the first compile has
+  written its depfile.  Headers reachable only that way which aren't among
+  |headers| are never found."""
+
+  def __init__(self, real_command, source, headers, include_dirs,
+               dep_artifact=None, flags=None):
+    typecheck(real_command, Command)
+    typecheck(source, Artifact)
+    typecheck(headers, list, Artifact)
+    typecheck(include_dirs, list, basestring)
+    typecheck(dep_artifact, Artifact)
+    typecheck(flags, Artifact)
+    self.__command = real_command
+    self.__source = source
+    self.__headers = headers
+    self.__include_dirs = include_dirs
+    self.__dep_artifact = dep_artifact
+    self.__flags = flags
+    self.__headers_by_name = dict([(os.path.normpath(header.filename), header)
+                                   for header in headers])
+
+  def enumerate_artifacts(self, artifact_enumerator):
+    self.__command.enumerate_artifacts(artifact_enumerator)
+
+    used = set()
+    dependencies = None
+    if self.__dep_artifact is not None:
+      dependencies = artifact_enumerator.read_previous_dependencies(
+          self.__dep_artifact)
+      if dependencies is not None:
+        for dependency in dependencies:
+          header = self.__headers_by_name.get(os.path.normpath(dependency))
+          if header is not None:
+            used.add(header)
+
+    if dependencies is None and self.__flags is not None:
+      # If the flags aren't known yet, we'll be called again once they are.
+      flags = artifact_enumerator.read(self.__flags)
+      if flags is not None and _adds_include_dirs(flags.split()):
+        used = set(self.__headers)
+
+    if not self.__scan(artifact_enumerator, used):
+      used = set(self.__headers)
+
+    for header in self.__headers:
+      if header in used:
+        artifact_enumerator.add_input(header)
+
+  def __scan(self, artifact_enumerator, used):
+    """Adds to |used| the headers reachable from the source.  Returns false
+    if the scan found an include it can't follow."""
+
+    includes = artifact_enumerator.scan_includes(self.__source)
+    if includes is None:
+      # The source isn't built yet.  We'll be called again once it is.
+      return True
+
+    # Files found so far, by name, so that each is only scanned once.
+    visited = set([os.path.normpath(self.__source.filename)])
+    pending = [(self.__source.filename, includes)]
+    while len(pending) > 0:
+      filename, includes = pending.pop()
+      for include in includes:
+        if include.startswith('"'):
+          dirs = [os.path.dirname(filename)] + self.__include_dirs
+        elif include.startswith("<"):
+          dirs = self.__include_dirs
+        else:
+          return False
+
+        for dir in dirs:
+          path = os.path.normpath(os.path.join(dir, include[1:-1]))
+          if path in visited:
+            break
+          header = self.__headers_by_name.get(path)
+          if header is None:
+            sub_includes = artifact_enumerator.scan_includes(path)
+            if sub_includes is None:
+              # Not in this directory.  System headers aren't found anywhere,
+              # which is fine since they can't reach generated headers.
+              continue
+          else:
+            used.add(header)
+            # None if the header isn't built yet; we'll be called again once
+            # it is.
+            sub_includes = artifact_enumerator.scan_includes(header)
+          visited.add(path)
+          if sub_includes is not None:
+            pending.append((path, sub_includes))
+          break
+
+    return True
+
+  def run_async(self, context, log):
+    result = yield self.__command.run_async(context, log)
+    yield result
+
+  def print_(self, output):
+    self.__command.print_(output)
+
+  def hash(self, hasher):
+    hasher.update("IncludeScanCommand:")
+    self.__command.hash(hasher)
+    _hash_string_and_length(self.__source.filename, hasher)
+    if self.__flags is not None:
+      hasher.update("f")
+      _hash_string_and_length(self.__flags.filename, hasher)
+    hasher.update(str(len(self.__headers)))
+    hasher.update(" ")
+    for header in self.__headers:
+      _hash_string_and_length(header.filename, hasher)
+    hasher.update(str(len(self.__include_dirs)))
+    hasher.update(" ")
+    for dir in self.__include_dirs:
+      _hash_string_and_length(dir, hasher)
+    if self.__dep_artifact is not None:
+      hasher.update("d")
+      _hash_string_and_length(self.__dep_artifact.filename, hasher)
+
+  def write_script(self, script_writer):
+    self.__command.write_script(script_writer)
+
+# ====================================================================
+
+def _find_program(name):
+  """Returns the absolute path of the program which running |name| would
+  execute, resolving symlinks, or None if it can't be found."""
+
+  if os.sep in name:
+    candidates = [name]
+  else:
+    candidates = [os.path.join(dir, name)
+                  for dir in os.environ.get("PATH", "").split(os.pathsep)]
+  for candidate in candidates:
+    if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+      return os.path.realpath(candidate)
+  return None
+
+def _file_digest(path):
+  """Returns the MD5 digest of the file's contents."""
+
+  hasher = hashlib.md5()
+  file = open(path, "rb")
+  try:
+    while True:
+      chunk = file.read(65536)
+      if chunk == "":
+        break
+      hasher.update(chunk)
+  finally:
+    file.close()
+  return hasher.digest()
+
+# Compiler flags which change the system include search list, mapped to
+# whether they may take their value as the next argument.
+_SEARCH_FLAGS = {
+  "--sysroot": True,
+  "-isysroot": True,
+  "-isystem": True,
+  "-idirafter": True,
+  "-nostdinc": False,
+  "-nostdinc++": False,
+}
+
+def _search_flags(flags):
+  """Given a list of compiler flags, returns those which change the system
+  include search list, with their values."""
+
+  result = []
+  i = 0
+  while i < len(flags):
+    flag = flags[i]
+    if flag in _SEARCH_FLAGS:
+      result.append(flag)
+      if _SEARCH_FLAGS[flag] and i + 1 < len(flags):
+        i = i + 1
+        result.append(flags[i])
+    else:
+      for name, takes_value in _SEARCH_FLAGS.items():
+        # E.g. "-isystemfoo" or "--sysroot=foo".
+        if takes_value and flag.startswith(name):
+          result.append(flag)
+          break
+    i = i + 1
+  return result
+
+def _adds_include_dirs(flags):
+  """Returns true if any of the given compiler flags adds an include
+  directory."""
+
+  for flag in flags:
+    for name in ["-I", "-iquote", "-isystem", "-idirafter"]:
+      if flag.startswith(name):
+        return True
+  return False
+
+def _parse_search_list(text):
+  """Given the output of a GCC-style compiler run with -v, returns the
+  directories it searches for #include <...>, normalized."""
+
+  result = []
+  in_list = False
+  for line in text.splitlines():
+    if line.startswith("#include <...> search starts here:"):
+      in_list = True
+    elif line.startswith("End of search list."):
+      break
+    elif in_list and line.startswith(" "):
+      dir = line.strip()
+      # Clang on OSX marks some entries.
+      if dir.endswith(" (framework directory)"):
+        dir = dir[:-len(" (framework directory)")]
+      result.append(os.path.normpath(dir))
+  return result
+
+def _system_include_dirs(toolchain):
+  """Given the contents of a ToolchainCommand's output, returns the system
+  include directories it lists."""
+
+  return toolchain.split("\n")[1:]
+
+class ToolchainCommand(Command):
+  """Command which fingerprints a compiler:  the contents of the program that
+  the compiler command runs (for GCC and Clang, the driver), the version and
+  configuration details the compiler prints when given -v, and the
+  directories it searches for system headers.  The first line of the output
+  is a digest of all that; the rest list the system include directories.
+  Give the output to DepFileCommand so that compiles depend on this one
+  artifact rather than on every system header.
+
+  If |flags| is given, it is an artifact containing the flags passed to
+  compiles.  Those which change the system header search (--sysroot,
+  -isystem, -nostdinc, etc.) are passed to the compiler when probing it, so
+  the search list matches what compiles use.
+
+  The system headers themselves are not tracked, so changes to them which
+  don't come with a new compiler driver go unnoticed.  Nor are the programs
+  which the driver runs in turn (such as cc1plus), except as far as their
+  paths and versions show up in the -v output."""
+
+  def __init__(self, compiler, output_artifact, language="c++", flags=None):
+    typecheck(compiler, Artifact)
+    typecheck(output_artifact, Artifact)
+    typecheck(language, str)
+    typecheck(flags, Artifact)
+    self.__compiler = compiler
+    self.__output_artifact = output_artifact
+    self.__language = language
+    self.__flags = flags
+
+  def enumerate_artifacts(self, artifact_enumerator):
+    typecheck(artifact_enumerator, ArtifactEnumerator)
+
+    artifact_enumerator.add_input(self.__compiler)
+    if self.__flags is not None:
+      artifact_enumerator.add_input(self.__flags)
+    artifact_enumerator.add_output(self.__output_artifact)
+
+    compiler = artifact_enumerator.read(self.__compiler)
+    if compiler is not None and len(compiler.split()) > 0:
+      binary = _find_program(compiler.split()[0])
+      if binary is not None:
+        artifact_enumerator.add_disk_input(binary)
+
+  def run_async(self, context, log):
+    typecheck(context, CommandContext)
+
+    compiler = context.read(self.__compiler).split()
+    if len(compiler) == 0:
+      log.write("No compiler specified.\n")
+      yield False
+      return
+
+    flags = []
+    if self.__flags is not None:
+      flags = _search_flags(context.read(self.__flags).split())
+
+    args = compiler + flags + ["-v", "-E", "-x", self.__language,
+                               "/dev/null", "-o", "/dev/null"]
+    env = os.environ.copy()
+    # The search list headings are translated in other locales.
+    env["LC_ALL"] = "C"
+    exit_code, output, dummy = \
+        yield context.subprocess_async(args, stdout = subprocess.PIPE,
+                                       stderr = subprocess.STDOUT, env = env)
+    if exit_code != 0:
+      log.write(output)
+      log.write("Command failed with exit code %d: %s\n" %
+          (exit_code, " ".join(args)))
+      yield False
+      return
+
+    hasher = hashlib.md5()
+    binary = _find_program(compiler[0])
+    if binary is None:
+      _hash_string_and_length(compiler[0], hasher)
+    else:
+      # The binary is also a disk input, so a new compiler installed at the
+      # same path reruns us, and if it differs so does the fingerprint.
+      _hash_string_and_length(binary, hasher)
+      hasher.update(_file_digest(binary))
+    _hash_string_and_length(output, hasher)
+    context.write(self.__output_artifact,
+        "\n".join([hasher.hexdigest()] + _parse_search_list(output)))
+    yield True
+
+  def print_(self, output):
+    if self.__flags is None:
+      flags = ""
+    else:
+      flags = " $(%s)" % self.__flags.filename
+    output.write("$(%s)%s -v -E -x %s /dev/null 2>&1 | fingerprint > %s\n" %
+        (self.__compiler.filename, flags, self.__language,
+         self.__output_artifact.filename))
+
+  def hash(self, hasher):
+    hasher.update("ToolchainCommand:")
+    _hash_string_and_length(self.__compiler.filename, hasher)
+    _hash_string_and_length(self.__output_artifact.filename, hasher)
+    _hash_string_and_length(self.__language, hasher)
+    if self.__flags is not None:
+      _hash_string_and_length(self.__flags.filename, hasher)
+
+  def write_script(self, script_writer):
+    # Scripts always build everything, so they have no use for the
+    # fingerprint.
+    script_writer.add_command(
+        script_writer.echo_expression("''", self.__output_artifact))
+
+# ====================================================================
+
 class MirrorCommand(Command):
   """A Command which sets up a directory to contain mirrors of a set of files.
   It may use symbolic links, hard links, or copies depending on what the OS
@@ -31,13 +31,18 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import cStringIO
+import os
+import shutil
 import subprocess
+import tempfile
 import unittest
 
 from sebs.core import Artifact, Action, DefinitionError, ContentToken, Context
 from sebs.command import CommandContext, ArtifactEnumerator, Command, \
                          EchoCommand, EnvironmentCommand, DoAllCommand, \
-                         ConditionalCommand, SubprocessCommand
+                         ConditionalCommand, SubprocessCommand, \
+                         DepFileCommand, IncludeScanCommand, \
+                         ToolchainCommand
 from sebs.filesystem import VirtualDirectory
 
 def _print_command(command):
@@ -593,5 +598,243 @@ class SubprocessCommandTest(unittest.TestCase):
     self.assertTrue(command.run(context, cStringIO.StringIO()))
     self.assertEquals("false", self.__dir.read("filename"))
 
+  def testPersistentWorker(self):
+    input = Artifact("input", None)
+    output = Artifact("output", self.__action)
+    command = SubprocessCommand(self.__action, ["tool", input, "-o", output],
+                                implicit = [self.__artifact],
+                                persistent_worker = True)
+    self.assertEquals("tool input -o output\n", _print_command(command))
+
+    self.assertRaises(DefinitionError, SubprocessCommand, self.__action,
+                      ["tool"], capture_stdout = self.__artifact,
+                      persistent_worker = True)
+    self.assertRaises(DefinitionError, SubprocessCommand, self.__action,
+                      [["tool"]], persistent_worker = True)
+
+    # Without a worker pool, the command runs as an ordinary subprocess.
+    context = MockCommandContext(self.__dir, diskpath_prefix = "disk/")
+    context.subprocess_result = (0, "some output", None)
+    log = cStringIO.StringIO()
+    self.assertTrue(command.run(context, log))
+    self.assertEquals(["tool", "disk/input", "-o", "disk/output"],
+                      context.subprocess_args)
+    self.assertTrue(context.subprocess_kwargs["stderr"] is subprocess.STDOUT)
+    self.assertEquals("some output", log.getvalue())
+
+    class WorkerContext(MockCommandContext):
+      def worker_request(self, args, inputs, env=None, cwd=None):
+        self.worker_args = args
+        self.worker_inputs = inputs
+        return (1, "worker output\n")
+
+    context = WorkerContext(self.__dir, diskpath_prefix = "disk/")
+    log = cStringIO.StringIO()
+    self.assertFalse(command.run(context, log))
+    self.assertEquals(["tool", "disk/input", "-o", "disk/output"],
+                      context.worker_args)
+    self.assertEquals(["disk/filename", "disk/input"], context.worker_inputs)
+    self.assertEquals("worker output\n"
+        "Command failed with exit code 1: tool disk/input -o disk/output\n",
+        log.getvalue())
+    self.assertTrue(context.subprocess_args is None)
+
+class ToolchainCommandTest(unittest.TestCase):
+  def setUp(self):
+    self.__action = Action(None, "dummy", "dummy")
+    self.__dir = VirtualDirectory()
+    self.__tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.__tempdir)
+
+  def __write_compiler(self, content):
+    path = os.path.join(self.__tempdir, "c++")
+    file = open(path, "wb")
+    file.write(content)
+    file.close()
+    os.chmod(path, 0755)
+    return path
+
+  def testToolchainCommand(self):
+    compiler = Artifact("cxx", None)
+    output = Artifact("toolchain", self.__action)
+    command = ToolchainCommand(compiler, output)
+    binary = self.__write_compiler("compiler 1")
+    self.__dir.write("cxx", binary + " -m32")
+
+    probe_output = ("gcc version 4.3.3\n"
+        "#include \"...\" search starts here:\n"
+        "#include <...> search starts here:\n"
+        " /usr/lib/gcc/4.3.3/../../../include/c++/4.3\n"
+        " /usr/include\n"
+        "End of search list.\n")
+    context = MockCommandContext(self.__dir)
+    context.subprocess_result = (0, probe_output, None)
+    self.assertTrue(command.run(context, cStringIO.StringIO()))
+    self.assertEquals([binary, "-m32", "-v", "-E", "-x", "c++", "/dev/null",
+                       "-o", "/dev/null"], context.subprocess_args)
+    lines = self.__dir.read("toolchain").split("\n")
+    self.assertEquals(["/usr/include/c++/4.3", "/usr/include"], lines[1:])
+
+    # A different compiler version gets a different fingerprint.
+    context = MockCommandContext(self.__dir)
+    context.subprocess_result = (0, "gcc version 4.4.0\n", None)
+    self.assertTrue(command.run(context, cStringIO.StringIO()))
+    new_lines = self.__dir.read("toolchain").split("\n")
+    self.assertEquals(1, len(new_lines))
+    self.assertNotEquals(lines[0], new_lines[0])
+
+    # So does a different binary, even if it reports the same version.
+    self.__write_compiler("compiler 2")
+    context = MockCommandContext(self.__dir)
+    context.subprocess_result = (0, probe_output, None)
+    self.assertTrue(command.run(context, cStringIO.StringIO()))
+    new_lines = self.__dir.read("toolchain").split("\n")
+    self.assertEquals(lines[1:], new_lines[1:])
+    self.assertNotEquals(lines[0], new_lines[0])
+
+    context = MockCommandContext(self.__dir)
+    context.subprocess_result = (1, "no such compiler\n", None)
+    log = cStringIO.StringIO()
+    self.assertFalse(command.run(context, log))
+    self.assertTrue(log.getvalue().startswith("no such compiler\n"))
+
+  def testSearchFlags(self):
+    compiler = Artifact("cxx", None)
+    flags = Artifact("cxxflags", None)
+    output = Artifact("toolchain", self.__action)
+    command = ToolchainCommand(compiler, output, flags = flags)
+    self.__dir.write("cxx", "c++")
+    self.__dir.write("cxxflags",
+        "-O2 --sysroot=/sys -isystem inc -isystemfoo -Wall -nostdinc++ "
+        "-I bar -idirafter after")
+
+    enumerator = MockArtifactEnumerator({})
+    command.enumerate_artifacts(enumerator)
+    self.assertEquals([compiler, flags], enumerator.inputs)
+
+    # Only flags affecting the system include search are passed along.
+    context = MockCommandContext(self.__dir)
+    self.assertTrue(command.run(context, cStringIO.StringIO()))
+    self.assertEquals(["c++", "--sysroot=/sys", "-isystem", "inc",
+                       "-isystemfoo", "-nostdinc++", "-idirafter", "after",
+                       "-v", "-E", "-x", "c++", "/dev/null",
+                       "-o", "/dev/null"], context.subprocess_args)
+
+  def testDepFileCommand(self):
+    class DepFileEnumerator(MockArtifactEnumerator):
+      def __init__(self, readable_artifacts):
+        MockArtifactEnumerator.__init__(self, readable_artifacts)
+        self.disk_inputs = []
+      def add_disk_input(self, filename):
+        self.disk_inputs.append(filename)
+      def read_previous_dependencies(self, artifact):
+        return ["foo.cc", "/usr/include/stdio.h",
+                "/usr/lib/../include/string.h", "/usr/include2/foo.h"]
+
+    dep = Artifact("foo.d", self.__action)
+    toolchain = Artifact("toolchain", None)
+    command = DepFileCommand(MockCommand("foo"), dep, toolchain = toolchain)
+
+    enumerator = DepFileEnumerator({toolchain: "0123\n/usr/include"})
+    command.enumerate_artifacts(enumerator)
+    self.assertEquals([toolchain], enumerator.inputs)
+    self.assertEquals(["foo.cc", "/usr/include2/foo.h"], enumerator.disk_inputs)
+
+    # Until the toolchain is known, the dependencies can't be filtered.
+    enumerator = DepFileEnumerator({})
+    command.enumerate_artifacts(enumerator)
+    self.assertEquals([toolchain], enumerator.inputs)
+    self.assertEquals([], enumerator.disk_inputs)
+
+    command = DepFileCommand(MockCommand("foo"), dep)
+    enumerator = DepFileEnumerator({})
+    command.enumerate_artifacts(enumerator)
+    self.assertEquals(4, len(enumerator.disk_inputs))
+
+class IncludeScanCommandTest(unittest.TestCase):
+  class Enumerator(MockArtifactEnumerator):
+    def __init__(self, readable_artifacts, sources, dependencies = None):
+      MockArtifactEnumerator.__init__(self, readable_artifacts)
+      self.sources = sources
+      self.dependencies = dependencies
+    def read_previous_dependencies(self, artifact):
+      return self.dependencies
+    def scan_includes(self, file):
+      if isinstance(file, Artifact):
+        return MockArtifactEnumerator.scan_includes(self, file)
+      elif file in self.sources:
+        return self.sources[file]
+      else:
+        return None
+
+  def setUp(self):
+    action = Action(None, "dummy", "dummy")
+    self.__source = Artifact("src/foo/foo.cc", None)
+    self.__dep = Artifact("tmp/foo/foo.d", action)
+    self.__bar = Artifact("tmp/bar/bar.pb.h", action)
+    self.__baz = Artifact("tmp/baz.pb.h", action)
+    self.__qux = Artifact("tmp/bar/qux.pb.h", action)
+    self.__unused = Artifact("tmp/unused.pb.h", action)
+    self.__command = IncludeScanCommand(
+        MockCommand("foo"), self.__source,
+        [self.__bar, self.__baz, self.__qux, self.__unused],
+        ["src", "tmp"], dep_artifact = self.__dep)
+
+  def testScan(self):
+    enumerator = self.Enumerator(
+        { self.__source: '#include "foo.pb.h"\n'
+                         '#include <bar/bar.pb.h>\n'
+                         '#include "util.h"\n'
+                         '#include <vector>\n',
+          # qux.pb.h is in the same directory.
+          self.__bar: '#include "qux.pb.h"\n',
+          self.__qux: '#include "bar/bar.pb.h"\n' },
+        { "src/foo/util.h": ['"baz.pb.h"'] })
+    self.__command.enumerate_artifacts(enumerator)
+    self.assertEquals([self.__bar, self.__baz, self.__qux], enumerator.inputs)
+
+    # The depfile catches anything the scan missed.
+    enumerator = self.Enumerator({ self.__source: "" }, {},
+                                 ["src/foo/foo.cc", "tmp/unused.pb.h"])
+    self.__command.enumerate_artifacts(enumerator)
+    self.assertEquals([self.__unused], enumerator.inputs)
+
+  def testComputedInclude(self):
+    enumerator = self.Enumerator(
+        { self.__source: '#include "util.h"\n' },
+        { "src/foo/util.h": ["HEADER_NAME"] })
+    self.__command.enumerate_artifacts(enumerator)
+    self.assertEquals([self.__bar, self.__baz, self.__qux, self.__unused],
+                      enumerator.inputs)
+
+  def testFlagsAddIncludeDirs(self):
+    flags = Artifact("cxxflags", None)
+    command = IncludeScanCommand(
+        MockCommand("foo"), self.__source, [self.__bar, self.__unused],
+        ["src", "tmp"], dep_artifact = self.__dep, flags = flags)
+    source = '#include "bar.pb.h"\n'
+
+    # Without a depfile, "bar.pb.h" might be found through -I, so everything
+    # is an input.
+    enumerator = self.Enumerator(
+        { self.__source: source, flags: "-O2 -Itmp/bar" }, {})
+    command.enumerate_artifacts(enumerator)
+    self.assertEquals([self.__bar, self.__unused], enumerator.inputs)
+    self.assertTrue(flags in enumerator.reads)
+
+    # Once there's a depfile, it says what was found.
+    enumerator = self.Enumerator(
+        { self.__source: source, flags: "-O2 -Itmp/bar" }, {},
+        ["src/foo/foo.cc", "tmp/bar/bar.pb.h"])
+    command.enumerate_artifacts(enumerator)
+    self.assertEquals([self.__bar], enumerator.inputs)
+
+    # Flags which don't add include directories don't matter.
+    enumerator = self.Enumerator({ self.__source: source, flags: "-O2" }, {})
+    command.enumerate_artifacts(enumerator)
+    self.assertEquals([], enumerator.inputs)
+
 if __name__ == "__main__":
   unittest.main()
@@ -62,8 +62,10 @@ import cPickle
 import os
 import shutil
 
-from sebs.filesystem import DiskDirectory, VirtualDirectory, MappedDirectory
+from sebs.filesystem import DiskDirectory, VirtualDirectory, MappedDirectory, \
+                            StatCache
 from sebs.helpers import typecheck
+from sebs.kvstore import KeyValueStore
 
 class _WorkingDirMapping(MappedDirectory.Mapping):
   """Sometimes we want to put all build output (including intermediates) in
@@ -130,23 +132,13 @@ class _WorkingDirMapping(MappedDirectory.Mapping):
         # Value has changed.  Update.
         self.__env_dir.write(filename, value)
 
-def _restore_pickle(obj, dir, filename):
-  if dir is not None:
-    filename = dir.get_disk_path(filename)
-  if os.path.exists(filename):
-    db = open(filename, "rb")
-    obj.restore(cPickle.load(db))
-    db.close()
-
-def _save_pickle(obj, dir, filename):
-  if dir is not None:
-    filename = dir.get_disk_path(filename)
-  db = open(filename, "wb")
-  cPickle.dump(obj.save(), db, cPickle.HIGHEST_PROTOCOL)
-  db.close()
-
 class Configuration(object):
-  def __init__(self, output_path, all_configs = None):
+  def __init__(self, output_path, all_configs = None, stat_cache = None):
+    """If |stat_cache| is given, it is shared by this and all linked configs'
+    disk directories, and is available as self.stat_cache."""
+
+    typecheck(stat_cache, StatCache)
+
     # We want to make sure to construct only one copy of each config, even
     # if configs refer to each other or multiple configs refer to a shared
     # config.  So, all_configs maps names to configs that we have already
@@ -170,16 +162,19 @@ class Configuration(object):
       all_configs[output_path] = self
 
     self.name = output_path
-    self.source_dir = DiskDirectory(".")
+    self.stat_cache = stat_cache
+    self.source_dir = DiskDirectory(".", stat_cache)
     if output_path is None:
       self.output_dir = self.source_dir
     else:
       self.source_dir.mkdir(output_path)
-      self.output_dir = DiskDirectory(output_path)
-    self.mem_dir = VirtualDirectory()
-    self.env_dir = VirtualDirectory()
-    _restore_pickle(self.mem_dir, self.output_dir, "mem.pickle")
-    _restore_pickle(self.env_dir, self.output_dir, "env.pickle")
+      self.output_dir = DiskDirectory(output_path, stat_cache)
+    # The "mem" and "env" directories live in config.db, and are written
+    # through as they change.
+    self.database = KeyValueStore(self.output_dir.get_disk_path("config.db"))
+    self.__make_virtual_dirs()
+    self.__import_pickle(self.mem_dir, "mem.pickle")
+    self.__import_pickle(self.env_dir, "env.pickle")
     self.alt_configs = {}
     self.__make_root_dir()
 
@@ -196,7 +191,8 @@ class Configuration(object):
         else:
           if name == "":
             name = None
-          self.alt_configs[alias] = Configuration(name, all_configs)
+          self.alt_configs[alias] = Configuration(name, all_configs,
+                                                  stat_cache)
 
   def __make_root_dir(self):
     self.mapping = _WorkingDirMapping(self.source_dir, self.output_dir,
@@ -204,11 +200,34 @@ class Configuration(object):
                                       self.alt_configs)
     self.root_dir = MappedDirectory(self.mapping)
 
-  def save(self):
-    if not self.mem_dir.empty():
-      _save_pickle(self.mem_dir, self.root_dir, "mem.pickle")
-    if not self.env_dir.empty():
-      _save_pickle(self.env_dir, self.root_dir, "env.pickle")
+  def __make_virtual_dirs(self):
+    self.mem_dir = VirtualDirectory(self.database.table("mem"),
+                                    self.database.table("mem dirs"))
+    self.env_dir = VirtualDirectory(self.database.table("env"),
+                                    self.database.table("env dirs"))
+
+  def __import_pickle(self, dir, filename):
+    """Moves the contents of a pickle written by older versions of SEBS into
+    the database."""
+
+    filename = self.output_dir.get_disk_path(filename)
+    if os.path.exists(filename):
+      file = open(filename, "rb")
+      try:
+        files = cPickle.load(file)
+      finally:
+        file.close()
+      for name, (mtime, content) in files.items():
+        dir.write(name, content, mtime)
+      os.remove(filename)
+
+  def __clear_virtual_dirs(self):
+    for name in ["mem", "mem dirs", "env", "env dirs"]:
+      self.database.table(name).clear()
+
+  def close(self):
+    """Closes config.db.  Everything has already been saved."""
+    self.database.close()
 
   def getenv(self, name):
     if self.root_dir.read("env/set/" + name) == "true":
@@ -221,13 +240,13 @@ class Configuration(object):
       if self.root_dir.exists(dir):
         shutil.rmtree(self.root_dir.get_disk_path(dir))
 
-    for file in [ "mem.pickle", "env.pickle" ]:
-      if self.root_dir.exists(file):
-        os.remove(self.root_dir.get_disk_path(file))
-
-    self.mem_dir = VirtualDirectory()
-
     if expunge:
+      self.database.close()
+      for suffix in ["", "-wal", "-shm"]:
+        filename = self.output_dir.get_disk_path("config.db" + suffix)
+        if os.path.exists(filename):
+          os.remove(filename)
+
       # Try to remove the output directory itself -- will fail if not empty.
       outdir = self.root_dir.get_disk_path(".")
       if outdir.endswith("/."):
@@ -238,22 +257,25 @@ class Configuration(object):
       except os.error:
         pass
     else:
-      # Restore the parts of env.pickle that were set explicitly.
-      new_env_dir = VirtualDirectory()
+      # Keep the parts of the environment that were set explicitly.
+      kept_env_dir = VirtualDirectory()
 
       if self.env_dir.exists("$mappings"):
-        new_env_dir.write("$mappings", self.env_dir.read("$mappings"))
+        kept_env_dir.write("$mappings", self.env_dir.read("$mappings"))
       if self.env_dir.exists("$config"):
         locked_vars = self.env_dir.read("$config")
-        new_env_dir.write("$config", locked_vars)
+        kept_env_dir.write("$config", locked_vars)
 
         for var in locked_vars.split(","):
           if var != "":
-            new_env_dir.write(var, self.env_dir.read(var))
-            new_env_dir.write("set/" + var,
+            kept_env_dir.write(var, self.env_dir.read(var))
+            kept_env_dir.write("set/" + var,
               self.env_dir.read("set/" + var))
 
-      self.env_dir = new_env_dir
+      self.__clear_virtual_dirs()
+      self.__make_virtual_dirs()
+      for name, (mtime, content) in kept_env_dir.save().items():
+        self.env_dir.write(name, content, mtime)
 
     self.__make_root_dir()
 
@@ -33,6 +33,8 @@
 Implements fancy console output.
 """
 
+import threading
+
 from helpers import typecheck
 
 class ColoredText(object):
@@ -105,19 +107,27 @@ class _SerialConsole(Console):
   def __init__(self, out):
     self.__out = out
     self.__pending = []
+    # Actions run on many threads at once.  Formatting happens outside the
+    # lock; only the write itself is serialized.
+    self.__lock = threading.Lock()
 
   def write(self, text):
-    self.__out.write("> " + _add_newline(self.__format_text(text)))
-    self.__out.flush()
+    self.__write("> " + _add_newline(self.__format_text(text)))
 
   def add_pending(self, text):
-    self.__out.write("+ " + _add_newline(self.__format_text(text)))
-    self.__out.flush()
+    self.__write("+ " + _add_newline(self.__format_text(text)))
     return _SerialPendingMessage(self, text)
 
   def _finish_pending(self, pending_message, final_text):
-    self.__out.write(_add_newline(self.__format_text(final_text)))
-    self.__out.flush()
+    self.__write(_add_newline(self.__format_text(final_text)))
+
+  def __write(self, text):
+    self.__lock.acquire()
+    try:
+      self.__out.write(text)
+      self.__out.flush()
+    finally:
+      self.__lock.release()
 
   def __format_text(self, text):
     if isinstance(text, basestring):
@@ -201,28 +211,48 @@ class _AnsiConsole(Console):
     self.__out = out
     self.__pending = []
     self.pending_lines = 0
+    # Actions run on many threads at once.  Since every update redraws the
+    # pending lines at the bottom of the screen, the whole redraw must be
+    # serialized.
+    self.__lock = threading.Lock()
 
   def write(self, text):
-    self.__clear_pending()
-    self.__format_text(self.__out, text)
-    self.__write_pending()
+    self.__lock.acquire()
+    try:
+      self.__clear_pending()
+      self.__format_text(self.__out, text)
+      self.__write_pending()
+    finally:
+      self.__lock.release()
 
   def add_pending(self, text):
-    self.__clear_pending()
-    result = _AnsiPendingMessage(self, text)
-    self.__pending.append(result)
-    self.__write_pending()
-    return result
+    self.__lock.acquire()
+    try:
+      self.__clear_pending()
+      result = _AnsiPendingMessage(self, text)
+      self.__pending.append(result)
+      self.__write_pending()
+      return result
+    finally:
+      self.__lock.release()
 
   def _update_pending(self, pending_message):
-    self.__clear_pending()
-    self.__write_pending()
+    self.__lock.acquire()
+    try:
+      self.__clear_pending()
+      self.__write_pending()
+    finally:
+      self.__lock.release()
 
   def _finish_pending(self, pending_message, final_text):
-    self.__clear_pending()
-    self.__pending.remove(pending_message)
-    self.__format_text(self.__out, final_text)
-    self.__write_pending()
+    self.__lock.acquire()
+    try:
+      self.__clear_pending()
+      self.__pending.remove(pending_message)
+      self.__format_text(self.__out, final_text)
+      self.__write_pending()
+    finally:
+      self.__lock.release()
 
   def __clear_pending(self):
     if self.pending_lines > 0:
@@ -180,16 +180,29 @@ class Action(object):
     command    A Command to execute in order to build the outputs from
                the inputs.  Must be set using set_command(), since when a new
                Action is constructed its output Artifacts don't exist yet, and
-               the command probably depends on the output Artifacts."""
-
-  def __init__(self, rule, verb = "build", name = None):
+               the command probably depends on the output Artifacts.
+    pool       Name of the resource pool this action draws from, or None.
+               Pools let the user cap how many expensive actions (e.g. links,
+               which use lots of RAM) run at once, independently of -j.
+    weight     How much of the pool's capacity this action uses while it
+               runs."""
+
+  def __init__(self, rule, verb = "build", name = None, pool = None,
+               weight = 1):
     typecheck(rule, Rule)
     typecheck(verb, basestring)
     typecheck(name, basestring)
+    typecheck(pool, basestring)
+    typecheck(weight, int)
+
+    if weight < 1:
+      raise DefinitionError("Action weight must be positive: %d" % weight)
 
     self.rule = rule
     self.verb = verb
     self.__name = name
+    self.pool = pool
+    self.weight = weight
     self.command = None
 
   def __get_name(self):
@@ -101,13 +101,11 @@ rm foo.h
 touch src/sebs/cpp_test/foo.h
 expect_success "$SEBS build sebs/cpp_test/cpp_test.sebs:prog"
 
-# Note:  Several of these might be prefixed with "no changes:".
+# Note:  Several of these might be prefixed with "no changes:".  If the
+# objects come out the same, the links are skipped entirely.
 expect_contains output.txt 'compile: src/sebs/cpp_test/main.cc$'
 expect_contains output.txt 'compile: src/sebs/cpp_test/bar.cc$'
-expect_contains output.txt 'link: sebs/cpp_test/cpp_test.sebs:bar$'
 expect_contains output.txt 'compile: src/sebs/cpp_test/foo.cc$'
-expect_contains output.txt 'link: sebs/cpp_test/cpp_test.sebs:foo$'
-expect_contains output.txt 'link: sebs/cpp_test/cpp_test.sebs:prog$'
 
 echo "Running test binary..."
 
@@ -0,0 +1,192 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Parses Makefile-style dependency files, such as GCC writes when given -MD,
+and remembers the results between builds.
+
+A large C++ tree has tens of thousands of depfiles listing a few hundred
+headers each, mostly the same headers.  Rather than re-reading and splitting
+all of them every build, DepFileCache keeps each one's parsed contents keyed
+by the file's stat identity, so an unchanged depfile costs a single lookup.
+Paths are stored as indexes into one shared table of every path seen, packed
+into an array, so each distinct header name is stored only once.
+"""
+
+import array
+import os
+import threading
+import time
+
+from sebs.filesystem import StatCache
+from sebs.helpers import typecheck
+from sebs.kvstore import KeyValueStore
+
+def parse_depfile(text):
+  """Returns the list of files which the dependency file |text| says its
+  targets depend on."""
+
+  # Parse text that looks like:
+  #   foo.o: foo.h bar.h \
+  #     baz.h qux.h
+  text = text.replace("\\\n", " ")  # remove escaped newlines
+  # Skip tokens like "foo.o:".  The rest are files.
+  return [part for part in text.split() if not part.endswith(":")]
+
+def _identity(stat):
+  return (stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime)
+
+class DepFileCache(object):
+  """Reads dependency files, parsing each only when it has changed.
+  Thread-safe.  If |database| (a KeyValueStore) is given, results are kept in
+  it across builds; otherwise they only last as long as this object.  Files
+  are stat'ed through |stat_cache| if given."""
+
+  # A file modified less than this many seconds ago may change again without
+  # its identity changing; see DigestCache.RACY_INTERVAL.
+  RACY_INTERVAL = 2.0
+
+  # Names of the tables in which results are kept.  Subclasses which parse
+  # other kinds of files use their own.
+  _ENTRIES_TABLE = "depfiles"
+  _PATHS_TABLE = "depfile paths"
+
+  def __init__(self, database = None, stat_cache = None):
+    typecheck(database, KeyValueStore)
+    typecheck(stat_cache, StatCache)
+
+    if database is None:
+      database = KeyValueStore()
+    # Maps depfile paths to (identity, packed path IDs).
+    self.__entries = database.table(self._ENTRIES_TABLE)
+    # Maps path IDs to paths.  Read in full the first time we need it.
+    self.__path_table = database.table(self._PATHS_TABLE)
+    self.__stat_cache = stat_cache
+    # Guards everything below.
+    self.__lock = threading.Lock()
+    # The contents of __path_table as a list, and the reverse mapping, or None
+    # if not loaded yet.
+    self.__paths = None
+    self.__ids = None
+
+  def read(self, path):
+    """Returns the list of dependencies in the depfile at |path|, or None if
+    it doesn't exist."""
+
+    typecheck(path, basestring)
+
+    try:
+      if self.__stat_cache is None:
+        stat = os.stat(path)
+      else:
+        stat = self.__stat_cache.stat(path)
+    except OSError:
+      return None
+    identity = _identity(stat)
+
+    entry = self.__entries.get(path)
+    if entry is not None and entry[0] == identity:
+      dependencies = self.__decode(entry[1])
+      if dependencies is not None:
+        return dependencies
+
+    try:
+      file = open(path, "rU")
+      try:
+        dependencies = self._parse(file.read())
+      finally:
+        file.close()
+    except IOError:
+      return None
+
+    # Like DigestCache, don't remember files that might change again without
+    # us noticing.
+    if max(stat.st_mtime, stat.st_ctime) < \
+       time.time() - DepFileCache.RACY_INTERVAL:
+      self.__entries[path] = (identity, self.__encode(dependencies))
+    elif entry is not None:
+      self.__entries.pop(path)
+    return dependencies
+
+  def _parse(self, text):
+    """Parses the contents of a file.  Subclasses may override this to cache
+    other lists of strings extracted from files."""
+    return parse_depfile(text)
+
+  def __load(self):
+    # Call with __lock held.
+    if self.__paths is None:
+      items = self.__path_table.items()
+      self.__paths = [None] * (max([id for id, path in items] + [-1]) + 1)
+      for id, path in items:
+        self.__paths[id] = path
+      self.__ids = dict([(path, id) for id, path in items])
+
+  def __encode(self, dependencies):
+    new_paths = []
+    self.__lock.acquire()
+    try:
+      self.__load()
+      ids = array.array("I")
+      for dependency in dependencies:
+        id = self.__ids.get(dependency)
+        if id is None:
+          id = len(self.__paths)
+          self.__paths.append(dependency)
+          self.__ids[dependency] = id
+          new_paths.append((id, dependency))
+        ids.append(id)
+      if len(new_paths) > 0:
+        self.__path_table.update(new_paths)
+    finally:
+      self.__lock.release()
+    return ids.tostring()
+
+  def __decode(self, packed):
+    """Returns the paths with the given packed IDs, or None if some of them
+    are missing from the path table."""
+
+    ids = array.array("I")
+    ids.fromstring(packed)
+    self.__lock.acquire()
+    try:
+      self.__load()
+      paths = self.__paths
+    finally:
+      self.__lock.release()
+    try:
+      result = [paths[id] for id in ids]
+    except IndexError:
+      return None
+    if None in result:
+      return None
+    return result
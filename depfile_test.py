@@ -0,0 +1,103 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sebs.depfile import DepFileCache, parse_depfile
+from sebs.kvstore import KeyValueStore
+
+class DepFileCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, "foo.d")
+    self.old_racy_interval = DepFileCache.RACY_INTERVAL
+
+  def tearDown(self):
+    DepFileCache.RACY_INTERVAL = self.old_racy_interval
+    shutil.rmtree(self.tempdir)
+
+  def write(self, content, path = None):
+    if path is None:
+      path = self.path
+    file = open(path, "wb")
+    file.write(content)
+    file.close()
+
+  def testParse(self):
+    self.assertEqual(["foo.cc", "foo.h", "bar.h", "baz.h"],
+                     parse_depfile("foo.o: foo.cc foo.h \\\n  bar.h\\\n baz.h\n"))
+
+  def testRead(self):
+    cache = DepFileCache()
+    self.assertEqual(None, cache.read(self.path))
+    self.write("foo.o: foo.h bar.h\n")
+    self.assertEqual(["foo.h", "bar.h"], cache.read(self.path))
+
+  def testPersisted(self):
+    DepFileCache.RACY_INTERVAL = 0
+    database = KeyValueStore(os.path.join(self.tempdir, "cache.db"))
+    other_path = os.path.join(self.tempdir, "bar.d")
+    self.write("foo.o: foo.h common.h\n")
+    self.write("bar.o: bar.h common.h\n", other_path)
+    cache = DepFileCache(database)
+    self.assertEqual(["foo.h", "common.h"], cache.read(self.path))
+    self.assertEqual(["bar.h", "common.h"], cache.read(other_path))
+    # common.h is only stored once.
+    self.assertEqual(3, len(database.table("depfile paths")))
+    database.close()
+
+    # As long as the file's identity doesn't change, it isn't read again.
+    database = KeyValueStore(os.path.join(self.tempdir, "cache.db"))
+    entries = database.table("depfiles")
+    identity, packed = entries[self.path]
+    entries[self.path] = (identity, entries[other_path][1])
+    cache = DepFileCache(database)
+    self.assertEqual(["bar.h", "common.h"], cache.read(self.path))
+
+    # Once it changes, it is.
+    self.write("foo.o: foo.h qux.h\n")
+    self.assertEqual(["foo.h", "qux.h"], cache.read(self.path))
+    database.close()
+
+  def testRacilyClean(self):
+    # The file was just written, so it must not be remembered.
+    database = KeyValueStore()
+    self.write("foo.o: foo.h\n")
+    cache = DepFileCache(database)
+    self.assertEqual(["foo.h"], cache.read(self.path))
+    self.assertEqual(0, len(database.table("depfiles")))
+
+if __name__ == "__main__":
+  unittest.main()
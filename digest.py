@@ -0,0 +1,194 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Remembers the digests of files on disk so that they needn't be re-read.
+
+A file's digest is reused as long as its stat identity -- inode, size, mtime
+and ctime -- is unchanged.  Like any mtime-based scheme this is fooled by a
+file which changes within the filesystem's timestamp granularity of when it
+was hashed (the file is "racily clean"), so we don't remember digests of files
+which were modified too recently to tell.
+
+Files which do need reading are streamed in fixed-size chunks, several at a
+time if a thread pool is available.  (hashlib and file reads release the GIL,
+so this really is parallel.)
+"""
+
+import hashlib
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from sebs.filesystem import StatCache
+from sebs.helpers import typecheck
+from sebs.kvstore import KeyValueStore
+
+def _identity(stat):
+  return (stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime)
+
+class DigestCache(object):
+  """Computes and remembers file digests.  Thread-safe.  If |database| (a
+  KeyValueStore) is given, digests are kept in it across builds; otherwise
+  they only last as long as this object.  Digests computed with a different
+  algorithm are ignored."""
+
+  # Supported digest algorithms.
+  ALGORITHMS = ["md5", "sha1", "sha256"]
+  if hasattr(hashlib, "blake2b"):
+    ALGORITHMS.append("blake2b")
+
+  # A file modified less than this many seconds before we started reading it
+  # may change again without its mtime or ctime changing.  Two seconds covers
+  # the coarsest common filesystems (FAT).
+  RACY_INTERVAL = 2.0
+
+  # How much of a file to read at once.
+  CHUNK_SIZE = 65536
+
+  def __init__(self, algorithm = "md5", threads = 1, stat_cache = None,
+               database = None):
+    """If |stat_cache| is given, files' identities are looked up through it,
+    so files must not change during its lifetime without invalidating it."""
+
+    typecheck(algorithm, str)
+    typecheck(threads, int)
+    typecheck(stat_cache, StatCache)
+    typecheck(database, KeyValueStore)
+    if algorithm not in DigestCache.ALGORITHMS:
+      raise ValueError("Unknown digest algorithm: %s" % algorithm)
+
+    if database is None:
+      database = KeyValueStore()
+    self.__algorithm = algorithm
+    self.__stat_cache = stat_cache
+    # Maps paths to (algorithm, identity, digest).
+    self.__entries = database.table("digests")
+    if threads > 1:
+      self.__pool = ThreadPool(threads)
+    else:
+      self.__pool = None
+
+  def close(self):
+    """Stops the hashing threads."""
+    if self.__pool is not None:
+      self.__pool.close()
+      self.__pool.join()
+      self.__pool = None
+
+  def import_state(self, state):
+    """Adds the digests from a digests.pickle written by older versions of
+    SEBS."""
+
+    if isinstance(state, tuple) and state[0] == self.__algorithm:
+      self.__entries.update(
+          [(path, (self.__algorithm, identity, digest))
+           for path, (identity, digest) in state[1].items()])
+
+  def new_hasher(self):
+    """Returns a new hashlib object for the configured algorithm, for hashing
+    things other than files (e.g. in-memory content, or combining several
+    digests into one)."""
+    return hashlib.new(self.__algorithm)
+
+  def digest(self, path):
+    """Returns the digest of the file's contents, reading the file only if it
+    has changed since the digest was last computed.  Raises OSError or IOError
+    if the file can't be read."""
+
+    return self.digests([path])[0]
+
+  def digests(self, paths):
+    """Like digest(), but for a list of files.  Files which must be read are
+    read in parallel."""
+
+    typecheck(paths, list, basestring)
+
+    start_time = time.time()
+    results = []
+    misses = []
+    for path in paths:
+      if self.__stat_cache is None:
+        identity = _identity(os.stat(path))
+      else:
+        identity = _identity(self.__stat_cache.stat(path))
+      entry = self.__entries.get(path)
+      if entry is not None and entry[:2] == (self.__algorithm, identity):
+        results.append(entry[2])
+      else:
+        results.append(None)
+        misses.append((len(results) - 1, path, identity))
+
+    def compute(miss):
+      index, path, identity = miss
+      return self.__compute(path, identity, start_time)
+
+    if self.__pool is not None and len(misses) > 1:
+      computed = self.__pool.map(compute, misses)
+    else:
+      computed = [compute(miss) for miss in misses]
+
+    # Remember the new digests in one transaction.
+    entries = []
+    for miss, (digest, entry) in zip(misses, computed):
+      results[miss[0]] = digest
+      if entry is not None:
+        entries.append((miss[1], entry))
+    if len(entries) > 0:
+      self.__entries.update(entries)
+    return results
+
+  def __compute(self, path, identity, start_time):
+    """Returns the file's digest, and the entry to remember for it (or None
+    if it mustn't be remembered)."""
+
+    hasher = self.new_hasher()
+    file = open(path, "rb")
+    try:
+      while True:
+        chunk = file.read(DigestCache.CHUNK_SIZE)
+        if chunk == "":
+          break
+        hasher.update(chunk)
+    finally:
+      file.close()
+    digest = hasher.digest()
+
+    # Only remember the digest if the file didn't change while we read it and
+    # we can be sure that a later change would be visible in its identity.
+    # (A stale entry left behind otherwise can't match the new identity.)
+    stat = os.stat(path)
+    if _identity(stat) == identity and \
+       max(stat.st_mtime, stat.st_ctime) < \
+           start_time - DigestCache.RACY_INTERVAL:
+      return digest, (self.__algorithm, identity, digest)
+    return digest, None
@@ -0,0 +1,156 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+import hashlib
+import md5
+import os
+import shutil
+import tempfile
+import unittest
+
+from sebs.digest import DigestCache
+from sebs.kvstore import KeyValueStore
+
+class DigestCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, "file")
+    self.old_racy_interval = DigestCache.RACY_INTERVAL
+
+  def tearDown(self):
+    DigestCache.RACY_INTERVAL = self.old_racy_interval
+    shutil.rmtree(self.tempdir)
+
+  def write(self, content, mtime = None):
+    file = open(self.path, "wb")
+    file.write(content)
+    file.close()
+    if mtime is not None:
+      os.utime(self.path, (mtime, mtime))
+
+  def testDigest(self):
+    self.write("foo")
+    cache = DigestCache()
+    self.assertEqual(md5.md5("foo").digest(), cache.digest(self.path))
+    self.assertRaises(OSError, cache.digest,
+                      os.path.join(self.tempdir, "missing"))
+
+  def testUnchangedFileNotReread(self):
+    DigestCache.RACY_INTERVAL = 0
+    self.write("foo")
+    database = KeyValueStore()
+    cache = DigestCache(database = database)
+    cache.digest(self.path)
+
+    # Replace the remembered digest.  As long as the file's identity doesn't
+    # change, the replacement is returned without reading the file.
+    entries = database.table("digests")
+    self.assertEqual([self.path], entries.keys())
+    algorithm, identity, digest = entries[self.path]
+    entries[self.path] = (algorithm, identity, "fake")
+    cache = DigestCache(database = database)
+    self.assertEqual("fake", cache.digest(self.path))
+
+    # Same size and mtime, but the ctime changes.
+    mtime = os.stat(self.path).st_mtime
+    self.write("bar", mtime)
+    self.assertEqual(md5.md5("bar").digest(), cache.digest(self.path))
+
+  def testRacilyClean(self):
+    # The file was just written, so a change within the same timestamp tick
+    # could go unnoticed.  Its digest must not be remembered.
+    self.write("foo")
+    database = KeyValueStore()
+    cache = DigestCache(database = database)
+    self.assertEqual(md5.md5("foo").digest(), cache.digest(self.path))
+    self.assertEqual(0, len(database.table("digests")))
+
+  def testAlgorithms(self):
+    self.write("foo")
+    for algorithm in DigestCache.ALGORITHMS:
+      cache = DigestCache(algorithm)
+      self.assertEqual(hashlib.new(algorithm, "foo").digest(),
+                       cache.digest(self.path))
+      hasher = cache.new_hasher()
+      hasher.update("foo")
+      self.assertEqual(hashlib.new(algorithm, "foo").digest(),
+                       hasher.digest())
+    self.assertRaises(ValueError, DigestCache, "crc32")
+
+  def testOtherAlgorithm(self):
+    DigestCache.RACY_INTERVAL = 0
+    self.write("foo")
+    database = KeyValueStore()
+    cache = DigestCache("md5", database = database)
+    cache.digest(self.path)
+
+    cache = DigestCache("sha1", database = database)
+    self.assertEqual(hashlib.sha1("foo").digest(), cache.digest(self.path))
+
+  def testImportState(self):
+    # digests.pickle held (algorithm, {path: (identity, digest)}).
+    DigestCache.RACY_INTERVAL = 0
+    self.write("foo")
+    database = KeyValueStore()
+    cache = DigestCache(database = database)
+    cache.digest(self.path)
+    identity = database.table("digests")[self.path][1]
+
+    cache = DigestCache(database = KeyValueStore())
+    cache.import_state(("sha1", {self.path: (identity, "wrong")}))
+    self.assertEqual(md5.md5("foo").digest(), cache.digest(self.path))
+    cache.import_state(("md5", {self.path: (identity, "fake")}))
+    self.assertEqual("fake", cache.digest(self.path))
+
+  def testParallel(self):
+    paths = []
+    expected = []
+    for i in range(20):
+      path = os.path.join(self.tempdir, "file%d" % i)
+      # Make some files span several chunks.
+      content = str(i) * (i * 10000)
+      file = open(path, "wb")
+      file.write(content)
+      file.close()
+      paths.append(path)
+      expected.append(md5.md5(content).digest())
+
+    cache = DigestCache(threads = 4)
+    try:
+      self.assertEqual(expected, cache.digests(paths))
+      self.assertEqual(expected[3:5], cache.digests(paths[3:5]))
+    finally:
+      cache.close()
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,419 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Support for running many actions concurrently from a single thread.
+
+Commands and ActionRunners may be written as generators (see
+Command.run_async() and ActionRunner.run_async()).  Such a generator yields:
+  * A SubprocessRequest, to run a subprocess.  The generator is resumed with
+    the (exit_code, stdout, stderr) triplet that CommandContext.subprocess()
+    would have returned.
+  * Another such generator, to run it as a sub-step.  The generator is resumed
+    with the sub-step's result.
+  * Anything else, which is the generator's final result.  The generator is
+    closed without being resumed.
+Exceptions raised by a sub-step or a subprocess are raised inside the
+generator that asked for it, exactly as if it had made a blocking call.
+
+run_synchronously() runs such a generator in the calling thread, one
+subprocess at a time.  EventLoop runs any number of them at once.
+"""
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import subprocess
+import sys
+import types
+
+from sebs.helpers import typecheck
+
+class SubprocessRequest(object):
+  """Yielded by a run_async() generator to run a subprocess.  Usually created
+  by CommandContext.subprocess_async()."""
+
+  def __init__(self, context, args, kwargs):
+    typecheck(args, list)
+    typecheck(kwargs, dict)
+    self.context = context
+    self.args = args
+    self.kwargs = kwargs
+
+  def run(self):
+    """Runs the subprocess to completion in the calling thread."""
+
+    return self.context.subprocess(self.args, **self.kwargs)
+
+  def start(self):
+    """Starts the subprocess without waiting for it.  Returns a tuple of the
+    Popen object and the string (or None) to write to its stdin."""
+
+    kwargs = dict(self.kwargs)
+    if "stdin" in kwargs and isinstance(kwargs["stdin"], str):
+      stdin_str = kwargs["stdin"]
+      kwargs["stdin"] = subprocess.PIPE
+    else:
+      stdin_str = None
+    return (subprocess.Popen(self.args, **kwargs), stdin_str)
+
+  def finish(self, proc, stdout_str, stderr_str):
+    """Called after a process started with start() has exited and its output
+    has been collected.  Returns the triplet to send back to the generator."""
+
+    return (proc.returncode, stdout_str, stderr_str)
+
+  def kill(self, proc):
+    """Called instead of finish() to kill a process started with start() which
+    is being abandoned.  The caller waits for the process afterwards."""
+
+    try:
+      os.kill(proc.pid, signal.SIGKILL)
+    except OSError:
+      pass   # Already exited.
+
+class Task(object):
+  """A generator of the kind described above, together with the stack of
+  sub-step generators it is currently running."""
+
+  def __init__(self, generator):
+    typecheck(generator, types.GeneratorType)
+    self.__stack = [generator]
+
+  def step(self, value = None, exc_info = None):
+    """Resumes the task by sending it |value|, or by raising |exc_info| (as
+    returned by sys.exc_info()) inside it, and runs it until it either asks
+    for a subprocess or finishes.  Returns (False, request) in the former case
+    and (True, result) in the latter.  An exception which escapes the
+    outermost generator propagates to the caller."""
+
+    while True:
+      generator = self.__stack[-1]
+      try:
+        if exc_info is None:
+          yielded = generator.send(value)
+        else:
+          yielded = generator.throw(*exc_info)
+      except:
+        exc_info = sys.exc_info()
+        self.__stack.pop()
+        if exc_info[0] is StopIteration:
+          error = AssertionError(
+              "Generator finished without yielding a result: %s" % generator)
+          exc_info = (AssertionError, error, exc_info[2])
+        if len(self.__stack) == 0:
+          raise exc_info[0], exc_info[1], exc_info[2]
+        continue
+
+      value = None
+      exc_info = None
+      if isinstance(yielded, types.GeneratorType):
+        self.__stack.append(yielded)
+      elif isinstance(yielded, SubprocessRequest):
+        return (False, yielded)
+      else:
+        generator.close()
+        self.__stack.pop()
+        if len(self.__stack) == 0:
+          return (True, yielded)
+        value = yielded
+
+def run_synchronously(generator):
+  """Runs a generator of the kind described above to completion in the calling
+  thread, and returns its result."""
+
+  task = Task(generator)
+  done, value = task.step()
+  while not done:
+    try:
+      result = value.run()
+    except:
+      done, value = task.step(exc_info = sys.exc_info())
+    else:
+      done, value = task.step(result)
+  return value
+
+def _set_cloexec(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _set_nonblocking(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+  fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _ignore_signal(signum, frame):
+  pass
+
+class _Process(object):
+  """A subprocess started on behalf of a Task."""
+
+  def __init__(self, task, request):
+    self.task = task
+    self.request = request
+    self.proc, self.stdin_str = request.start()
+    self.stdin_pos = 0
+    self.stdout_chunks = []
+    self.stderr_chunks = []
+    # Maps file descriptors of pipes we have yet to finish with to the
+    # corresponding file objects.
+    self.pipes = {}
+
+    # The file descriptors of our ends of the pipes, or None.  (We can't ask
+    # the file objects after they're closed.)
+    self.stdin_fd, self.stdout_fd, self.stderr_fd = \
+        [self.__add_pipe(pipe)
+         for pipe in [self.proc.stdin, self.proc.stdout, self.proc.stderr]]
+
+    if self.stdin_fd is not None and not self.stdin_str:
+      # Nothing to write; like communicate(), close stdin right away.
+      self.close_pipe(self.stdin_fd)
+
+  def __add_pipe(self, pipe):
+    if pipe is None:
+      return None
+    fd = pipe.fileno()
+    # Don't let processes we start later inherit our end of the pipe, or e.g.
+    # this process would never see EOF on its stdin.
+    _set_cloexec(fd)
+    _set_nonblocking(fd)
+    self.pipes[fd] = pipe
+    return fd
+
+  def close_pipe(self, fd):
+    self.pipes.pop(fd).close()
+
+  def events_for(self, fd):
+    if fd == self.stdin_fd:
+      return select.POLLOUT
+    else:
+      return select.POLLIN
+
+  def handle(self, fd):
+    """Does whatever I/O is possible on the given pipe.  Returns false if the
+    pipe has been closed."""
+
+    if fd == self.stdin_fd:
+      try:
+        self.stdin_pos = self.stdin_pos + os.write(
+            fd, buffer(self.stdin_str, self.stdin_pos, select.PIPE_BUF))
+      except OSError, e:
+        if e.errno == errno.EAGAIN:
+          return True
+        elif e.errno != errno.EPIPE:
+          raise
+        # The process exited or closed its stdin without reading everything.
+        self.stdin_pos = len(self.stdin_str)
+      if self.stdin_pos < len(self.stdin_str):
+        return True
+    else:
+      try:
+        data = os.read(fd, 65536)
+      except OSError, e:
+        if e.errno == errno.EAGAIN:
+          return True
+        raise
+      if data != "":
+        if fd == self.stdout_fd:
+          self.stdout_chunks.append(data)
+        else:
+          self.stderr_chunks.append(data)
+        return True
+
+    self.close_pipe(fd)
+    return False
+
+  def finish(self):
+    if self.stdout_fd is None:
+      stdout_str = None
+    else:
+      stdout_str = "".join(self.stdout_chunks)
+    if self.stderr_fd is None:
+      stderr_str = None
+    else:
+      stderr_str = "".join(self.stderr_chunks)
+    return self.request.finish(self.proc, stdout_str, stderr_str)
+
+class EventLoop(object):
+  """Runs many Tasks at once from a single thread.  When a task asks for a
+  subprocess, the process is started and the task set aside.  poll() is used
+  to feed every process its stdin and collect its output as it arrives, and
+  SIGCHLD to notice when processes exit, so no thread ever blocks on an
+  individual process.
+
+  If created on the main thread, the EventLoop installs a SIGCHLD handler
+  until close() is called.  On other threads it has to poll for exited
+  processes instead, which is slower."""
+
+  # How often to check for exited processes if we can't use SIGCHLD.
+  POLL_INTERVAL = 0.01
+
+  def __init__(self):
+    self.__poll = select.poll()
+    # Maps pipe file descriptors to the _Process which they belong to.
+    self.__pipes = {}
+    self.__processes = set()
+    self.__num_tasks = 0
+
+    # SIGCHLD interrupts poll() but the handler itself does nothing, so we
+    # also have the signal module write a byte to a pipe we're polling.  This
+    # way a child exiting just before we call poll() can't be missed.
+    self.__wakeup_read, self.__wakeup_write = os.pipe()
+    for fd in [self.__wakeup_read, self.__wakeup_write]:
+      _set_cloexec(fd)
+      _set_nonblocking(fd)
+    self.__poll.register(self.__wakeup_read, select.POLLIN)
+
+    try:
+      self.__old_wakeup_fd = signal.set_wakeup_fd(self.__wakeup_write)
+    except ValueError:
+      # Not the main thread.
+      self.__old_wakeup_fd = None
+      self.__old_handler = None
+    else:
+      self.__old_handler = signal.signal(signal.SIGCHLD, _ignore_signal)
+      # Don't let SIGCHLD make other system calls (e.g. reads from files
+      # while hashing) fail with EINTR.
+      signal.siginterrupt(signal.SIGCHLD, False)
+
+  def close(self):
+    """Restores the SIGCHLD handler and releases the EventLoop's resources."""
+
+    if self.__old_wakeup_fd is not None:
+      signal.signal(signal.SIGCHLD, self.__old_handler)
+      signal.set_wakeup_fd(self.__old_wakeup_fd)
+    os.close(self.__wakeup_read)
+    os.close(self.__wakeup_write)
+
+  def __len__(self):
+    """Returns the number of tasks which haven't finished yet."""
+    return self.__num_tasks
+
+  def add(self, generator):
+    """Starts a new task running the given generator.  The task runs right
+    away until it first has to wait for a subprocess (or finishes)."""
+
+    self.__num_tasks = self.__num_tasks + 1
+    self.__advance(Task(generator), None, None)
+
+  def run_once(self, timeout = None):
+    """Waits up to |timeout| seconds (or indefinitely if None) for some
+    subprocess to make progress, then resumes every task whose subprocess has
+    finished.  Exceptions which escape a task propagate to the caller."""
+
+    if self.__old_wakeup_fd is None and len(self.__processes) > 0:
+      if timeout is None or timeout > EventLoop.POLL_INTERVAL:
+        timeout = EventLoop.POLL_INTERVAL
+
+    if timeout is None:
+      milliseconds = None
+    else:
+      milliseconds = int(timeout * 1000)
+
+    try:
+      events = self.__poll.poll(milliseconds)
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      events = []
+
+    for fd, event in events:
+      if fd == self.__wakeup_read:
+        try:
+          while os.read(fd, 4096) != "":
+            pass
+        except OSError, e:
+          if e.errno != errno.EAGAIN:
+            raise
+      elif fd in self.__pipes:
+        if not self.__pipes[fd].handle(fd):
+          self.__poll.unregister(fd)
+          del self.__pipes[fd]
+
+    for process in list(self.__processes):
+      if len(process.pipes) == 0 and process.proc.poll() is not None:
+        self.__processes.remove(process)
+        try:
+          result = process.finish()
+        except:
+          self.__advance(process.task, None, sys.exc_info())
+        else:
+          self.__advance(process.task, result, None)
+
+  def cancel(self):
+    """Kills all running subprocesses, and raises KeyboardInterrupt inside the
+    tasks waiting for them so that they can clean up.  KeyboardInterrupts
+    which escape those tasks are ignored."""
+
+    while len(self.__processes) > 0:
+      process = self.__processes.pop()
+      for fd in process.pipes.keys():
+        self.__poll.unregister(fd)
+        del self.__pipes[fd]
+        process.close_pipe(fd)
+      process.request.kill(process.proc)
+      process.proc.wait()
+
+      try:
+        raise KeyboardInterrupt
+      except KeyboardInterrupt:
+        exc_info = sys.exc_info()
+      try:
+        self.__advance(process.task, None, exc_info)
+      except KeyboardInterrupt:
+        pass
+
+  def __advance(self, task, value, exc_info):
+    while True:
+      try:
+        done, request = task.step(value, exc_info)
+      except:
+        self.__num_tasks = self.__num_tasks - 1
+        raise
+      if done:
+        self.__num_tasks = self.__num_tasks - 1
+        return
+
+      try:
+        process = _Process(task, request)
+      except:
+        # Couldn't start the process (e.g. the program doesn't exist).  Let
+        # the task handle the error.
+        value = None
+        exc_info = sys.exc_info()
+        continue
+
+      self.__processes.add(process)
+      for fd in process.pipes:
+        self.__pipes[fd] = process
+        self.__poll.register(fd, process.events_for(fd))
+      return
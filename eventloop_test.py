@@ -0,0 +1,182 @@
+#! /usr/bin/python
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import subprocess
+import time
+import unittest
+
+from sebs.eventloop import SubprocessRequest, Task, EventLoop, \
+                           run_synchronously
+
+class MockContext(object):
+  def __init__(self):
+    self.subprocesses = []
+
+  def subprocess(self, args, **kwargs):
+    self.subprocesses.append(args)
+    if args[0] == "fail":
+      raise OSError("no such program")
+    return (0, " ".join(args), None)
+
+def _echo_twice(context):
+  first = yield SubprocessRequest(context, ["echo", "one"], {})
+  second = yield SubprocessRequest(context, ["echo", "two"], {})
+  yield first[1] + "," + second[1]
+
+def _outer(context):
+  result = yield _echo_twice(context)
+  yield "outer(%s)" % result
+
+def _catch(context):
+  try:
+    yield SubprocessRequest(context, ["fail"], {})
+  except OSError:
+    yield "caught"
+
+def _no_result():
+  if False:
+    yield None
+
+class TaskTest(unittest.TestCase):
+  def testRunSynchronously(self):
+    context = MockContext()
+    self.assertEqual("outer(echo one,echo two)",
+                     run_synchronously(_outer(context)))
+    self.assertEqual([["echo", "one"], ["echo", "two"]], context.subprocesses)
+
+  def testStep(self):
+    context = MockContext()
+    task = Task(_outer(context))
+    done, request = task.step()
+    self.assertFalse(done)
+    self.assertEqual(["echo", "one"], request.args)
+    done, request = task.step((0, "a", None))
+    self.assertFalse(done)
+    self.assertEqual(["echo", "two"], request.args)
+    self.assertEqual((True, "outer(a,b)"), task.step((0, "b", None)))
+    self.assertEqual([], context.subprocesses)
+
+  def testExceptions(self):
+    context = MockContext()
+    self.assertEqual("caught", run_synchronously(_catch(context)))
+    self.assertRaises(AssertionError, run_synchronously, _no_result())
+
+class EventLoopTest(unittest.TestCase):
+  def setUp(self):
+    self.event_loop = EventLoop()
+
+  def tearDown(self):
+    self.event_loop.close()
+
+  def runAll(self):
+    while len(self.event_loop) > 0:
+      self.event_loop.run_once()
+
+  def testPipes(self):
+    results = []
+    def task(args, stdin):
+      result = yield SubprocessRequest(None, args,
+          { "stdin": stdin, "stdout": subprocess.PIPE,
+            "stderr": subprocess.PIPE })
+      results.append(result)
+      yield True
+
+    # More input than fits in a pipe buffer, so it has to be fed in pieces.
+    big = "x" * 200000
+    self.event_loop.add(task(["cat"], big))
+    self.event_loop.add(task(["sh", "-c", "echo out; echo err >&2; exit 3"],
+                             None))
+    self.runAll()
+
+    results.sort()
+    self.assertEqual([(0, big, ""), (3, "out\n", "err\n")], results)
+
+  def testConcurrency(self):
+    def task():
+      yield SubprocessRequest(None, ["sleep", "0.2"], {})
+      yield True
+
+    start = time.time()
+    for i in range(10):
+      self.event_loop.add(task())
+    self.runAll()
+    # Run one at a time, these would take two seconds.
+    self.assertTrue(time.time() - start < 1.0)
+
+  def testStartFailure(self):
+    results = []
+    def task():
+      try:
+        yield SubprocessRequest(None, ["/nonexistent/program"], {})
+      except OSError:
+        results.append("caught")
+      yield True
+
+    self.event_loop.add(task())
+    self.runAll()
+    self.assertEqual(["caught"], results)
+
+  def testCancel(self):
+    results = []
+    def task():
+      try:
+        yield SubprocessRequest(None, ["sleep", "10"], {})
+      except KeyboardInterrupt:
+        results.append("cancelled")
+        raise
+      yield True
+
+    self.event_loop.add(task())
+    self.event_loop.add(task())
+    self.event_loop.run_once(0)
+    self.event_loop.cancel()
+    self.assertEqual(["cancelled", "cancelled"], results)
+    self.assertEqual(0, len(self.event_loop))
+
+  def testCancelUsesRequestKill(self):
+    killed = []
+    class KillRecordingRequest(SubprocessRequest):
+      def kill(self, proc):
+        killed.append(proc.pid)
+        super(KillRecordingRequest, self).kill(proc)
+
+    def task():
+      yield KillRecordingRequest(None, ["sleep", "10"], {})
+
+    self.event_loop.add(task())
+    self.event_loop.run_once(0)
+    self.event_loop.cancel()
+    self.assertEqual(1, len(killed))
+    self.assertEqual(0, len(self.event_loop))
+
+if __name__ == "__main__":
+  unittest.main()
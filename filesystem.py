@@ -29,13 +29,183 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import errno
 import glob
 import os
 import shutil
+import stat
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 from sebs.helpers import typecheck
 
+def _makedirs(path):
+  """Like os.makedirs(), but doesn't fail if some other thread or process
+  creates the directory first."""
+
+  try:
+    os.makedirs(path)
+  except OSError, e:
+    if e.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+
+class StatCache(object):
+  """Remembers the results of stat() for the duration of a build, so that a
+  file which many actions depend on (such as a common header) is only stat'ed
+  once.  Missing files are remembered too.  Anything which changes a file must
+  call invalidate() for it; DiskDirectory does this for its own writes, and
+  the Builder does it for each action's outputs.  Thread-safe."""
+
+  # How many threads prefetch() uses by default.  Stats mostly wait on the
+  # disk (or the network), so this can exceed the number of CPUs.
+  PREFETCH_THREADS = 16
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    # Maps paths to stat results, or to the OSError raised by stat().
+    self.__entries = {}
+    self.__lookups = 0
+    self.__misses = 0
+
+  def stat(self, path):
+    """Like os.stat(), but cached."""
+
+    self.__lock.acquire()
+    try:
+      self.__lookups = self.__lookups + 1
+      result = self.__entries.get(path)
+    finally:
+      self.__lock.release()
+
+    if result is None:
+      try:
+        result = os.stat(path)
+      except OSError, e:
+        result = e
+      self.__lock.acquire()
+      try:
+        self.__misses = self.__misses + 1
+        self.__entries[path] = result
+      finally:
+        self.__lock.release()
+
+    if isinstance(result, OSError):
+      raise result
+    return result
+
+  def prefetch(self, paths, threads = None):
+    """Stats all of the given paths in parallel, so that later lookups of
+    them are answered from the cache.  Paths are grouped by directory, and the
+    directory is listed once so that files which don't exist needn't be
+    stat'ed individually."""
+
+    typecheck(paths, list, basestring)
+    if threads is None:
+      threads = StatCache.PREFETCH_THREADS
+
+    by_dir = {}
+    self.__lock.acquire()
+    try:
+      for path in paths:
+        if path not in self.__entries:
+          by_dir.setdefault(os.path.dirname(path), set()).add(path)
+    finally:
+      self.__lock.release()
+    if len(by_dir) == 0:
+      return
+
+    if threads > 1 and len(by_dir) > 1:
+      pool = ThreadPool(min(threads, len(by_dir)))
+      try:
+        results = pool.map(self.__stat_group, by_dir.items())
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [self.__stat_group(group) for group in by_dir.items()]
+
+    self.__lock.acquire()
+    try:
+      for entries, calls in results:
+        for path, result in entries:
+          # Don't clobber anything invalidated or re-stat'ed meanwhile.
+          self.__entries.setdefault(path, result)
+        self.__misses = self.__misses + calls
+    finally:
+      self.__lock.release()
+
+  def __stat_group(self, group):
+    """Stats a set of paths in one directory.  Returns a list of
+    (path, result) pairs, and the number of system calls it took."""
+
+    dirname, paths = group
+    calls = 0
+    names = None
+    if len(paths) > 1:
+      calls = calls + 1
+      try:
+        # Case-folded, in case the filesystem is case-insensitive.
+        names = set([name.lower() for name in os.listdir(dirname or ".")])
+      except OSError:
+        pass
+
+    entries = []
+    for path in paths:
+      basename = os.path.basename(path)
+      if names is not None and basename not in ("", ".", "..") and \
+         basename.lower() not in names:
+        result = OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+      else:
+        calls = calls + 1
+        try:
+          result = os.stat(path)
+        except OSError, e:
+          result = e
+      entries.append((path, result))
+    return (entries, calls)
+
+  def exists(self, path):
+    try:
+      self.stat(path)
+      return True
+    except OSError:
+      return False
+
+  def isdir(self, path):
+    try:
+      return stat.S_ISDIR(self.stat(path).st_mode)
+    except OSError:
+      return False
+
+  def getmtime(self, path):
+    return self.stat(path).st_mtime
+
+  def invalidate(self, path):
+    """Forgets what we know about the path, because it is about to change or
+    just has.  Parent directories remembered as missing are forgotten too,
+    since writing a file may create them."""
+
+    self.__lock.acquire()
+    try:
+      self.__entries.pop(path, None)
+      parent = os.path.dirname(path)
+      while isinstance(self.__entries.get(parent), OSError):
+        del self.__entries[parent]
+        parent = os.path.dirname(parent)
+    finally:
+      self.__lock.release()
+
+  def stats(self):
+    """Returns (lookups, stat calls) so far.  The difference is the number of
+    stat() calls the cache saved."""
+
+    self.__lock.acquire()
+    try:
+      return (self.__lookups, self.__misses)
+    finally:
+      self.__lock.release()
+
 class Directory(object):
   """Abstract base class for a directory in which builds may be performed."""
 
@@ -102,24 +272,39 @@ class Directory(object):
     raise NotImplementedError
 
 class DiskDirectory(Directory):
-  def __init__(self, path):
+  def __init__(self, path, stat_cache=None):
+    """If |stat_cache| (a StatCache) is given, file metadata is looked up
+    through it."""
+
     typecheck(path, basestring)
+    typecheck(stat_cache, StatCache)
 
     super(DiskDirectory, self).__init__()
 
     self.__path = os.path.normpath(path)
+    self.__stat_cache = stat_cache
 
   def exists(self, filename):
-    return os.path.exists(os.path.join(self.__path, filename))
+    path = os.path.join(self.__path, filename)
+    if self.__stat_cache is None:
+      return os.path.exists(path)
+    return self.__stat_cache.exists(path)
 
   def isdir(self, filename):
-    return os.path.isdir(os.path.join(self.__path, filename))
+    path = os.path.join(self.__path, filename)
+    if self.__stat_cache is None:
+      return os.path.isdir(path)
+    return self.__stat_cache.isdir(path)
 
   def getmtime(self, filename):
-    return os.path.getmtime(os.path.join(self.__path, filename))
+    path = os.path.join(self.__path, filename)
+    if self.__stat_cache is None:
+      return os.path.getmtime(path)
+    return self.__stat_cache.getmtime(path)
 
   def touch(self, filename, mtime=None):
     path = os.path.join(self.__path, filename)
+    self.__invalidate(path)
     if mtime is None:
       os.utime(path, None)
     else:
@@ -139,9 +324,10 @@ class DiskDirectory(Directory):
     typecheck(mtime, [int, float])
 
     path = os.path.join(self.__path, filename)
+    self.__invalidate(path)
     dirname = os.path.dirname(path)
     if not os.path.exists(dirname):
-      os.makedirs(dirname)
+      _makedirs(dirname)
 
     # TODO(kenton):  Write to temp file and atomically rename?  Does it matter?
     dest = open(path, "wb")
@@ -171,7 +357,8 @@ class DiskDirectory(Directory):
     # but is *not* a directory, we still call makedirs() so that it raises an
     # appropriate error.
     if not os.path.exists(path) or not os.path.isdir(path):
-      os.makedirs(path)
+      self.__invalidate(path)
+      _makedirs(path)
 
   def get_disk_path(self, filename):
     return os.path.join(self.__path, filename)
@@ -182,11 +369,24 @@ class DiskDirectory(Directory):
       assert match.startswith(prefix)
       yield match[len(prefix):]
 
+  def __invalidate(self, path):
+    if self.__stat_cache is not None:
+      self.__stat_cache.invalidate(path)
+
 class VirtualDirectory(Directory):
-  def __init__(self):
+  """A directory which exists only in memory -- or in whatever |files| and
+  |dirs| are, if given.  These are dict-like objects (such as tables of a
+  KeyValueStore) mapping each file's name to (mtime, content), and each
+  directory's name to True."""
+
+  def __init__(self, files = None, dirs = None):
     super(VirtualDirectory, self).__init__()
-    self.__files = {}
-    self.__dirs = set()
+    if files is None:
+      files = {}
+    if dirs is None:
+      dirs = {}
+    self.__files = files
+    self.__dirs = dirs
 
   def add(self, filename, mtime, content):
     """Deprecated:  Use write() instead."""
@@ -205,7 +405,7 @@ class VirtualDirectory(Directory):
   def restore(self, state):
     typecheck(state, dict)
     self.__files = state
-    self.__dirs = set()
+    self.__dirs = {}
     for name in state.keys():
       self.mkdir(os.path.dirname(name))
 
@@ -270,9 +470,9 @@ class VirtualDirectory(Directory):
 
     if filename in self.__files:
       raise os.error("Can't make directory because file exists: %s" % filename)
-    if filename != "":
+    if filename != "" and filename not in self.__dirs:
       self.mkdir(os.path.dirname(filename))
-      self.__dirs.add(filename)
+      self.__dirs[filename] = True
 
   def expand_glob(self, pattern):
     # TODO(kenton):  Implement?  Currently not needed since we only allow
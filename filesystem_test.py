@@ -37,7 +37,7 @@ import time
 import unittest
 
 from sebs.filesystem import Directory, DiskDirectory, VirtualDirectory, \
-                            MappedDirectory
+                            MappedDirectory, StatCache
 
 class DirectoryTest(object):
   """Base class for DiskDirectoryTest and VirtualDirectoryTest.  Defines test
@@ -187,6 +187,62 @@ class DiskDirectoryTest(DirectoryTest, unittest.TestCase):
     self.assertEquals(set([]),
                       set(self.dir.expand_glob("grault")))
 
+class CachedDiskDirectoryTest(DiskDirectoryTest):
+  def setUp(self):
+    super(CachedDiskDirectoryTest, self).setUp()
+    self.stat_cache = StatCache()
+    self.dir = DiskDirectory(self.tempdir, self.stat_cache)
+
+  def addFile(self, name, mtime, content):
+    super(CachedDiskDirectoryTest, self).addFile(name, mtime, content)
+    self.stat_cache.invalidate(os.path.join(self.tempdir, name))
+
+  def addDirectory(self, name):
+    super(CachedDiskDirectoryTest, self).addDirectory(name)
+    self.stat_cache.invalidate(os.path.join(self.tempdir, name))
+
+  def testStatsCached(self):
+    self.assertFalse(self.dir.exists("foo"))
+    DiskDirectoryTest.addFile(self, "foo", 123, "Hello world!")
+    # That went behind the cache's back.
+    self.assertFalse(self.dir.exists("foo"))
+
+    self.stat_cache.invalidate(os.path.join(self.tempdir, "foo"))
+    self.assertTrue(self.dir.exists("foo"))
+    self.assertEquals(123, self.dir.getmtime("foo"))
+    self.assertFalse(self.dir.isdir("foo"))
+    self.assertEquals((5, 2), self.stat_cache.stats())
+
+    # Writes through the directory invalidate the cache.
+    self.dir.write("bar/baz", "qux", 456)
+    self.assertEquals(456, self.dir.getmtime("bar/baz"))
+    self.assertTrue(self.dir.isdir("bar"))
+    self.dir.touch("bar/baz", 789)
+    self.assertEquals(789, self.dir.getmtime("bar/baz"))
+
+  def testPrefetch(self):
+    self.addFile("foo", 123, "Hello world!")
+    self.addFile("bar", 456, "Hello world!")
+    self.addDirectory("sub")
+    self.addFile("sub/baz", 789, "Hello world!")
+    paths = [os.path.join(self.tempdir, name)
+             for name in ["foo", "bar", "missing", "missing2", "sub/baz",
+                          "nosuchdir/qux"]]
+    self.stat_cache.prefetch(paths, 4)
+    lookups, calls = self.stat_cache.stats()
+
+    self.assertTrue(self.dir.exists("foo"))
+    self.assertEquals(456, self.dir.getmtime("bar"))
+    self.assertFalse(self.dir.exists("missing"))
+    self.assertFalse(self.dir.exists("missing2"))
+    self.assertEquals(789, self.dir.getmtime("sub/baz"))
+    self.assertFalse(self.dir.exists("nosuchdir/qux"))
+    # All answered from the cache.
+    self.assertEquals((lookups + 6, calls), self.stat_cache.stats())
+    # One listing of the top directory served "missing" and "missing2", plus
+    # three stat()s.
+    self.assertEquals(5, calls)
+
 class VirtualDirectoryTest(DirectoryTest, unittest.TestCase):
   def setUp(self):
     self.dir = VirtualDirectory()
@@ -0,0 +1,65 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+"""
+Scans C and C++ source files for #include directives, and remembers the
+results between builds.  This lets a compile depend on just the generated
+headers its source can actually reach, without running the preprocessor.
+"""
+
+import re
+
+from sebs.depfile import DepFileCache
+
+_INCLUDE_PATTERN = re.compile(
+    r'^[ \t]*#[ \t]*include\b[ \t]*([<"][^>"\n]*[>"]|[^ \t\n<"][^\n]*)',
+    re.MULTILINE)
+
+def parse_includes(text):
+  """Returns the operands of the #include directives in the C/C++ source
+  |text|, including their quotes or angle brackets, e.g. '"foo.h"' or
+  '<vector>'.  Computed includes, which name a macro, are returned as written.
+  Conditional compilation is ignored, so every directive is returned, even
+  ones which would be skipped or are inside comments."""
+
+  return [match.strip() for match in _INCLUDE_PATTERN.findall(text)]
+
+class IncludeCache(DepFileCache):
+  """Like DepFileCache, but read() returns the list of #include directives in
+  a source file, as parse_includes() would, rather than parsing a depfile."""
+
+  _ENTRIES_TABLE = "includes"
+  _PATHS_TABLE = "include names"
+
+  def _parse(self, text):
+    return parse_includes(text)
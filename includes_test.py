@@ -0,0 +1,69 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sebs.includes import IncludeCache, parse_includes
+from sebs.kvstore import KeyValueStore
+
+class IncludesTest(unittest.TestCase):
+  def testParse(self):
+    self.assertEqual(['"foo.h"', '<vector>', '"bar/baz.h"', 'QUX_HEADER'],
+                     parse_includes('#include "foo.h"\n'
+                                    '#include <vector>  // comment\n'
+                                    'int i;  #include "not_a_directive.h"\n'
+                                    '  #  include"bar/baz.h"\n'
+                                    '#include_next <stdio.h>\n'
+                                    '#include QUX_HEADER\n'))
+
+  def testCache(self):
+    tempdir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tempdir, "foo.cc")
+      file = open(path, "wb")
+      file.write('#include "foo.h"\n')
+      file.close()
+
+      database = KeyValueStore()
+      cache = IncludeCache(database)
+      self.assertEqual(['"foo.h"'], cache.read(path))
+      self.assertEqual(None, cache.read(os.path.join(tempdir, "bar.cc")))
+      # Kept apart from depfiles.
+      self.assertEqual(0, len(database.table("depfile paths")))
+    finally:
+      shutil.rmtree(tempdir)
+
+if __name__ == "__main__":
+  unittest.main()
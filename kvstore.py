@@ -0,0 +1,296 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+A persistent key-value store for SEBS's bookkeeping (action hashes, the "mem"
+and "env" directories, and so on), backed by sqlite3.
+
+Unlike the pickles it replaces, nothing is read until it is asked for, and
+every change is committed as it is made, so a build which crashes or is
+interrupted keeps everything it learned up to that point.  The database is
+in WAL mode with synchronous=NORMAL:  a commit is just an append to the log,
+and while a power failure may lose the last few commits, it can't corrupt
+the database.
+
+The store holds any number of named tables.  Values may be anything
+picklable.  Keys are pickled without memoization, so that equal keys encode
+identically even if some of their parts are the same object; they should be
+strings, numbers, None, and tuples thereof, and equal keys must have the same
+types (e.g. str, not unicode).
+"""
+
+import cPickle
+import cStringIO
+import os
+import sqlite3
+import threading
+
+from sebs.helpers import typecheck
+
+# In a _Table's cache, marks keys known to be missing from the database.
+_MISSING = object()
+# Returned by a cache lookup for keys we haven't read from the database yet.
+_UNKNOWN = object()
+
+# Stored as the database's user_version.  Databases with any other version
+# encoded keys differently, so their entries are discarded.
+_FORMAT_VERSION = 1
+
+class KeyValueStore(object):
+  """A database file containing tables; see table().  If |path| is None, the
+  store lives in memory and is discarded when closed.  Thread-safe."""
+
+  # Seconds to wait for another process which has the database locked.
+  TIMEOUT = 30
+
+  def __init__(self, path = None):
+    typecheck(path, basestring)
+
+    self.__lock = threading.Lock()
+    self.__tables = {}
+    if path is None:
+      self.__connection = self.__connect(":memory:")
+    else:
+      try:
+        self.__connection = self.__connect(path)
+      except sqlite3.DatabaseError:
+        # Everything in here can be recomputed, so rather than make the user
+        # figure out what went wrong, start over.
+        for suffix in ["", "-wal", "-shm"]:
+          if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+        self.__connection = self.__connect(path)
+
+  def close(self):
+    """Closes the database.  Does nothing if already closed."""
+
+    self.__lock.acquire()
+    try:
+      if self.__connection is not None:
+        self.__connection.close()
+        self.__connection = None
+    finally:
+      self.__lock.release()
+
+  def table(self, name):
+    """Returns the table with the given name, creating it if needed.  Tables
+    act like dicts, except that writes go straight to disk and values should
+    be treated as immutable (modify a copy and store it back)."""
+
+    typecheck(name, str)
+
+    self.__lock.acquire()
+    try:
+      result = self.__tables.get(name)
+      if result is None:
+        result = _Table(self, name)
+        self.__tables[name] = result
+      return result
+    finally:
+      self.__lock.release()
+
+  # ------------------------------------------------------------------
+  # Used by _Table.  These take care of locking.
+
+  def _query(self, sql, args):
+    self.__lock.acquire()
+    try:
+      return self.__connection.execute(sql, args).fetchall()
+    finally:
+      self.__lock.release()
+
+  def _update(self, sql, rows):
+    """Runs the statement once for each row, as one transaction."""
+
+    self.__lock.acquire()
+    try:
+      self.__connection.execute("BEGIN")
+      try:
+        self.__connection.executemany(sql, rows)
+      except:
+        self.__connection.execute("ROLLBACK")
+        raise
+      self.__connection.execute("COMMIT")
+    finally:
+      self.__lock.release()
+
+  # ------------------------------------------------------------------
+
+  def __connect(self, path):
+    # isolation_level = None stops the sqlite3 module from managing
+    # transactions itself; _update() does so explicitly.
+    connection = sqlite3.connect(path, timeout = KeyValueStore.TIMEOUT,
+                                 isolation_level = None,
+                                 check_same_thread = False)
+    try:
+      connection.text_factory = str
+      connection.execute("PRAGMA journal_mode = WAL")
+      connection.execute("PRAGMA synchronous = NORMAL")
+      connection.execute(
+          "CREATE TABLE IF NOT EXISTS entries ("
+          "  tbl TEXT NOT NULL, key BLOB NOT NULL, value BLOB NOT NULL,"
+          "  PRIMARY KEY (tbl, key))")
+      version = connection.execute("PRAGMA user_version").fetchall()[0][0]
+      if version != _FORMAT_VERSION:
+        connection.execute("DELETE FROM entries")
+        connection.execute("PRAGMA user_version = %d" % _FORMAT_VERSION)
+    except:
+      connection.close()
+      raise
+    return connection
+
+class _Table(object):
+  """One table of a KeyValueStore.  Remembers what it has read (and written),
+  so repeated lookups don't go to the database.  This assumes that only one
+  process uses the table at a time."""
+
+  def __init__(self, store, name):
+    self.__store = store
+    self.__name = name
+    # Guards __cache.  Never held while calling into the store.
+    self.__lock = threading.Lock()
+    self.__cache = {}
+
+  def get(self, key, default = None):
+    self.__lock.acquire()
+    try:
+      value = self.__cache.get(key, _UNKNOWN)
+    finally:
+      self.__lock.release()
+
+    if value is _UNKNOWN:
+      rows = self.__store._query(
+          "SELECT value FROM entries WHERE tbl = ? AND key = ?",
+          (self.__name, _encode_key(key)))
+      if len(rows) == 0:
+        value = _MISSING
+      else:
+        value = _decode(rows[0][0])
+      self.__lock.acquire()
+      try:
+        # Another thread may have written the key in the meantime.
+        value = self.__cache.setdefault(key, value)
+      finally:
+        self.__lock.release()
+
+    if value is _MISSING:
+      return default
+    return value
+
+  def __getitem__(self, key):
+    value = self.get(key, _MISSING)
+    if value is _MISSING:
+      raise KeyError(key)
+    return value
+
+  def __contains__(self, key):
+    return self.get(key, _MISSING) is not _MISSING
+
+  def __setitem__(self, key, value):
+    self.update([(key, value)])
+
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    self.pop(key)
+
+  def pop(self, key, default = None):
+    value = self.get(key, _MISSING)
+    if value is _MISSING:
+      return default
+    self.__store._update("DELETE FROM entries WHERE tbl = ? AND key = ?",
+                         [(self.__name, _encode_key(key))])
+    self.__lock.acquire()
+    try:
+      self.__cache[key] = _MISSING
+    finally:
+      self.__lock.release()
+    return value
+
+  def update(self, items):
+    """Stores all the given (key, value) pairs (or dict entries) in a single
+    transaction."""
+
+    if isinstance(items, dict):
+      items = items.items()
+    else:
+      items = list(items)
+    self.__store._update(
+        "INSERT OR REPLACE INTO entries (tbl, key, value) VALUES (?, ?, ?)",
+        [(self.__name, _encode_key(key), _encode(value))
+         for key, value in items])
+    self.__lock.acquire()
+    try:
+      for key, value in items:
+        self.__cache[key] = value
+    finally:
+      self.__lock.release()
+
+  def clear(self):
+    self.__store._update("DELETE FROM entries WHERE tbl = ?",
+                         [(self.__name,)])
+    self.__lock.acquire()
+    try:
+      self.__cache = {}
+    finally:
+      self.__lock.release()
+
+  def items(self):
+    """Returns all (key, value) pairs.  Reads the whole table."""
+
+    return [(_decode(key), _decode(value)) for key, value in
+            self.__store._query(
+                "SELECT key, value FROM entries WHERE tbl = ?",
+                (self.__name,))]
+
+  def keys(self):
+    return [key for key, value in self.items()]
+
+  def __len__(self):
+    return self.__store._query(
+        "SELECT COUNT(*) FROM entries WHERE tbl = ?", (self.__name,))[0][0]
+
+def _encode(obj):
+  return buffer(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))
+
+def _encode_key(key):
+  # A memoizing pickler would encode (a, a) differently from (a, b) even when
+  # a == b.  "Fast" mode turns memoization off; it can't handle recursive
+  # structures, but keys aren't.
+  file = cStringIO.StringIO()
+  pickler = cPickle.Pickler(file, cPickle.HIGHEST_PROTOCOL)
+  pickler.fast = 1
+  pickler.dump(key)
+  return buffer(file.getvalue())
+
+def _decode(data):
+  return cPickle.loads(str(data))
@@ -0,0 +1,144 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from sebs.kvstore import KeyValueStore
+
+class KeyValueStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, "test.db")
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testBasics(self):
+    store = KeyValueStore(self.path)
+    table = store.table("foo")
+    self.assertTrue(table is store.table("foo"))
+
+    self.assertEqual(None, table.get("a"))
+    self.assertEqual(123, table.get("a", 123))
+    self.assertFalse("a" in table)
+    self.assertRaises(KeyError, table.__getitem__, "a")
+
+    table["a"] = 1
+    table[(None, "b")] = {"x": [1, 2]}
+    table["c"] = None
+    self.assertEqual(1, table["a"])
+    self.assertEqual({"x": [1, 2]}, table[(None, "b")])
+    self.assertTrue("c" in table)
+    self.assertEqual(None, table.get("c", 123))
+    self.assertEqual(3, len(table))
+
+    # Tables are independent.
+    self.assertEqual(0, len(store.table("bar")))
+
+    del table["a"]
+    self.assertFalse("a" in table)
+    self.assertEqual(None, table.pop("a"))
+    self.assertEqual({"x": [1, 2]}, table.pop((None, "b")))
+    self.assertEqual(["c"], table.keys())
+
+    table.update({"d": 4, "e": 5})
+    self.assertEqual([("c", None), ("d", 4), ("e", 5)], sorted(table.items()))
+    table.clear()
+    self.assertEqual(0, len(table))
+    self.assertFalse("d" in table)
+    store.close()
+
+  def testPersistence(self):
+    store = KeyValueStore(self.path)
+    table = store.table("foo")
+    table["a"] = "b"
+    # Written immediately, so a second connection sees it (as would a new
+    # process after a crash).
+    self.assertEqual("b", KeyValueStore(self.path).table("foo")["a"])
+    table.pop("a")
+    table["c"] = "d"
+    store.close()
+    store.close()   # harmless
+
+    table = KeyValueStore(self.path).table("foo")
+    self.assertEqual([("c", "d")], table.items())
+
+  def testEqualKeys(self):
+    # Keys which are equal must find the same entry, whether or not their
+    # parts are the same objects.
+    name = "".join(["na", "me"])
+    other_name = "".join(["nam", "e"])
+    self.assertFalse(name is other_name)
+
+    store = KeyValueStore(self.path)
+    store.table("foo")[(name, "verb", name)] = 1
+    store.table("foo")[(name, "verb", other_name)] = 2
+    self.assertEqual(1, len(store.table("foo")))
+    store.close()
+
+    table = KeyValueStore(self.path).table("foo")
+    self.assertEqual(2, table.get((other_name, "verb", name)))
+    self.assertEqual(2, table.get(("name", "verb", "name")))
+
+  def testOldFormat(self):
+    store = KeyValueStore(self.path)
+    store.table("foo")["a"] = "b"
+    store.close()
+
+    # Entries written with a different key encoding are discarded.
+    connection = sqlite3.connect(self.path)
+    connection.execute("PRAGMA user_version = 0")
+    connection.close()
+    self.assertEqual(0, len(KeyValueStore(self.path).table("foo")))
+
+  def testCorruptDatabase(self):
+    file = open(self.path, "wb")
+    file.write("this is not a database" * 100)
+    file.close()
+    table = KeyValueStore(self.path).table("foo")
+    self.assertEqual(0, len(table))
+    table["a"] = "b"
+    self.assertEqual("b", table["a"])
+
+  def testInMemory(self):
+    table = KeyValueStore().table("foo")
+    table["a"] = "b"
+    self.assertEqual("b", table["a"])
+
+if __name__ == "__main__":
+  unittest.main()
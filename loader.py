@@ -191,6 +191,8 @@ class _Builtins(object):
     self.ConditionalCommand = command.ConditionalCommand
     self.SubprocessCommand  = command.SubprocessCommand
     self.DepFileCommand     = command.DepFileCommand
+    self.IncludeScanCommand = command.IncludeScanCommand
+    self.ToolchainCommand   = command.ToolchainCommand
     self.MirrorCommand      = command.MirrorCommand
 
     self.__loader = loader
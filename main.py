@@ -60,18 +60,29 @@
 
 import cPickle
 import getopt
+import multiprocessing
 import os
 import sys
 import threading
 
-from sebs.builder import Builder
+from sebs.builder import Builder, ActionTimings
+from sebs.cas import ContentStore
 from sebs.configuration import Configuration
 from sebs.core import Rule, Test
 from sebs.helpers import typecheck
+from sebs.kvstore import KeyValueStore
 from sebs.loader import Loader, BuildFile
 from sebs.console import make_console, ColoredText
+from sebs.depfile import DepFileCache
+from sebs.includes import IncludeCache
+from sebs.digest import DigestCache
+from sebs.filesystem import StatCache
+from sebs.eventloop import EventLoop
+from sebs.remote import CacheServer, RemoteCache, RemoteError
 from sebs.runner import SubprocessRunner, CachingRunner
 from sebs.script import ScriptBuilder
+from sebs.spawner import SpawnHelper
+from sebs.workers import WorkerPool
 
 class UsageError(Exception):
   pass
@@ -102,27 +113,97 @@ def _args_to_rules(loader, args):
     else:
       yield target
 
-def _restore_pickle(obj, filename):
+def _available_cpus():
+  """Returns the number of CPUs that this process is allowed to run on,
+  honoring its CPU affinity mask where we can find it."""
+
+  if hasattr(os, "sched_getaffinity"):
+    return len(os.sched_getaffinity(0))
+
+  # Linux reports the affinity mask as e.g. "Cpus_allowed_list:  0-3,6".
+  try:
+    status = open("/proc/self/status")
+    try:
+      for line in status:
+        if line.startswith("Cpus_allowed_list:"):
+          count = 0
+          for part in line.split(":", 1)[1].strip().split(","):
+            bounds = part.split("-")
+            count = count + int(bounds[-1]) - int(bounds[0]) + 1
+          return count
+    finally:
+      status.close()
+  except (IOError, ValueError):
+    pass
+
+  return multiprocessing.cpu_count()
+
+def _parse_pool(value):
+  """Parses a --pool option of the form NAME=CAPACITY."""
+
+  parts = value.split("=", 1)
+  if len(parts) != 2 or not parts[0].replace("_", "").isalnum():
+    raise UsageError("--pool: Expected NAME=CAPACITY, got: %s" % value)
+  try:
+    capacity = int(parts[1])
+  except ValueError:
+    raise UsageError("--pool: Capacity must be an integer: %s" % value)
+  if capacity < 1:
+    raise UsageError("--pool: Capacity must be positive: %s" % value)
+  return parts[0], capacity
+
+def _parse_size(value):
+  """Parses a --cas-size option:  a number of bytes, optionally followed by K,
+  M or G."""
+
+  multiplier = 1
+  for suffix, size in [("K", 1 << 10), ("M", 1 << 20), ("G", 1 << 30)]:
+    if value.upper().endswith(suffix):
+      value = value[:-1]
+      multiplier = size
+      break
+  try:
+    result = int(value) * multiplier
+  except ValueError:
+    raise UsageError("--cas-size: Expected a size like 500M, got: %s" % value)
+  if result < 0:
+    raise UsageError("--cas-size: Size must not be negative: %s" % value)
+  return result
+
+def _configured_pools(config):
+  """Returns the pool capacities locked in by "sebs configure"."""
+
+  pools = {}
+  if config.env_dir.exists("$pools"):
+    for pool in config.env_dir.read("$pools").split(","):
+      if pool != "":
+        name, capacity = _parse_pool(pool)
+        pools[name] = capacity
+  return pools
+
+def _import_pickle(obj, filename):
+  """Moves the contents of a pickle written by older versions of SEBS into
+  |obj|, which keeps them in cache.db from now on."""
+
   if os.path.exists(filename):
     db = open(filename, "rb")
-    obj.restore(cPickle.load(db))
-    db.close()
-
-def _save_pickle(obj, filename):
-  db = open(filename, "wb")
-  cPickle.dump(obj.save(), db, cPickle.HIGHEST_PROTOCOL)
-  db.close()
+    try:
+      obj.import_state(cPickle.load(db))
+    finally:
+      db.close()
+    os.remove(filename)
 
 # ====================================================================
 
 def configure(config, argv):
   try:
-    opts, args = getopt.getopt(argv[1:], "C:o", [])
+    opts, args = getopt.getopt(argv[1:], "C:o", ["pool="])
   except getopt.error, message:
     raise UsageError(message)
 
   output = False
   mappings = {}
+  pools = {}
   for name, value in opts:
     if name == "-C":
       parts = value.split("=", 1)
@@ -132,6 +213,9 @@ def configure(config, argv):
         mappings[parts[0]] = parts[1]
     elif name == "-o":
       output = True
+    elif name == "--pool":
+      pool_name, capacity = _parse_pool(value)
+      pools[pool_name] = capacity
 
   if output:
     if config.env_dir.exists("$mappings"):
@@ -141,6 +225,9 @@ def configure(config, argv):
           continue
         print "-C" + mapping
 
+    for pool_name, capacity in sorted(_configured_pools(config).items()):
+      print "--pool=%s=%d" % (pool_name, capacity)
+
     if config.env_dir.exists("$config"):
       locked_vars = config.env_dir.read("$config").split(",")
     else:
@@ -187,71 +274,219 @@ def configure(config, argv):
     config.env_dir.write("$mappings",
         ":".join(["=".join(mapping) for mapping in mappings.items()]))
 
+    config.env_dir.write("$pools",
+        ",".join(["%s=%d" % pool for pool in sorted(pools.items())]))
+
 # --------------------------------------------------------------------
 
+def _build_with_threads(builder, runner, threads, console):
+  thread_objects = []
+  for i in range(0, threads):
+    thread_objects.append(
+      threading.Thread(target = builder.build, args = [runner]))
+    thread_objects[-1].start()
+  try:
+    for thread in thread_objects:
+      # A join() without a timeout can't be interrupted by ctrl+C.
+      while thread.isAlive():
+        thread.join(1)
+  except KeyboardInterrupt:
+    if not builder.failed:
+      console.write(ColoredText(ColoredText.RED, "INTERRUPTED"))
+    builder.cancel()
+    runner.cancel()
+    for thread in thread_objects:
+      thread.join()
+
 def build(config, argv):
   try:
-    opts, args = getopt.getopt(argv[1:], "vj:", [])
+    opts, args = getopt.getopt(argv[1:], "vj:kl:",
+                               ["schedule=", "pool=", "event-loop",
+                                "spawn-helper", "hash=", "cas-dir=",
+                                "cas-size=", "remote-cache=",
+                                "remote-upload", "lazy-outputs"])
   except getopt.error, message:
     raise UsageError(message)
 
   runner = None
   caching_runner = None
+  database = None
   verbose = False
   console = make_console(sys.stdout)
   threads = 1
+  schedule = "critical-path"
+  keep_going = False
+  max_load = None
+  pools = _configured_pools(config)
+  use_event_loop = False
+  use_spawn_helper = False
+  spawn_helper = None
+  worker_pool = None
+  hash_algorithm = "md5"
+  digest_cache = None
+  cas_dir = None
+  cas_size = ContentStore.DEFAULT_MAX_SIZE
+  store = None
+  remote_url = None
+  remote_upload = False
+  remote = None
+  lazy_outputs = False
 
   for name, value in opts:
     if name == "-v":
       verbose = True
     elif name == "-j":
-      threads = int(value)
+      if value == "auto":
+        threads = _available_cpus()
+      else:
+        threads = int(value)
+    elif name == "-k":
+      keep_going = True
+    elif name == "-l":
+      max_load = float(value)
+      try:
+        os.getloadavg()
+      except (AttributeError, OSError):
+        raise UsageError("-l: Load average is not available on this system.")
+    elif name == "--schedule":
+      if value not in Builder.SCHEDULES:
+        raise UsageError("Unknown schedule: %s  (choices: %s)" %
+                         (value, ", ".join(Builder.SCHEDULES)))
+      schedule = value
+    elif name == "--pool":
+      pool_name, capacity = _parse_pool(value)
+      pools[pool_name] = capacity
+    elif name == "--event-loop":
+      use_event_loop = True
+    elif name == "--spawn-helper":
+      use_spawn_helper = True
+    elif name == "--hash":
+      if value not in DigestCache.ALGORITHMS:
+        raise UsageError("Unknown hash algorithm: %s  (choices: %s)" %
+                         (value, ", ".join(DigestCache.ALGORITHMS)))
+      hash_algorithm = value
+    elif name == "--cas-dir":
+      cas_dir = value
+    elif name == "--cas-size":
+      cas_size = _parse_size(value)
+    elif name == "--remote-cache":
+      remote_url = value
+    elif name == "--remote-upload":
+      remote_upload = True
+    elif name == "--lazy-outputs":
+      lazy_outputs = True
+
+  if remote_upload and remote_url is None:
+    raise UsageError("--remote-upload requires --remote-cache.")
+  if lazy_outputs and cas_dir is None and remote_url is None:
+    raise UsageError("--lazy-outputs requires --cas-dir or --remote-cache.")
+
+  if use_spawn_helper:
+    # Must happen before we load anything, so that the helper's heap stays
+    # small.  See spawner.py.  If we exit without closing it, the helper
+    # notices and exits too.
+    spawn_helper = SpawnHelper()
 
   if runner is None:
-    runner = SubprocessRunner(console, verbose)
-    caching_runner = CachingRunner(runner, console)
+    worker_pool = WorkerPool()
+    runner = SubprocessRunner(console, verbose, spawn_helper, worker_pool)
+    # Note that all configurations share a common cache.db.
+    database = KeyValueStore("cache.db")
+    # Changing the algorithm invalidates everything cached, since action
+    # hashes computed with different algorithms never match.
+    digest_cache = DigestCache(hash_algorithm, threads, config.stat_cache,
+                               database)
+    _import_pickle(digest_cache, "digests.pickle")
+    if cas_dir is not None:
+      store = ContentStore(cas_dir, digest_cache, cas_size)
+    if remote_url is not None:
+      try:
+        remote = RemoteCache(remote_url, digest_cache, remote_upload)
+      except RemoteError, error:
+        raise UsageError(error.message)
+    caching_runner = CachingRunner(runner, console, digest_cache, store,
+                                   remote, lazy_outputs, database,
+                                   config.stat_cache)
     runner = caching_runner
 
-    # Note that all configurations share a common cache.pickle.
-    _restore_pickle(caching_runner, "cache.pickle")
+  timings = ActionTimings(database)
+  if database is not None:
+    _import_pickle(timings, "timings.pickle")
+
+  # Lets the builder tell which actions' definitions changed, rather than
+  # rebuilding everything defined by a modified SEBS file.
+  action_keys = None
+  depfile_cache = None
+  include_cache = None
+  if database is not None:
+    action_keys = database.table("action keys")
+    depfile_cache = DepFileCache(database, config.stat_cache)
+    include_cache = IncludeCache(database, config.stat_cache)
 
   loader = Loader(config.root_dir)
-  builder = Builder(console)
+  builder = Builder(console, timings, schedule, keep_going, max_load,
+                    pools, action_keys, config.stat_cache, depfile_cache,
+                    include_cache)
 
+  rules = list(_args_to_rules(loader, args))
   if argv[0] == "test":
-    for rule in _args_to_rules(loader, args):
-      if isinstance(rule, Test):
-        builder.add_test(config, rule)
+    rules = [rule for rule in rules if isinstance(rule, Test)]
+  # Warm up the stat cache in parallel before the (serial) dirty checks.
+  builder.prefetch(config, rules)
+
+  if argv[0] == "test":
+    for rule in rules:
+      builder.add_test(config, rule)
   else:
-    for rule in _args_to_rules(loader, args):
+    for rule in rules:
       builder.add_rule(config, rule)
 
-  thread_objects = []
-  success = True
-  for i in range(0, threads):
-    thread_objects.append(
-      threading.Thread(target = builder.build, args = [runner]))
-    thread_objects[-1].start()
   try:
-    for thread in thread_objects:
-      thread.join()
-  except KeyboardInterrupt:
-    if not builder.failed:
-      console.write(ColoredText(ColoredText.RED, "INTERRUPTED"))
-      builder.failed = True
-    for thread in thread_objects:
-      thread.join()
+    if use_event_loop:
+      # Run all actions from this thread; -j is the number of actions which
+      # may run at once.
+      event_loop = EventLoop()
+      try:
+        builder.build_event_loop(runner, event_loop, threads)
+      finally:
+        event_loop.close()
+    else:
+      _build_with_threads(builder, runner, threads, console)
   finally:
-    _save_pickle(caching_runner, "cache.pickle")
-
-  if builder.failed:
+    if spawn_helper is not None:
+      spawn_helper.close()
+    if worker_pool is not None:
+      worker_pool.close()
+    if remote is not None:
+      errors = remote.close()
+      if len(errors) > 0:
+        console.write([ColoredText(ColoredText.YELLOW, "WARNING: "),
+                       "%d upload(s) to the remote cache failed:  %s" %
+                       (len(errors), errors[0])])
+    if store is not None:
+      store.close()
+    if digest_cache is not None:
+      digest_cache.close()
+    if database is not None:
+      database.close()
+
+  if builder.failed and not keep_going:
     return 1
 
+  result = 0
   if argv[0] == "test":
     if not builder.print_test_results():
-      return 1
-
-  return 0
+      result = 1
+  if not builder.print_failures():
+    result = 1
+  if caching_runner is not None:
+    caching_runner.print_stats()
+  if verbose:
+    lookups, stat_calls = config.stat_cache.stats()
+    console.write("%d file stat(s) requested, %d stat() call(s) saved." %
+                  (lookups, lookups - stat_calls))
+
+  return result
 
 # --------------------------------------------------------------------
 
@@ -309,8 +544,10 @@ def clean(config, argv):
   # would never be necessary.  So we nuke it.
   # TODO(kenton):  We could load the cache and remove only the entries that
   #   are specific to the configs being cleaned.
-  if os.path.exists("cache.pickle"):
-    os.remove("cache.pickle")
+  for filename in [ "cache.db", "cache.db-wal", "cache.db-shm",
+                    "digests.pickle", "timings.pickle" ]:
+    if os.path.exists(filename):
+      os.remove(filename)
 
   for linked_config in config.get_all_linked_configs():
     if linked_config.name is None:
@@ -320,6 +557,49 @@ def clean(config, argv):
 
     linked_config.clean(expunge = expunge)
 
+# --------------------------------------------------------------------
+
+def cache_server(config, argv):
+  try:
+    opts, args = getopt.getopt(argv[1:], "v", ["port=", "bind=", "read-only"])
+  except getopt.error, message:
+    raise UsageError(message)
+
+  port = CacheServer.DEFAULT_PORT
+  bind = ""
+  read_only = False
+  verbose = False
+
+  for name, value in opts:
+    if name == "-v":
+      verbose = True
+    elif name == "--port":
+      try:
+        port = int(value)
+      except ValueError:
+        raise UsageError("--port: Expected a number: %s" % value)
+    elif name == "--bind":
+      bind = value
+    elif name == "--read-only":
+      read_only = True
+
+  if len(args) != 1:
+    raise UsageError("cache-server: Expected one directory.")
+
+  server = CacheServer(args[0], (bind, port), read_only, verbose)
+  host, port = server.server_address[:2]
+  if read_only:
+    mode = "read-only"
+  else:
+    mode = "writable"
+  print "Serving %s cache from %s at http://%s:%d/" % \
+      (mode, args[0], host, port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
+
 # ====================================================================
 
 def main(argv):
@@ -337,7 +617,9 @@ def main(argv):
     elif name in ("-c", "--config"):
       output_path = value
 
-  config = Configuration(output_path)
+  # Within one run, files only change when we change them (or an action we
+  # run does), so their metadata can be cached.
+  config = Configuration(output_path, stat_cache = StatCache())
 
   if len(args) == 0:
     raise UsageError("Missing command.")
@@ -351,11 +633,13 @@ def main(argv):
       return script(config, args)
     elif args[0] == "clean":
       return clean(config, args)
+    elif args[0] == "cache-server":
+      return cache_server(config, args)
     else:
       raise UsageError("Unknown command: %s" % args[0])
   finally:
     for linked_config in config.get_all_linked_configs():
-      linked_config.save()
+      linked_config.close()
 
 if __name__ == "__main__":
   try:
@@ -34,13 +34,20 @@
 
 Usage:
   make_py_binary.py -m MAIN_MODULE -o PARFILE [-p PYTHONPATH] SOURCE_FILES
+  make_py_binary.py --persistent_worker
+
+With --persistent_worker, reads requests from stdin and runs each one as if
+it were a separate invocation.  See sebs/workers.py for the protocol.
 """
 
+import cStringIO
 import getopt
+import json
 import os
 import stat
 import sys
 import tempfile
+import traceback
 import zipfile
 
 class UsageError(Exception):
@@ -48,7 +55,7 @@ class UsageError(Exception):
 
 def main(argv):
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "hm:o:p:", ["--help"])
+    opts, args = getopt.getopt(argv[1:], "hm:o:p:", ["--help"])
   except getopt.error, message:
     raise UsageError(message)
 
@@ -103,10 +110,48 @@ def main(argv):
 
   file.close()
 
-if __name__ == "__main__":
+def run(argv):
+  """Like running the program with the given command line; returns the exit
+  code."""
   try:
-    sys.exit(main(sys.argv))
+    return main(argv) or 0
   except UsageError, error:
     print >>sys.stderr, error.message
     print >>sys.stderr, "for help use --help"
-    sys.exit(2)
+    return 2
+
+def serve_persistent_worker(argv0):
+  # Keep the real stdout for responses, and point file descriptor 1 at stderr
+  # so that nothing else can corrupt the stream.
+  responses = os.fdopen(os.dup(1), "w")
+  os.dup2(2, 1)
+
+  while True:
+    line = sys.stdin.readline()
+    if line == "":
+      return 0
+    request = json.loads(line)
+
+    output = cStringIO.StringIO()
+    sys.stdout = output
+    sys.stderr = output
+    try:
+      try:
+        exit_code = run([argv0] + request["arguments"])
+      except:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+      sys.stdout = sys.__stdout__
+      sys.stderr = sys.__stderr__
+
+    responses.write(json.dumps({
+        "exit_code": exit_code,
+        "output": output.getvalue().decode("utf-8", "replace")}) + "\n")
+    responses.flush()
+
+if __name__ == "__main__":
+  if sys.argv[1:] == ["--persistent_worker"]:
+    sys.exit(serve_persistent_worker(sys.argv[0]))
+  else:
+    sys.exit(run(sys.argv))
@@ -0,0 +1,428 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+A build cache shared over HTTP, so that developers and CI machines can reuse
+each other's action outputs.
+
+The protocol is deliberately dumb, so that any HTTP server which supports GET,
+HEAD and PUT of static files could stand in for the bundled one:
+  /ac/KEY:      A JSON object mapping each output's name to a list
+                [DIGEST, EXECUTABLE] for the action whose key (as computed by
+                CachingRunner) is KEY.
+  /cas/DIGEST:  File contents, named by digest.
+Keys and digests are in hex.  A missing entry is a 404.  Clients upload an
+action's blobs before its entry, so an entry's blobs should always exist, but
+clients verify every blob they download anyway -- a cache must never be
+trusted to produce correct outputs.
+
+"sebs cache-server" serves a local directory this way.  Typically CI builds
+with --remote-upload against a writable server while developers only read;
+a server started with --read-only refuses all uploads.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import binascii
+import errno
+import httplib
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from sebs.digest import DigestCache
+from sebs.helpers import typecheck
+
+# Paths served by CacheServer.
+_PATH_PATTERN = re.compile("^/(ac|cas)/([0-9a-f]+)$")
+
+class RemoteError(Exception):
+  pass
+
+def _makedirs(path):
+  try:
+    os.makedirs(path)
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+
+class RemoteCache(object):
+  """Client for a remote cache at the given http:// URL.  Thread-safe.  Keeps
+  a pool of persistent connections, fetches an action's blobs in parallel, and
+  uploads in the background; close() waits for uploads to finish.
+
+  Once the server can't be reached, the cache gives up on it:  every later
+  request fails immediately, and nothing more is uploaded.  Otherwise an
+  unreachable server would cost a timeout per action."""
+
+  # Seconds to wait on the server before giving up on a request.
+  TIMEOUT = 30
+
+  # Maximum number of simultaneous requests.
+  DEFAULT_CONNECTIONS = 8
+
+  def __init__(self, url, digest_cache, upload = False,
+               connections = DEFAULT_CONNECTIONS):
+    typecheck(url, basestring)
+    typecheck(digest_cache, DigestCache)
+    typecheck(upload, bool)
+    typecheck(connections, int)
+
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme != "http" or not parsed.hostname:
+      raise RemoteError("Remote cache URL must be http://HOST[:PORT][/PATH]: "
+                        "%s" % url)
+
+    self.__url = url
+    self.__host = parsed.hostname
+    self.__port = parsed.port
+    self.__prefix = parsed.path.rstrip("/")
+    self.__digest_cache = digest_cache
+    self.__upload = upload
+
+    self.__pool = ThreadPool(connections)
+    # Idle connections.  Guarded by __lock, as is __uploads, the AsyncResults
+    # of uploads which have been started.
+    self.__connections = []
+    self.__uploads = []
+    # The RemoteError which made us give up on the server, if any.  Also
+    # guarded by __lock.
+    self.__failure = None
+    self.__lock = threading.Lock()
+
+  def close(self):
+    """Waits for pending uploads and shuts down.  Returns a list of error
+    messages for uploads which failed."""
+
+    self.__lock.acquire()
+    try:
+      uploads = self.__uploads
+      self.__uploads = []
+    finally:
+      self.__lock.release()
+
+    errors = []
+    for upload in uploads:
+      try:
+        upload.get()
+      except RemoteError, e:
+        errors.append(str(e))
+
+    self.__pool.close()
+    self.__pool.join()
+
+    self.__lock.acquire()
+    try:
+      for connection in self.__connections:
+        connection.close()
+      self.__connections = []
+    finally:
+      self.__lock.release()
+
+    return errors
+
+  def available(self):
+    """Returns false once we've given up on the server."""
+
+    self.__lock.acquire()
+    try:
+      return self.__failure is None
+    finally:
+      self.__lock.release()
+
+  def get_action(self, key):
+    """Returns the outputs recorded for the given action key as a dict mapping
+    names to (digest, executable), or None if there is no such entry.  Raises
+    RemoteError if the server can't be reached."""
+
+    typecheck(key, str)
+
+    status, body = self.__request("GET", "/ac/" + binascii.hexlify(key))
+    if status == httplib.NOT_FOUND:
+      return None
+    elif status != httplib.OK:
+      raise RemoteError("%s: GET of action entry failed with HTTP status %d" %
+                        (self.__url, status))
+
+    try:
+      entry = json.loads(body)
+      result = {}
+      for name, (digest, executable) in entry.items():
+        result[str(name)] = (str(digest), bool(executable))
+    except (ValueError, TypeError, AttributeError, UnicodeError):
+      raise RemoteError("%s: Malformed action entry." % self.__url)
+    return result
+
+  def get_blobs(self, digests):
+    """Downloads the given blobs in parallel and returns their contents, in the
+    same order.  Raises RemoteError if any is missing or doesn't match its
+    digest."""
+
+    typecheck(digests, list, str)
+
+    return self.__pool.map(self.__get_blob, digests)
+
+  def put_action(self, key, outputs, files = None):
+    """Starts uploading the outputs of the action with the given key.
+    |outputs| maps each output's name to a tuple (content, executable).
+    |files| is like |outputs| but gives the path of each file instead of its
+    content; files are only read once their upload runs, so that queued
+    uploads don't hold them in memory.  A file which has changed by then is
+    not uploaded.  Does nothing unless the cache was opened with upload =
+    True, or once we've given up on the server.  Raises OSError or IOError if
+    a file can't be read."""
+
+    typecheck(key, str)
+    typecheck(outputs, dict)
+    typecheck(files, dict)
+
+    if not self.__upload or not self.available():
+      return
+
+    # Maps each digest to (path, content), one of which is None.
+    blobs = {}
+    entry = {}
+    for name, (content, executable) in outputs.items():
+      hasher = self.__digest_cache.new_hasher()
+      hasher.update(content)
+      digest = hasher.hexdigest()
+      blobs[digest] = (None, content)
+      entry[name] = [digest, executable]
+    if files is not None:
+      for name, (path, executable) in files.items():
+        digest = binascii.hexlify(self.__digest_cache.digest(path))
+        blobs[digest] = (path, None)
+        entry[name] = [digest, executable]
+
+    upload = self.__pool.apply_async(self.__put_action, (key, blobs, entry))
+    self.__lock.acquire()
+    try:
+      self.__uploads.append(upload)
+    finally:
+      self.__lock.release()
+
+  # ------------------------------------------------------------------
+
+  def __get_blob(self, digest):
+    status, body = self.__request("GET", "/cas/" + digest)
+    if status != httplib.OK:
+      raise RemoteError("%s: GET of blob %s failed with HTTP status %d" %
+                        (self.__url, digest, status))
+    hasher = self.__digest_cache.new_hasher()
+    hasher.update(body)
+    if hasher.hexdigest() != digest:
+      raise RemoteError("%s: Blob %s does not match its digest." %
+                        (self.__url, digest))
+    return body
+
+  def __put_action(self, key, blobs, entry):
+    for digest, (disk_path, content) in blobs.items():
+      path = "/cas/" + digest
+      status, body = self.__request("HEAD", path)
+      if status == httplib.OK:
+        continue
+      if content is None:
+        try:
+          file = open(disk_path, "rb")
+          try:
+            content = file.read()
+          finally:
+            file.close()
+        except IOError, e:
+          raise RemoteError("%s: Couldn't upload %s: %s" %
+                            (self.__url, disk_path, e))
+        hasher = self.__digest_cache.new_hasher()
+        hasher.update(content)
+        if hasher.hexdigest() != digest:
+          raise RemoteError("%s: %s changed before it could be uploaded." %
+                            (self.__url, disk_path))
+      self.__put(path, content)
+      # Don't hold on to it while uploading the rest.
+      content = None
+
+    # Only now that the blobs are all there can the entry refer to them.
+    self.__put("/ac/" + binascii.hexlify(key), json.dumps(entry))
+
+  def __put(self, path, content):
+    status, body = self.__request("PUT", path, content)
+    if status not in (httplib.OK, httplib.CREATED, httplib.NO_CONTENT):
+      raise RemoteError("%s: PUT of %s failed with HTTP status %d" %
+                        (self.__url, path, status))
+
+  def __request(self, method, path, body = None):
+    """Makes a request over a pooled connection and returns (status, body).
+    If the server can't be reached, gives up on it."""
+
+    while True:
+      connection = None
+      self.__lock.acquire()
+      try:
+        if self.__failure is not None:
+          raise self.__failure
+        if len(self.__connections) > 0:
+          connection = self.__connections.pop()
+      finally:
+        self.__lock.release()
+      reused = connection is not None
+      if not reused:
+        connection = httplib.HTTPConnection(self.__host, self.__port,
+                                            timeout = RemoteCache.TIMEOUT)
+
+      try:
+        headers = {}
+        if body is not None:
+          headers["Content-Type"] = "application/octet-stream"
+        connection.request(method, self.__prefix + path, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+      except (httplib.HTTPException, socket.error), e:
+        connection.close()
+        if reused:
+          # The server probably closed the idle connection.  Try a new one.
+          continue
+        failure = RemoteError("%s: %s" % (self.__url, e))
+        self.__lock.acquire()
+        try:
+          if self.__failure is None:
+            self.__failure = failure
+        finally:
+          self.__lock.release()
+        raise failure
+
+      if response.will_close:
+        connection.close()
+      else:
+        self.__lock.acquire()
+        try:
+          self.__connections.append(connection)
+        finally:
+          self.__lock.release()
+      return (response.status, data)
+
+# ====================================================================
+
+class _CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # Keep connections alive between requests.
+  protocol_version = "HTTP/1.1"
+
+  def do_GET(self):
+    self.__get(send_body = True)
+
+  def do_HEAD(self):
+    self.__get(send_body = False)
+
+  def do_PUT(self):
+    # Always consume the body, so that the connection can be reused.
+    length = int(self.headers.get("Content-Length", "0"))
+    content = self.rfile.read(length)
+
+    path = self.__disk_path()
+    if path is None:
+      self.__respond(httplib.NOT_FOUND)
+    elif self.server.read_only:
+      self.__respond(httplib.FORBIDDEN)
+    else:
+      fd, temp_path = tempfile.mkstemp(dir = self.server.temp_dir)
+      try:
+        os.write(fd, content)
+      finally:
+        os.close(fd)
+      _makedirs(os.path.dirname(path))
+      os.rename(temp_path, path)
+      self.__respond(httplib.CREATED)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def __get(self, send_body):
+    path = self.__disk_path()
+    content = None
+    if path is not None:
+      try:
+        file = open(path, "rb")
+        try:
+          content = file.read()
+        finally:
+          file.close()
+      except IOError:
+        pass
+
+    if content is None:
+      self.__respond(httplib.NOT_FOUND)
+    else:
+      self.send_response(httplib.OK)
+      self.send_header("Content-Type", "application/octet-stream")
+      self.send_header("Content-Length", str(len(content)))
+      self.end_headers()
+      if send_body:
+        self.wfile.write(content)
+
+  def __respond(self, status):
+    self.send_response(status)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def __disk_path(self):
+    match = _PATH_PATTERN.match(self.path)
+    if match is None:
+      return None
+    kind, name = match.groups()
+    return os.path.join(self.server.path, kind, name[:2], name)
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Serves a remote cache from the given directory.  Call serve_forever() to
+  run it, and shutdown() (from another thread) to stop."""
+
+  DEFAULT_PORT = 8080
+
+  daemon_threads = True
+
+  def __init__(self, path, address = ("", DEFAULT_PORT), read_only = False,
+               verbose = False):
+    typecheck(path, basestring)
+    typecheck(address, tuple)
+    typecheck(read_only, bool)
+    typecheck(verbose, bool)
+
+    self.path = path
+    self.temp_dir = os.path.join(path, "temp")
+    self.read_only = read_only
+    self.verbose = verbose
+    _makedirs(self.temp_dir)
+
+    BaseHTTPServer.HTTPServer.__init__(self, address, _CacheRequestHandler)
@@ -0,0 +1,153 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from sebs.digest import DigestCache
+from sebs.remote import CacheServer, RemoteCache, RemoteError
+
+class RemoteCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+    shutil.rmtree(self.tempdir)
+
+  def start_server(self, read_only = False):
+    server = CacheServer(self.tempdir, ("127.0.0.1", 0), read_only)
+    # A short poll interval makes shutdown() quick.
+    thread = threading.Thread(target = server.serve_forever, args = (0.05,))
+    thread.daemon = True
+    thread.start()
+    self.servers.append(server)
+    return "http://127.0.0.1:%d/" % server.server_address[1]
+
+  def testRoundTrip(self):
+    url = self.start_server()
+    digest_cache = DigestCache()
+
+    client = RemoteCache(url, digest_cache, upload = True)
+    self.assertEqual(None, client.get_action("key"))
+    client.put_action("key", {"foo": ("foo content", True),
+                              "bar": ("bar content", False)})
+    self.assertEqual([], client.close())
+
+    client = RemoteCache(url, digest_cache)
+    entry = client.get_action("key")
+    self.assertEqual(["bar", "foo"], sorted(entry.keys()))
+    self.assertTrue(entry["foo"][1])
+    self.assertFalse(entry["bar"][1])
+    self.assertEqual(["foo content", "bar content"],
+                     client.get_blobs([entry["foo"][0], entry["bar"][0]]))
+    client.close()
+
+    # Files are read when they're uploaded.
+    path = os.path.join(self.tempdir, "file")
+    file = open(path, "wb")
+    file.write("file content")
+    file.close()
+    client = RemoteCache(url, digest_cache, upload = True)
+    client.put_action("files", {"foo": ("foo content", False)},
+                      {"file": (path, True)})
+    self.assertEqual([], client.close())
+    client = RemoteCache(url, digest_cache)
+    entry = client.get_action("files")
+    self.assertEqual(["file content"], client.get_blobs([entry["file"][0]]))
+    self.assertTrue(entry["file"][1])
+
+    # Reading clients don't upload.
+    client.put_action("other", {"foo": ("foo content", False)})
+    self.assertEqual([], client.close())
+    client = RemoteCache(url, digest_cache)
+    self.assertEqual(None, client.get_action("other"))
+    client.close()
+
+  def testReadOnlyServer(self):
+    url = self.start_server(read_only = True)
+    client = RemoteCache(url, DigestCache(), upload = True)
+    client.put_action("key", {"foo": ("foo content", False)})
+    self.assertEqual(1, len(client.close()))
+
+    client = RemoteCache(url, DigestCache())
+    self.assertEqual(None, client.get_action("key"))
+    client.close()
+
+  def testCorruptBlob(self):
+    url = self.start_server()
+    client = RemoteCache(url, DigestCache(), upload = True)
+    client.put_action("key", {"foo": ("foo content", False)})
+    self.assertEqual([], client.close())
+
+    client = RemoteCache(url, DigestCache())
+    digest = client.get_action("key")["foo"][0]
+    file = open(os.path.join(self.tempdir, "cas", digest[:2], digest), "wb")
+    file.write("evil content")
+    file.close()
+    self.assertRaises(RemoteError, client.get_blobs, [digest])
+
+    os.remove(os.path.join(self.tempdir, "cas", digest[:2], digest))
+    self.assertRaises(RemoteError, client.get_blobs, [digest])
+    client.close()
+
+  def testUnreachable(self):
+    # Find a port nobody is listening on.
+    server = CacheServer(self.tempdir, ("127.0.0.1", 0))
+    url = "http://127.0.0.1:%d/" % server.server_address[1]
+    server.server_close()
+    client = RemoteCache(url, DigestCache(), upload = True)
+    self.assertTrue(client.available())
+    self.assertRaises(RemoteError, client.get_action, "key")
+
+    # Having failed once, the client gives up on the server, even if it comes
+    # back:  later requests fail without trying, and uploads are dropped.
+    self.assertFalse(client.available())
+    server = CacheServer(self.tempdir, server.server_address)
+    self.assertRaises(RemoteError, client.get_action, "key")
+    client.put_action("key", {"foo": ("foo content", False)})
+    self.assertEqual([], client.close())
+    server.server_close()
+
+    self.assertRaises(RemoteError, RemoteCache, "ftp://example.com/",
+                      DigestCache())
+
+if __name__ == "__main__":
+  unittest.main()
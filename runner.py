@@ -29,18 +29,26 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import binascii
 import cStringIO
-import md5
 import os
-import subprocess
 import tempfile
+import threading
 import signal
+import time
 
+from sebs.cas import ContentStore, link_or_copy
 from sebs.core import Action, Artifact, ContentToken, DefinitionError
-from sebs.filesystem import Directory
+from sebs.filesystem import Directory, StatCache
 from sebs.helpers import typecheck
+from sebs.kvstore import KeyValueStore
+from sebs.remote import RemoteCache, RemoteError
 from sebs.command import CommandContext, Command, ArtifactEnumerator
 from sebs.console import ColoredText
+from sebs.digest import DigestCache
+from sebs.eventloop import SubprocessRequest, run_synchronously
+from sebs.spawner import SpawnHelper
+from sebs.workers import WorkerPool
 
 class ActionRunner(object):
   """Abstract interface for an object which can execute actions."""
@@ -49,23 +57,141 @@ class ActionRunner(object):
     pass
 
   def run(self, action, inputs, disk_inputs, outputs, test_result, config,
-          real_name_map, lock):
+          real_name_map):
     """Executes the given action.  Returns true if the command succeeds, false
     if it fails.  |inputs| and |outputs| are lists of artifacts that are the
     inputs and outputs of this action, as determined by calling
     enumerate_artifacts on the command.
 
+    The Builder calls this from several threads at once without holding any
+    lock, so implementations must be thread-safe.
+
+    Runners must override either this or run_async().  The default
+    implementation runs run_async() to completion.
+
     TODO(kenton):  Too many arguments, need to organize better."""
-    raise NotImplementedError
+    return run_synchronously(self.run_async(
+        action, inputs, disk_inputs, outputs, test_result, config,
+        real_name_map))
+
+  def run_async(self, action, inputs, disk_inputs, outputs, test_result,
+                config, real_name_map):
+    """Like run(), but written as a generator in the same style as
+    Command.run_async(), for use with Builder.build_event_loop().  The default
+    implementation simply calls run()."""
+    if self.run.im_func is ActionRunner.run.im_func:
+      raise NotImplementedError
+    yield self.run(action, inputs, disk_inputs, outputs, test_result, config,
+                   real_name_map)
+
+  def cancel(self):
+    """Called (from any thread) when the build is being abandoned, e.g.
+    because an action failed or the user hit ctrl+C.  Should make the actions
+    currently running stop as soon as possible; run() and run_async() may
+    then raise KeyboardInterrupt.  Must not block for long.  The default
+    implementation does nothing."""
+    pass
+
+  def materialize(self, config, names):
+    """Makes sure that the files with the given real names, which are outputs
+    of actions this runner has run, actually exist on disk.  A runner may
+    report an action as successful without writing its outputs until
+    something needs them; the Builder calls this for outputs it must read and
+    for outputs the user asked for.  Returns false (after reporting the
+    problem) if the outputs can't be produced.  The default implementation
+    does nothing."""
+    return True
+
+  def unchanged_outputs(self, config, names):
+    """Called by the Builder right after an action succeeds, with the real
+    names of its outputs.  Returns those of them whose content the action left
+    exactly as it was before it ran, so that the Builder need not rebuild
+    anything on their account.  The default implementation returns an empty
+    list, i.e. every output is assumed to have changed."""
+    return []
+
+class _ProcessGroups(object):
+  """Tracks the subprocesses started by a SubprocessRunner.  Each one leads its
+  own process group, so that signalling the group also reaches anything the
+  process itself started (e.g. the compiler proper started by gcc).  A side
+  effect is that ctrl+C no longer reaches subprocesses directly; SEBS kills
+  them itself."""
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__processes = set()
+    self.__cancelled = False
+
+  def add(self, proc):
+    self.__lock.acquire()
+    try:
+      self.__processes.add(proc)
+      cancelled = self.__cancelled
+    finally:
+      self.__lock.release()
+    if cancelled:
+      # Started just as the build was cancelled.
+      _signal_group(proc, signal.SIGTERM)
+
+  def remove(self, proc):
+    self.__lock.acquire()
+    try:
+      self.__processes.discard(proc)
+    finally:
+      self.__lock.release()
+
+  def cancel(self):
+    """Marks the build cancelled.  Returns false if it already was."""
+    self.__lock.acquire()
+    try:
+      result = not self.__cancelled
+      self.__cancelled = True
+      return result
+    finally:
+      self.__lock.release()
+
+  def signal_all(self, signum):
+    """Sends the given signal to every tracked process group.  Returns the
+    number signalled.  (So with signal 0, this just counts them.)"""
+    self.__lock.acquire()
+    try:
+      processes = [ proc for proc in self.__processes
+                    if proc.returncode is None ]
+    finally:
+      self.__lock.release()
+    for proc in processes:
+      _signal_group(proc, signum)
+    return len(processes)
+
+  def check_interrupted(self, returncode):
+    """Raises KeyboardInterrupt if a subprocess with the given exit code was
+    stopped by ctrl+C or by cancellation."""
+    if returncode == -signal.SIGINT or \
+       (self.__cancelled and returncode != 0):
+      raise KeyboardInterrupt
+
+def _signal_group(proc, signum):
+  # Popen sets returncode once it has waited for the process, after which the
+  # process ID (and so the process group ID) may be reused.
+  if proc.returncode is None:
+    try:
+      os.killpg(proc.pid, signum)
+    except OSError:
+      pass   # Already exited.
 
 class _CommandContextImpl(CommandContext):
-  def __init__(self, working_dir, pending_message, verbose, real_name_map,lock):
+  def __init__(self, working_dir, pending_message, verbose, real_name_map,
+               spawn_helper = None, worker_pool = None, process_groups = None):
     self.__working_dir = working_dir
     self.__temp_files_for_mem = {}
     self.__pending_message = pending_message
     self.__verbose = verbose
     self.__real_name_map = real_name_map
-    self.__lock = lock
+    self.__spawn_helper = spawn_helper
+    self.__worker_pool = worker_pool
+    if process_groups is None:
+      process_groups = _ProcessGroups()
+    self.__process_groups = process_groups
 
     self.__original_text = list(self.__pending_message.text)
     self.__verbose_text = []
@@ -119,33 +245,56 @@ class _CommandContextImpl(CommandContext):
       self.__working_dir.write(filename, content)
 
   def subprocess(self, args, **kwargs):
-    if self.__verbose:
-      self.__verbose_text.append("\n  ")
-      self.__verbose_text.append(" ".join(args))
-      self.__pending_message.update(self.__original_text + self.__verbose_text)
-    if "stdin" in kwargs and isinstance(kwargs["stdin"], str):
-      stdin_str = kwargs["stdin"]
-      kwargs["stdin"] = subprocess.PIPE
-    else:
-      stdin_str = None
-    proc = subprocess.Popen(args, **kwargs)
+    if self.__spawn_helper is not None and \
+       self.__spawn_helper.can_call(kwargs):
+      self._show_subprocess(args)
+      result = self.__spawn_helper.call(args, **kwargs)
+      self.__process_groups.check_interrupted(result[0])
+      return result
+
+    request = self.subprocess_async(args, **kwargs)
+    proc, stdin_str = request.start()
 
-    self.__lock.release()
     try:
       stdout_str, stderr_str = proc.communicate(stdin_str)
     except:
       # Kill the process if it is still running.
-      # Note:  Can't use proc.kill() because it's too new.
-      os.kill(proc.pid, signal.SIGKILL)
+      request.kill(proc)
+      proc.wait()
       raise
-    finally:
-      self.__lock.acquire()
 
-    if proc.returncode == -signal.SIGINT:
-      # Subprocess was killed due to ctrl+C.
-      raise KeyboardInterrupt
+    return request.finish(proc, stdout_str, stderr_str)
+
+  def subprocess_async(self, args, **kwargs):
+    return _SubprocessRequestImpl(self, args, kwargs)
+
+  def worker_request(self, args, inputs, env=None, cwd=None):
+    if self.__worker_pool is None:
+      return super(_CommandContextImpl, self).worker_request(
+          args, inputs, env = env, cwd = cwd)
+
+    self._show_subprocess(args)
+    result = self.__worker_pool.request(args[:1], args[1:], inputs,
+                                        env = env, cwd = cwd)
+    self.__process_groups.check_interrupted(result[0])
+    return result
+
+  def _process_started(self, proc):
+    self.__process_groups.add(proc)
 
-    return (proc.returncode, stdout_str, stderr_str)
+  def _process_finished(self, proc):
+    self.__process_groups.remove(proc)
+    self.__process_groups.check_interrupted(proc.returncode)
+
+  def _kill_process(self, proc):
+    _signal_group(proc, signal.SIGKILL)
+    self.__process_groups.remove(proc)
+
+  def _show_subprocess(self, args):
+    if self.__verbose:
+      self.__verbose_text.append("\n  ")
+      self.__verbose_text.append(" ".join(args))
+      self.__pending_message.update(self.__original_text + self.__verbose_text)
 
   def status(self, text):
     self.__original_text.append(" ")
@@ -160,6 +309,24 @@ class _CommandContextImpl(CommandContext):
       os.remove(diskfile)
     self.__temp_files_for_mem = {}
 
+class _SubprocessRequestImpl(SubprocessRequest):
+  def start(self):
+    self.context._show_subprocess(self.args)
+    if "preexec_fn" not in self.kwargs:
+      # Put the process in its own process group; see _ProcessGroups.
+      self.kwargs = dict(self.kwargs, preexec_fn = os.setpgrp)
+    proc, stdin_str = super(_SubprocessRequestImpl, self).start()
+    self.context._process_started(proc)
+    return (proc, stdin_str)
+
+  def finish(self, proc, stdout_str, stderr_str):
+    self.context._process_finished(proc)
+    return super(_SubprocessRequestImpl, self).finish(
+        proc, stdout_str, stderr_str)
+
+  def kill(self, proc):
+    self.context._kill_process(proc)
+
 def _config_prefix(config):
   if config.name is None:
     return ""
@@ -167,16 +334,53 @@ def _config_prefix(config):
     return ColoredText(ColoredText.FUCHSIA, [config.name, ": "])
 
 class SubprocessRunner(ActionRunner):
-  """An ActionRunner which actually executes the commands."""
-
-  def __init__(self, console, verbose = False):
+  """An ActionRunner which actually executes the commands.  If a SpawnHelper
+  is given, run() starts subprocesses through it where possible.  (run_async()
+  always starts them directly, since the EventLoop needs the Popen objects.)
+  If a WorkerPool is given, commands which support persistent workers use it;
+  note that worker requests block, even under run_async()."""
+
+  # How long cancel() gives subprocesses to exit after SIGTERM before sending
+  # SIGKILL.
+  TERMINATE_TIMEOUT = 2.0
+
+  def __init__(self, console, verbose = False, spawn_helper = None,
+               worker_pool = None):
+    typecheck(spawn_helper, SpawnHelper)
+    typecheck(worker_pool, WorkerPool)
     super(SubprocessRunner, self).__init__()
 
     self.__console = console
     self.__verbose = verbose
-
-  def run(self, action, inputs, disk_inputs, outputs, test_result, config,
-          real_name_map, lock):
+    self.__spawn_helper = spawn_helper
+    self.__worker_pool = worker_pool
+    self.__process_groups = _ProcessGroups()
+
+  def cancel(self):
+    if not self.__process_groups.cancel():
+      return   # Already cancelled.
+    self.__signal_all(signal.SIGTERM)
+    # Give the processes a chance to clean up, but not forever.
+    threading.Thread(target = self.__kill_stragglers).start()
+
+  def __signal_all(self, signum):
+    count = self.__process_groups.signal_all(signum)
+    if self.__spawn_helper is not None:
+      count = count + self.__spawn_helper.signal_all(signum)
+    if self.__worker_pool is not None:
+      count = count + self.__worker_pool.signal_busy(signum)
+    return count
+
+  def __kill_stragglers(self):
+    deadline = time.time() + SubprocessRunner.TERMINATE_TIMEOUT
+    while self.__signal_all(0) > 0:
+      if time.time() >= deadline:
+        self.__signal_all(signal.SIGKILL)
+        return
+      time.sleep(0.05)
+
+  def run_async(self, action, inputs, disk_inputs, outputs, test_result,
+                config, real_name_map):
     typecheck(action, Action)
 
     pending_message = self.__console.add_pending([
@@ -191,11 +395,12 @@ class SubprocessRunner(ActionRunner):
       config.root_dir.mkdir(os.path.dirname(output))
 
     context = _CommandContextImpl(
-        config.root_dir, pending_message, self.__verbose, real_name_map, lock)
+        config.root_dir, pending_message, self.__verbose, real_name_map,
+        self.__spawn_helper, self.__worker_pool, self.__process_groups)
 
     try:
       log = cStringIO.StringIO()
-      result = action.command.run(context, log)
+      result = yield action.command.run_async(context, log)
       context.resolve_mem_files()
 
       final_text = [pending_message.text]
@@ -211,8 +416,6 @@ class SubprocessRunner(ActionRunner):
 
         pending_message.finish(
             [ColoredText(ColoredText.RED, "ERROR: ")] + final_text)
-
-        return False
     except KeyboardInterrupt:
       # Like above.
       context.resolve_mem_files()
@@ -228,6 +431,12 @@ class SubprocessRunner(ActionRunner):
             [ColoredText(ColoredText.RED, "ERROR: "), pending_message.text])
       raise
 
+    # Note that we must not yield our result from inside the try block above,
+    # since closing this generator afterwards raises GeneratorExit there.
+    if not result:
+      yield False
+      return
+
     if test_result is not None:
       if context.read(test_result) == "true":
         passfail = ColoredText(ColoredText.GREEN, "PASS: ")
@@ -236,7 +445,7 @@ class SubprocessRunner(ActionRunner):
       final_text = [passfail] + final_text
     pending_message.finish(final_text)
 
-    return True
+    yield True
 
   def __reset_mtime(self, dir, real_outputs):
     for output in real_outputs:
@@ -249,26 +458,163 @@ class SubprocessRunner(ActionRunner):
 
 class CachingRunner(ActionRunner):
   """A wrapper ActionRunner which checks the contents of input files to
-  determine if they have actually changed, and skips the action if not."""
-
-  # TODO(kenton):  I wonder if we could use this to detect when the same
-  #   action in different configurations produces identical results, and thus
-  #   we can "steal" the result from the other config?  Might not be very
-  #   useful in practice, though.
-
-  def __init__(self, sub_runner, console):
+  determine if they have actually changed, and skips the action if not.  File
+  contents are summarized using the DigestCache, so unchanged files on disk
+  are not re-read.  If a ContentStore is given, the outputs of successful
+  actions are saved in it, and an action whose inputs match any earlier run
+  has its outputs restored from it rather than being run.  A RemoteCache is
+  consulted likewise when the local store misses.
+
+  Action keys don't depend on the configuration, only on the command and the
+  contents of its inputs.  So an action which some other configuration has
+  already performed identically (typically a host tool built for several
+  linked configs) is satisfied by linking that config's outputs.
+
+  With |lazy| set, outputs found in the store or remote cache aren't written
+  at all:  we only remember their digests, which is all we need to compute the
+  keys of the actions that use them.  They are materialized if an action
+  which actually runs needs them, or if the Builder asks for them.
+
+  Disk inputs and outputs are checked through |stat_cache|, which should be
+  the same StatCache the Builder and the DigestCache use.  We invalidate
+  outputs in it whenever we or the actions we run change them."""
+
+  # Names of the ways an action can be satisfied, in the order print_stats()
+  # lists them.  "run" is a miss; everything else is a hit.
+  OUTCOMES = ("no changes", "cached", "shared", "remote", "run")
+
+  def __init__(self, sub_runner, console, digest_cache = None, store = None,
+               remote = None, lazy = False, database = None,
+               stat_cache = None):
     typecheck(sub_runner, ActionRunner)
+    typecheck(digest_cache, DigestCache)
+    typecheck(store, ContentStore)
+    typecheck(remote, RemoteCache)
+    typecheck(lazy, bool)
+    typecheck(database, KeyValueStore)
+    typecheck(stat_cache, StatCache)
     self.__sub_runner = sub_runner
     self.__console = console
-    self.__cache = {}
+    if digest_cache is None:
+      digest_cache = DigestCache()
+    self.__digest_cache = digest_cache
+    if stat_cache is None:
+      stat_cache = StatCache()
+    self.__stat_cache = stat_cache
+    self.__store = store
+    self.__remote = remote
+    # Set once we've complained about the remote cache being unreachable.
+    self.__remote_warned = False
+    self.__lazy_outputs = lazy
+    # Everything we remember between builds lives in |database|, and is
+    # written as each action finishes.
+    if database is None:
+      database = KeyValueStore()
+    # Maps (config name, real name) to the key of the action which last
+    # produced that output, or None if it's being rebuilt.
+    self.__cache = database.table("hashes")
+    # Maps the disk paths of outputs which we've restored without writing to
+    # (hex digest, executable).  |executable| is None if unknown, which is the
+    # case for blobs in the local store (they carry their own mode).  Kept
+    # across builds:  the files don't exist, so the Builder will ask for the
+    # actions again, and we can skip them again.
+    self.__lazy = database.table("lazy outputs")
+    # Maps action keys to {config name: {real name: disk path}} describing the
+    # outputs each config produced with that key, so that other configs can
+    # share them.
+    self.__outputs_by_key = database.table("outputs by key")
+    # Maps config names to {outcome: count} for this build.  Not persisted.
+    self.__stats = {}
+    # (config name, real name) pairs of outputs which the last run of their
+    # action didn't change, until the Builder asks about them.
+    self.__unchanged = set()
+    # Guards __stats, __unchanged, and the read-modify-write of
+    # __outputs_by_key.  (The tables are thread-safe by themselves.)  Hashing
+    # and other file I/O happen outside of it so that cache hits can be
+    # checked in parallel.
+    self.__lock = threading.Lock()
+
+  def print_stats(self):
+    """Prints, for each configuration, how many actions were cache hits (and
+    of which kind) and how many had to run."""
+
+    self.__lock.acquire()
+    try:
+      stats = self.__stats.items()
+    finally:
+      self.__lock.release()
+    if len(stats) == 0:
+      return
+
+    print "\nCache statistics:"
+    stats.sort()
+    for name, counts in stats:
+      if name is None:
+        name = "default config"
+      hits = [(outcome, counts[outcome])
+              for outcome in CachingRunner.OUTCOMES[:-1]
+              if counts.get(outcome, 0) > 0]
+      message = ["  ", ColoredText(ColoredText.FUCHSIA, [name, ": "]),
+                 "%d hit(s)" % sum([count for outcome, count in hits])]
+      if len(hits) > 0:
+        message.append(" (%s)" % ", ".join(
+            ["%d %s" % (count, outcome) for outcome, count in hits]))
+      message.append(", %d miss(es)" % counts.get("run", 0))
+      self.__console.write(message)
+
+  def cancel(self):
+    self.__sub_runner.cancel()
+
+  def materialize(self, config, names):
+    from_store = []
+    from_remote = []
+    for name in names:
+      disk_path = config.root_dir.get_disk_path(name)
+      info = self.__get_lazy(disk_path)
+      if info is None:
+        continue
+      digest, executable = info
+      if self.__store is not None and self.__store.has_blob(digest):
+        from_store.append((name, disk_path, digest))
+      else:
+        from_remote.append((name, disk_path, digest, executable))
+
+    try:
+      for name, disk_path, digest in from_store:
+        self.__stat_cache.invalidate(disk_path)
+        self.__store.materialize(digest, disk_path)
+        self.__forget_lazy([disk_path])
+      if len(from_remote) > 0:
+        if self.__remote is None:
+          raise RemoteError("Not in the local store, and no remote cache.")
+        contents = self.__remote.get_blobs(
+            [digest for name, disk_path, digest, executable in from_remote])
+        for (name, disk_path, digest, executable), content in \
+            zip(from_remote, contents):
+          self.__write_output(config.root_dir, name, content, executable)
+          self.__forget_lazy([disk_path])
+    except (OSError, IOError, RemoteError), e:
+      self.__console.write([
+          _config_prefix(config),
+          ColoredText(ColoredText.RED, "ERROR: "),
+          "Couldn't restore outputs from the cache; try building again:  ",
+          str(e)])
+      return False
+    return True
 
-  def save(self):
-    return self.__cache
-  def restore(self, cache):
-    self.__cache = cache
+  def unchanged_outputs(self, config, names):
+    self.__lock.acquire()
+    try:
+      result = [name for name in names
+                if (config.name, name) in self.__unchanged]
+      for name in names:
+        self.__unchanged.discard((config.name, name))
+    finally:
+      self.__lock.release()
+    return result
 
-  def run(self, action, inputs, disk_inputs, outputs, test_result, config,
-          real_name_map, lock):
+  def run_async(self, action, inputs, disk_inputs, outputs, test_result,
+                config, real_name_map):
     (can_skip, hash) = self.__can_skip(
         action, inputs, disk_inputs, outputs, config, real_name_map)
     if can_skip:
@@ -277,22 +623,77 @@ class CachingRunner(ActionRunner):
           ColoredText(ColoredText.CYAN, "no changes: "),
           ColoredText(ColoredText.BLUE, [action.verb, ": "]),
           action.name])
+      self.__count(config, "no changes")
 
       # Update timestamps so that the builder does not even mark these files
       # dirty if we immediately build again.
-      for output in outputs:
-        config.root_dir.touch(real_name_map[output])
-      return True
+      self.__touch_outputs(outputs, config.root_dir, real_name_map)
+      self.__set_unchanged(config, outputs, real_name_map, None)
+      yield True
+      return
+
+    # Remember what the outputs looked like, so that we can tell the Builder
+    # which of them came out the same.
+    old_digests = self.__output_digests(outputs, config.root_dir,
+                                        real_name_map)
+
+    if len(outputs) > 0:
+      if hash is None and \
+         all([self.__stat_cache.exists(disk_input)
+              for disk_input in disk_inputs]):
+        hash = self.__hash(
+            action, inputs, disk_inputs, outputs, config.root_dir,
+            real_name_map)
+      source = None
+      if hash is None:
+        pass
+      elif self.__store is not None and self.__restore_outputs(
+          hash, outputs, config.root_dir, real_name_map):
+        source = "cached"
+      elif self.__share_outputs(hash, outputs, config, real_name_map):
+        source = "shared"
+      elif self.__remote is not None and self.__fetch_outputs(
+          hash, outputs, config.root_dir, real_name_map):
+        source = "remote"
+      if hash is not None:
+        # Even a failed attempt may have replaced some of the outputs.
+        self.__invalidate_outputs(outputs, config.root_dir, real_name_map)
+      if source is not None:
+        self.__console.write([
+            _config_prefix(config),
+            ColoredText(ColoredText.CYAN, [source, ": "]),
+            ColoredText(ColoredText.BLUE, [action.verb, ": "]),
+            action.name])
+        self.__count(config, source)
+        self.__set_hashes(config, outputs, real_name_map, hash)
+        # The restored files have the blobs' old timestamps.
+        self.__touch_outputs(outputs, config.root_dir, real_name_map)
+        self.__set_unchanged(config, outputs, real_name_map, old_digests)
+        yield True
+        return
 
     # Clear all outputs from cache since the cached value is now invalid.
-    for output in outputs:
-      # Set to None instead of actually removing from the map because we'll
-      # probably be putting these outputs back into the map momentarily.
-      self.__cache[(config.name, real_name_map[output])] = None
-
-    result = self.__sub_runner.run(
-        action, inputs, disk_inputs, outputs, test_result, config,
-        real_name_map, lock)
+    # Set to None instead of actually removing from the map because we'll
+    # probably be putting these outputs back into the map momentarily.
+    self.__set_hashes(config, outputs, real_name_map, None)
+
+    # We're really running the action, so its inputs had better exist, and
+    # its outputs will.
+    if not self.materialize(
+        config, [real_name_map[input] for input in inputs]):
+      yield False
+      return
+    self.__forget_lazy([config.root_dir.get_disk_path(real_name_map[output])
+                        for output in outputs])
+    self.__unlink_shared_outputs(outputs, config.root_dir, real_name_map)
+
+    self.__count(config, "run")
+    try:
+      result = yield self.__sub_runner.run_async(
+          action, inputs, disk_inputs, outputs, test_result, config,
+          real_name_map)
+    finally:
+      self.__invalidate_outputs(outputs, config.root_dir, real_name_map)
 
     if result:
       # Action succeeded, so record it in the cache.  First we need to refresh
@@ -308,11 +709,326 @@ class CachingRunner(ActionRunner):
             real_name_map)
 
       # Set new hash on all outputs.
+      self.__set_hashes(config, outputs, real_name_map, hash)
+
+      if self.__store is not None and len(outputs) > 0:
+        self.__store_outputs(hash, outputs, config.root_dir, real_name_map)
+      if self.__remote is not None and len(outputs) > 0:
+        self.__upload_outputs(hash, outputs, config.root_dir, real_name_map)
+
+      self.__set_unchanged(config, outputs, real_name_map, old_digests)
+
+    yield result
+
+  def __restore_outputs(self, hash, outputs, dir, real_name_map):
+    """Restores the outputs recorded in the ContentStore for the given action
+    key.  Returns false if there are none (or they can't be restored)."""
+
+    entry = self.__store.get_action(hash)
+    names = [real_name_map[output] for output in outputs]
+    if entry is None or set(entry.keys()) != set(names):
+      return False
+
+    if self.__remember_lazily(
+        dir, dict([(name, (entry[name], None)) for name in names])):
+      return True
+
+    try:
+      for name in names:
+        disk_path = dir.get_disk_path(name)
+        if disk_path is None:
+          dir.write(name, self.__store.read(entry[name]))
+        else:
+          self.__store.materialize(entry[name], disk_path)
+    except (OSError, IOError):
+      # Probably evicted by another process.  Any outputs we did restore will
+      # be replaced when the action runs.
+      return False
+    return True
+
+  def __store_outputs(self, hash, outputs, dir, real_name_map):
+    entry = {}
+    try:
       for output in outputs:
-        self.__cache[(config.name, real_name_map[output])] = hash
+        name = real_name_map[output]
+        disk_path = dir.get_disk_path(name)
+        if disk_path is None:
+          entry[name] = self.__store.put_content(dir.read(name))
+        else:
+          entry[name] = self.__store.put_file(disk_path)
+      self.__store.put_action(hash, entry)
+    except (OSError, IOError):
+      # The store is only an optimization, and the command may have neglected
+      # to write some output.
+      pass
+
+  def __fetch_outputs(self, hash, outputs, dir, real_name_map):
+    """Like __restore_outputs(), but fetches the outputs from the
+    RemoteCache, adding them to the local store (if any) as well."""
+
+    names = [real_name_map[output] for output in outputs]
+    try:
+      entry = self.__remote.get_action(hash)
+      if entry is None or set(entry.keys()) != set(names):
+        return False
+      if self.__remember_lazily(dir, entry):
+        return True
+      contents = self.__remote.get_blobs(
+          [entry[name][0] for name in names])
+    except RemoteError, e:
+      self.__warn_remote(e)
+      return False
+
+    self.__unlink_shared_outputs(outputs, dir, real_name_map)
+    try:
+      for name, content in zip(names, contents):
+        self.__write_output(dir, name, content, entry[name][1])
+    except (OSError, IOError):
+      # The action will run and replace whatever we managed to write.
+      return False
+
+    if self.__store is not None:
+      self.__store_outputs(hash, outputs, dir, real_name_map)
+    return True
+
+  def __share_outputs(self, hash, outputs, config, real_name_map):
+    """If another config has produced outputs with the given action key, links
+    them into place and returns true."""
+
+    names = [real_name_map[output] for output in outputs]
+    dests = [config.root_dir.get_disk_path(name) for name in names]
+    if None in dests:
+      return False
+
+    self.__lock.acquire()
+    try:
+      candidates = [
+          disk_paths for config_name, disk_paths
+          in self.__outputs_by_key.get(hash, {}).items()
+          if config_name != config.name and
+             set(disk_paths.keys()) == set(names) and
+             self.__is_current(hash, config_name, disk_paths)]
+    finally:
+      self.__lock.release()
+
+    for disk_paths in candidates:
+      try:
+        for name, dest in zip(names, dests):
+          link_or_copy(disk_paths[name], dest)
+        return True
+      except (OSError, IOError):
+        # Probably cleaned, or never materialized (see |lazy|).  Any outputs
+        # we did link will be replaced by the next candidate or by running
+        # the action.
+        pass
+    return False
+
+  def __is_current(self, hash, config_name, disk_paths):
+    """Checks that the given config hasn't since rebuilt the outputs
+    differently.  Call with __lock held."""
+
+    for name in disk_paths:
+      if self.__cache.get((config_name, name)) != hash:
+        return False
+    return True
+
+  def __count(self, config, outcome):
+    self.__lock.acquire()
+    try:
+      counts = self.__stats.setdefault(config.name, {})
+      counts[outcome] = counts.get(outcome, 0) + 1
+    finally:
+      self.__lock.release()
+
+  def __write_output(self, dir, name, content, executable):
+    dir.write(name, content)
+    disk_path = dir.get_disk_path(name)
+    if disk_path is not None and executable:
+      # Make it executable by whoever can read it, which respects the umask
+      # the file was created with.
+      mode = os.stat(disk_path).st_mode
+      os.chmod(disk_path, mode | ((mode & 0444) >> 2))
+
+  def __remember_lazily(self, dir, entry):
+    """In lazy mode, records the outputs described by |entry| (a dict mapping
+    names to (digest, executable)) without writing them, and returns true.
+    Any stale copies on disk are deleted, since they would otherwise look
+    up-to-date to anyone who didn't ask us."""
+
+    if not self.__lazy_outputs:
+      return False
+    disk_paths = [dir.get_disk_path(name) for name in entry]
+    if None in disk_paths:
+      return False
+
+    for disk_path in disk_paths:
+      self.__stat_cache.invalidate(disk_path)
+      try:
+        os.remove(disk_path)
+      except OSError:
+        pass
+    self.__lazy.update([(disk_path, entry[name]) for name, disk_path
+                        in zip(entry.keys(), disk_paths)])
+    return True
+
+  def __get_lazy(self, disk_path):
+    """Returns (digest, executable) if the file at |disk_path| is an output
+    we haven't materialized, or None."""
+
+    if disk_path is None:
+      return None
+    info = self.__lazy.get(disk_path)
+    if info is not None and self.__stat_cache.exists(disk_path):
+      # Someone wrote it behind our backs.  Believe the disk.
+      self.__forget_lazy([disk_path])
+      return None
+    return info
+
+  def __forget_lazy(self, disk_paths):
+    for disk_path in disk_paths:
+      self.__lazy.pop(disk_path, None)
+
+  def __touch_outputs(self, outputs, dir, real_name_map):
+    for output in outputs:
+      name = real_name_map[output]
+      if self.__get_lazy(dir.get_disk_path(name)) is None:
+        dir.touch(name)
 
+  def __output_digests(self, outputs, dir, real_name_map):
+    """Returns a dict mapping the real name of each output to the digest of
+    its current content, or to None if it doesn't exist."""
+
+    result = {}
+    on_disk = []
+    for output in outputs:
+      name = real_name_map[output]
+      disk_path = dir.get_disk_path(name)
+      info = self.__get_lazy(disk_path)
+      if info is not None:
+        result[name] = binascii.unhexlify(info[0])
+      elif not dir.exists(name):
+        result[name] = None
+      elif disk_path is None:
+        hasher = self.__digest_cache.new_hasher()
+        hasher.update(dir.read(name))
+        result[name] = hasher.digest()
+      else:
+        on_disk.append((name, disk_path))
+
+    try:
+      digests = self.__digest_cache.digests(
+          [disk_path for name, disk_path in on_disk])
+    except (OSError, IOError):
+      # Deleted while we looked.  Calling it changed is always safe.
+      digests = [None] * len(on_disk)
+    for (name, disk_path), digest in zip(on_disk, digests):
+      result[name] = digest
     return result
 
+  def __set_unchanged(self, config, outputs, real_name_map, old_digests):
+    """Records which outputs have the same content as they did before the
+    action, whose digests were |old_digests|.  If that is None, the action
+    didn't touch the outputs at all."""
+
+    if old_digests is None:
+      names = [real_name_map[output] for output in outputs]
+    else:
+      new_digests = self.__output_digests(outputs, config.root_dir,
+                                          real_name_map)
+      names = [name for name, digest in new_digests.items()
+               if digest is not None and digest == old_digests.get(name)]
+
+    self.__lock.acquire()
+    try:
+      self.__unchanged.update([(config.name, name) for name in names])
+    finally:
+      self.__lock.release()
+
+  def __upload_outputs(self, hash, outputs, dir, real_name_map):
+    # Files on disk are passed by path, to be read when the upload runs.
+    contents = {}
+    files = {}
+    try:
+      for output in outputs:
+        name = real_name_map[output]
+        disk_path = dir.get_disk_path(name)
+        if disk_path is None:
+          contents[name] = (dir.read(name), False)
+        else:
+          files[name] = (disk_path, os.access(disk_path, os.X_OK))
+      self.__remote.put_action(hash, contents, files)
+    except (OSError, IOError):
+      # As in __store_outputs().
+      pass
+
+  def __warn_remote(self, error):
+    # An unreachable cache is just a slower build, but the user should know
+    # why.  (The RemoteCache then stops trying to use it.)
+    self.__lock.acquire()
+    try:
+      if self.__remote_warned:
+        return
+      self.__remote_warned = True
+    finally:
+      self.__lock.release()
+    self.__console.write([ColoredText(ColoredText.YELLOW, "WARNING: "),
+                          str(error)])
+
+  def __invalidate_outputs(self, outputs, dir, real_name_map):
+    for output in outputs:
+      disk_path = dir.get_disk_path(real_name_map[output])
+      if disk_path is not None:
+        self.__stat_cache.invalidate(disk_path)
+
+  def __unlink_shared_outputs(self, outputs, dir, real_name_map):
+    # An output restored from (or saved to) the ContentStore may be a hard link
+    # to a blob, and a command which wrote to it in place would corrupt the
+    # blob.  Remove such links before running the command.
+    for output in outputs:
+      disk_path = dir.get_disk_path(real_name_map[output])
+      if disk_path is not None:
+        try:
+          if os.stat(disk_path).st_nlink > 1:
+            os.remove(disk_path)
+        except OSError:
+          pass
+
+  def __set_hashes(self, config, outputs, real_name_map, hash):
+    disk_paths = {}
+    for output in outputs:
+      name = real_name_map[output]
+      disk_paths[name] = config.root_dir.get_disk_path(name)
+
+    self.__lock.acquire()
+    try:
+      old_hashes = set([self.__cache.get((config.name, name))
+                        for name in disk_paths])
+      self.__cache.update([((config.name, name), hash)
+                           for name in disk_paths])
+
+      # This config's outputs no longer match the keys they used to.
+      for old_hash in old_hashes:
+        producers = self.__outputs_by_key.get(old_hash)
+        if old_hash != hash and producers is not None and \
+           config.name in producers:
+          producers = dict(producers)
+          del producers[config.name]
+          if len(producers) > 0:
+            self.__outputs_by_key[old_hash] = producers
+          else:
+            self.__outputs_by_key.pop(old_hash)
+
+      if hash is not None and None not in disk_paths.values():
+        producers = dict(self.__outputs_by_key.get(hash, {}))
+        producers[config.name] = disk_paths
+        self.__outputs_by_key[hash] = producers
+    finally:
+      self.__lock.release()
+
+  def __get_hashes(self, config, outputs, real_name_map):
+    return [self.__cache.get((config.name, real_name_map[output]))
+            for output in outputs]
+
   def __can_skip(self, action, inputs, disk_inputs, outputs, config,
                  real_name_map):
     # There should be no such thing as an action without outputs, but if we
@@ -321,18 +1037,19 @@ class CachingRunner(ActionRunner):
       return (False, None)
 
     # Look up the hash of the action which produced these outputs last time.
-    last_hash = self.__cache.get((config.name, real_name_map[outputs[0]]))
+    last_hashes = self.__get_hashes(config, outputs, real_name_map)
+    last_hash = last_hashes[0]
     if last_hash is None:
       return (False, None)    # Nothing in cache, must re-run.
 
     # All outputs must have the same hash.
-    for output in outputs[1:]:
-      if self.__cache.get((config.name, real_name_map[output])) != last_hash:
+    for hash in last_hashes[1:]:
+      if hash != last_hash:
         return (False, None)
 
     # All disk inputs must exist.
     for disk_input in disk_inputs:
-      if not os.path.exists(disk_input):
+      if not self.__stat_cache.exists(disk_input):
         return (False, None)
 
     # Compute new hash and compare.
@@ -341,46 +1058,75 @@ class CachingRunner(ActionRunner):
     if new_hash != last_hash:
       return (False, new_hash)
 
-    # Make sure all outputs exist.  We do this last to avoid touching the
-    # filesystem when we don't have to.
+    # Make sure all outputs exist (or, in lazy mode, can be materialized).  We
+    # do this last to avoid touching the filesystem when we don't have to.
     for output in outputs:
-      if not config.root_dir.exists(real_name_map[output]):
+      name = real_name_map[output]
+      if config.root_dir.exists(name):
+        continue
+      info = self.__get_lazy(config.root_dir.get_disk_path(name))
+      if not self.__lazy_outputs or info is None:
+        return (False, new_hash)
+      if self.__store is not None and self.__store.has_blob(info[0]):
+        continue
+      if self.__remote is None or not self.__remote.available():
         return (False, new_hash)
 
     return (True, new_hash)
 
   def __hash(self, action, inputs, disk_inputs, outputs, dir, real_name_map):
-    # Security is not a concern here, so MD5 is OK and probably faster than
-    # more-secure algorithms.
-    hasher = md5.md5()
+    """Computes the action's key.  In order, it covers:  each input's name and
+    content digest, sorted by name; each disk input's path and digest, sorted
+    by path, except those which are also inputs; each output's name, sorted;
+    and finally the command itself.  All digests use the DigestCache's
+    algorithm."""
 
-    input_names = [real_name_map[input] for input in inputs]
+    input_names = list(set([real_name_map[input] for input in inputs]))
     input_names.sort()
-    for input in input_names:
+    input_paths = [dir.get_disk_path(input) for input in input_names]
+
+    # A depfile lists the headers and source which are also inputs; hash each
+    # file only once, as an input.
+    covered = set([os.path.normpath(path) for path in input_paths
+                   if path is not None])
+    disk_input_names = [disk_input for disk_input in set(disk_inputs)
+                        if os.path.normpath(disk_input) not in covered]
+    disk_input_names.sort()
+
+    # Collect everything that lives on disk so that the files can be hashed in
+    # parallel.  Outputs we haven't materialized have known digests.
+    lazy_digests = {}
+    for path in input_paths:
+      info = self.__get_lazy(path)
+      if info is not None:
+        lazy_digests[path] = binascii.unhexlify(info[0])
+    paths = [path for path in input_paths
+             if path is not None and path not in lazy_digests]
+    paths.extend(disk_input_names)
+    digests = iter(self.__digest_cache.digests(paths))
+
+    hasher = self.__digest_cache.new_hasher()
+
+    for input, disk_path in zip(input_names, input_paths):
       hasher.update("i")
       hasher.update(str(len(input)))
       hasher.update(" ")
       hasher.update(input)
-      content = dir.read(input)
-      hasher.update(str(len(content)))
-      hasher.update(" ")
-      hasher.update(content)
-      content = None
+      if disk_path is None:
+        content_hasher = self.__digest_cache.new_hasher()
+        content_hasher.update(dir.read(input))
+        hasher.update(content_hasher.digest())
+      elif disk_path in lazy_digests:
+        hasher.update(lazy_digests[disk_path])
+      else:
+        hasher.update(digests.next())
 
-    disk_input_names = list(disk_inputs)
-    disk_input_names.sort()
     for disk_input in disk_input_names:
       hasher.update("d")
       hasher.update(str(len(disk_input)))
       hasher.update(" ")
       hasher.update(disk_input)
-      file = open(disk_input, "rU")
-      content = file.read()
-      file.close()
-      hasher.update(str(len(content)))
-      hasher.update(" ")
-      hasher.update(content)
-      content = None
+      hasher.update(digests.next())
 
     output_names = [real_name_map[output] for output in outputs]
     output_names.sort()
@@ -421,6 +1167,10 @@ class _DiskInputCollector(ArtifactEnumerator):
     else:
       return None
 
+  def scan_includes(self, file):
+    # Includes only decide which artifacts are inputs, which we don't need.
+    return []
+
 # useful for debugging...
 #
 #class HashInterceptor(object):
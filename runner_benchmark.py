@@ -0,0 +1,186 @@
+#! /usr/bin/python
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""Measures how well CachingRunner's cache-hit path scales with threads.
+
+Usage:
+  runner_benchmark.py [-j THREADS] [-n ACTIONS] [-s SIZE_KB]
+
+Creates ACTIONS input files of SIZE_KB kilobytes each in a temporary
+directory, along with one action per input that copies it to an output.  After
+an initial build fills the cache, the outputs are marked out-of-date and the
+build is repeated with 1, 2, 4, ... up to THREADS threads.  Every action in
+those builds is a cache hit, so nearly all the time goes to reading and
+hashing inputs, which should speed up with more threads as long as the
+builder doesn't hold its lock while the runner works.
+"""
+
+import cStringIO
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from sebs.core import Artifact, Action, Rule, Context
+from sebs.filesystem import DiskDirectory
+from sebs.builder import Builder
+from sebs.command import Command
+from sebs.console import make_console
+from sebs.runner import ActionRunner, CachingRunner
+
+class UsageError(Exception):
+  pass
+
+class _CopyRunner(ActionRunner):
+  def run(self, action, inputs, disk_inputs, outputs, test_result, config,
+          real_name_map):
+    config.root_dir.write(real_name_map[outputs[0]],
+                          config.root_dir.read(real_name_map[inputs[0]]))
+    return True
+
+class _BenchmarkContext(Context):
+  def __init__(self):
+    super(_BenchmarkContext, self).__init__()
+    self.filename = "benchmark.sebs"
+    self.full_filename = "src/benchmark.sebs"
+    self.timestamp = 0
+
+class _CopyCommand(Command):
+  def __init__(self, input, output):
+    self.__input = input
+    self.__output = output
+
+  def enumerate_artifacts(self, artifact_enumerator):
+    artifact_enumerator.add_input(self.__input)
+    artifact_enumerator.add_output(self.__output)
+
+  def hash(self, hasher):
+    hasher.update("CopyCommand:")
+
+class _BenchmarkConfiguration(object):
+  def __init__(self, dir):
+    self.root_dir = dir
+    self.name = None
+
+def _build(outputs, config, runner, threads):
+  """Builds |outputs| and returns the wall time taken, in seconds."""
+
+  builder = Builder(make_console(cStringIO.StringIO()))
+  for output in outputs:
+    builder.add_artifact(config, output)
+
+  thread_objects = []
+  start = time.time()
+  for i in range(threads):
+    thread_objects.append(
+      threading.Thread(target = builder.build, args = [runner]))
+    thread_objects[-1].start()
+  for thread in thread_objects:
+    thread.join()
+  elapsed = time.time() - start
+
+  if builder.failed:
+    raise AssertionError("Benchmark build failed.")
+  return elapsed
+
+def run_benchmark(max_threads, count, size):
+  """Returns a list of (threads, seconds) pairs."""
+
+  tempdir = tempfile.mkdtemp(prefix = "sebs_benchmark_")
+  try:
+    dir = DiskDirectory(tempdir)
+    config = _BenchmarkConfiguration(dir)
+    rule = Rule(_BenchmarkContext())
+
+    outputs = []
+    for i in range(count):
+      input = Artifact("src/in%d" % i, None)
+      dir.write(input.filename, os.urandom(size), 1000)
+      action = Action(rule, "copy", input.filename)
+      outputs.append(Artifact("tmp/out%d" % i, action))
+      action.command = _CopyCommand(input, outputs[-1])
+
+    runner = CachingRunner(_CopyRunner(), make_console(cStringIO.StringIO()))
+    _build(outputs, config, runner, max_threads)
+
+    results = []
+    threads = 1
+    while True:
+      # Make every output older than its input so the builder hands them all
+      # to the runner again.
+      for output in outputs:
+        dir.touch(output.filename, 0)
+      results.append((threads, _build(outputs, config, runner, threads)))
+      if threads >= max_threads:
+        break
+      threads = min(threads * 2, max_threads)
+    return results
+  finally:
+    shutil.rmtree(tempdir)
+
+def main(argv):
+  try:
+    opts, args = getopt.getopt(argv[1:], "hj:n:s:", ["help"])
+  except getopt.error, message:
+    raise UsageError(message)
+
+  threads = 8
+  count = 200
+  size = 1024 * 1024
+
+  for name, value in opts:
+    if name in ("-h", "--help"):
+      print __doc__
+      return 0
+    elif name == "-j":
+      threads = int(value)
+    elif name == "-n":
+      count = int(value)
+    elif name == "-s":
+      size = int(value) * 1024
+
+  results = run_benchmark(threads, count, size)
+  print "%d cache hits on %d KB inputs:" % (count, size / 1024)
+  base = results[0][1]
+  for threads, elapsed in results:
+    print "  -j%-3d %8.3fs  (%.2fx)" % (threads, elapsed, base / elapsed)
+  return 0
+
+if __name__ == "__main__":
+  try:
+    sys.exit(main(sys.argv))
+  except UsageError, error:
+    print >>sys.stderr, error.message
+    print >>sys.stderr, "for help use --help"
+    sys.exit(2)
@@ -0,0 +1,375 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+A helper process for starting subprocesses cheaply.
+
+Forking copies the parent's page tables, so once SEBS has loaded a large build
+graph every fork() costs milliseconds.  SpawnHelper forks a helper process
+early, while the heap is still small, and asks it to start subprocesses on our
+behalf.  Requests and exit statuses travel over a pair of pipes.
+
+Since file descriptors can't be sent over a pipe, the child's stdin, stdout
+and stderr are described by file name.  Output which the caller wants back as
+a string is written to a temporary file and read once the child exits.
+"""
+
+import cPickle
+import errno
+import fcntl
+import os
+import select
+import signal
+import subprocess
+import tempfile
+import threading
+import traceback
+
+def _set_cloexec(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _write_fully(fd, data):
+  while len(data) > 0:
+    data = data[os.write(fd, data):]
+
+def _read_fully(fd, size):
+  chunks = []
+  while size > 0:
+    chunk = os.read(fd, size)
+    if chunk == "":
+      raise EOFError
+    chunks.append(chunk)
+    size = size - len(chunk)
+  return "".join(chunks)
+
+def _send(fd, message):
+  data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+  _write_fully(fd, "%08x" % len(data) + data)
+
+def _receive(fd):
+  """Reads one message written by _send().  Raises EOFError if the other end
+  has been closed."""
+  size = int(_read_fully(fd, 8), 16)
+  return cPickle.loads(_read_fully(fd, size))
+
+# ====================================================================
+# The helper process
+
+def _ignore_signal(signum, frame):
+  pass
+
+def _setup_child():
+  # The helper ignores SIGINT, and ignored signals stay ignored across exec(),
+  # but the actions themselves should still respond to it.
+  signal.signal(signal.SIGINT, signal.SIG_DFL)
+  # Like SubprocessRunner, give each action its own process group so that
+  # signal_all() reaches anything it starts.
+  os.setpgrp()
+
+def _open_spec(spec):
+  """Opens a file described by a stream spec (see SpawnHelper.call()) and
+  returns a file object, or returns None or subprocess.STDOUT."""
+
+  if spec is None:
+    return None
+  elif spec == "stdout":
+    return subprocess.STDOUT
+  else:
+    path, mode = spec
+    return open(path, mode)
+
+def _spawn(request):
+  args, env, cwd, stdin_spec, stdout_spec, stderr_spec = request
+  files = [_open_spec(spec) for spec in [stdin_spec, stdout_spec, stderr_spec]]
+  try:
+    return subprocess.Popen(args, stdin = files[0], stdout = files[1],
+                            stderr = files[2], env = env, cwd = cwd,
+                            preexec_fn = _setup_child)
+  finally:
+    for file in files:
+      if file is not None and file is not subprocess.STDOUT:
+        file.close()
+
+def _helper_main(request_fd, response_fd):
+  # Ctrl+C goes to the whole process group.  The SEBS process decides what to
+  # do about it; we just keep reporting on our children.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  wakeup_read, wakeup_write = os.pipe()
+  for fd in [wakeup_read, wakeup_write]:
+    _set_cloexec(fd)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+  signal.set_wakeup_fd(wakeup_write)
+  signal.signal(signal.SIGCHLD, _ignore_signal)
+  signal.siginterrupt(signal.SIGCHLD, False)
+
+  # Maps request IDs to Popen objects.
+  running = {}
+  done = False
+
+  while not done or len(running) > 0:
+    if done:
+      watched = [wakeup_read]
+    else:
+      watched = [wakeup_read, request_fd]
+    try:
+      readable = select.select(watched, [], [])[0]
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+      readable = []
+
+    if request_fd in readable:
+      try:
+        message = _receive(request_fd)
+      except EOFError:
+        # SEBS is done with us.
+        done = True
+        message = None
+
+      if message is None:
+        pass
+      elif message[0] == "spawn":
+        id = message[1]
+        try:
+          running[id] = _spawn(message[2:])
+        except (OSError, IOError), e:
+          _send(response_fd, (id, None, (e.errno, e.strerror)))
+      elif message[0] == "kill":
+        proc = running.get(message[1])
+        if proc is not None and proc.poll() is None:
+          try:
+            os.killpg(proc.pid, message[2])
+          except OSError:
+            pass   # Already exited.
+
+    if wakeup_read in readable:
+      try:
+        while os.read(wakeup_read, 4096) != "":
+          pass
+      except OSError, e:
+        if e.errno != errno.EAGAIN:
+          raise
+
+    for id, proc in running.items():
+      if proc.poll() is not None:
+        del running[id]
+        _send(response_fd, (id, proc.returncode, None))
+
+# ====================================================================
+# The SEBS side
+
+class SpawnHelper(object):
+  """Starts subprocesses by way of a helper process forked when the
+  SpawnHelper was constructed.  Construct it before loading anything large.
+  Any number of threads may call call() at once."""
+
+  # Keyword arguments to subprocess.Popen() which call() understands.
+  SUPPORTED_ARGUMENTS = frozenset(["stdin", "stdout", "stderr", "env", "cwd"])
+
+  def __init__(self):
+    request_read, request_write = os.pipe()
+    response_read, response_write = os.pipe()
+    for fd in [request_read, request_write, response_read, response_write]:
+      # Keep our children from holding the pipes open.
+      _set_cloexec(fd)
+
+    self.__pid = os.fork()
+    if self.__pid == 0:
+      status = 1
+      try:
+        try:
+          os.close(request_write)
+          os.close(response_read)
+          _helper_main(request_read, response_write)
+          status = 0
+        except:
+          traceback.print_exc()
+      finally:
+        # Don't run any cleanup inherited from the parent.
+        os._exit(status)
+
+    os.close(request_read)
+    os.close(response_write)
+    self.__request_fd = request_write
+    self.__response_fd = response_read
+
+    self.__lock = threading.Lock()
+    self.__condition = threading.Condition(self.__lock)
+    self.__next_id = 0
+    # Maps request IDs to responses which haven't been claimed yet.
+    self.__responses = {}
+    # True if some thread is currently reading a response.
+    self.__reading = False
+    # IDs of requests which haven't completed.
+    self.__running = set()
+
+  def close(self):
+    """Tells the helper to exit (once its remaining children have) and waits
+    for it to do so."""
+
+    os.close(self.__request_fd)
+    os.waitpid(self.__pid, 0)
+    os.close(self.__response_fd)
+
+  def signal_all(self, signum):
+    """Sends the given signal to the process group of every subprocess which
+    is still running.  Returns the number of subprocesses signalled.  (So
+    with signal 0, this just counts them.)"""
+
+    self.__lock.acquire()
+    try:
+      for id in self.__running:
+        _send(self.__request_fd, ("kill", id, signum))
+      return len(self.__running)
+    finally:
+      self.__lock.release()
+
+  def can_call(self, kwargs):
+    """Returns true if call() supports the given arguments to Popen()."""
+
+    for name, value in kwargs.items():
+      if name not in SpawnHelper.SUPPORTED_ARGUMENTS:
+        return False
+      if name in ("stdin", "stdout", "stderr"):
+        if isinstance(value, file):
+          if not os.path.exists(value.name):
+            return False   # Not a named file.
+        elif name == "stdin" and isinstance(value, str):
+          pass
+        elif value not in (None, subprocess.PIPE, subprocess.STDOUT):
+          return False
+    return True
+
+  def call(self, args, stdin = None, stdout = None, stderr = None, env = None,
+           cwd = None):
+    """Like CommandContext.subprocess():  runs the subprocess to completion and
+    returns (exit_code, stdout, stderr).  stdin may be a string, a named
+    file, or None; stdout and stderr may be subprocess.PIPE, a named file, or
+    None, and stderr may also be subprocess.STDOUT."""
+
+    temp_files = []
+    try:
+      if isinstance(stdin, str):
+        fd, path = tempfile.mkstemp(prefix = "sebs_stdin_")
+        temp_files.append(path)
+        _write_fully(fd, stdin)
+        os.close(fd)
+        stdin_spec = (path, "rb")
+      elif stdin == subprocess.PIPE:
+        # Nothing will be written.
+        stdin_spec = (os.devnull, "rb")
+      elif stdin is None:
+        stdin_spec = None
+      else:
+        stdin_spec = (stdin.name, "rb")
+
+      output_paths = []
+      specs = []
+      for stream in [stdout, stderr]:
+        if stream == subprocess.PIPE:
+          fd, path = tempfile.mkstemp(prefix = "sebs_output_")
+          os.close(fd)
+          temp_files.append(path)
+          output_paths.append(path)
+          specs.append((path, "wb"))
+        elif stream == subprocess.STDOUT:
+          output_paths.append(None)
+          specs.append("stdout")
+        elif stream is None:
+          output_paths.append(None)
+          specs.append(None)
+        else:
+          stream.flush()
+          output_paths.append(None)
+          specs.append((stream.name, "wb"))
+
+      self.__lock.acquire()
+      try:
+        id = self.__next_id
+        self.__next_id = id + 1
+        self.__running.add(id)
+        _send(self.__request_fd,
+              ("spawn", id, args, env, cwd, stdin_spec, specs[0], specs[1]))
+      finally:
+        self.__lock.release()
+
+      try:
+        returncode, error = self.__wait(id)
+      except:
+        self.__lock.acquire()
+        try:
+          _send(self.__request_fd, ("kill", id, signal.SIGKILL))
+          self.__running.discard(id)
+        finally:
+          self.__lock.release()
+        raise
+
+      if error is not None:
+        raise OSError(*error)
+
+      results = [returncode]
+      for path in output_paths:
+        if path is None:
+          results.append(None)
+        else:
+          file = open(path, "rb")
+          results.append(file.read())
+          file.close()
+      return tuple(results)
+    finally:
+      for path in temp_files:
+        os.remove(path)
+
+  def __wait(self, id):
+    self.__lock.acquire()
+    try:
+      while id not in self.__responses:
+        if self.__reading:
+          # Another thread is reading; it'll notify us when it gets something.
+          self.__condition.wait()
+          continue
+
+        self.__reading = True
+        self.__lock.release()
+        try:
+          response = _receive(self.__response_fd)
+        finally:
+          self.__lock.acquire()
+          self.__reading = False
+          self.__condition.notify_all()
+        self.__responses[response[0]] = response[1:]
+
+      self.__running.discard(id)
+      return self.__responses.pop(id)
+    finally:
+      self.__lock.release()
@@ -0,0 +1,116 @@
+#! /usr/bin/python
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Measures how fast subprocesses can be started as the heap grows.
+
+Usage:
+  spawner_benchmark.py [-n COUNT] [-m HEAP_MB,HEAP_MB,...]
+
+For each heap size, allocates roughly that many megabytes of small Python
+objects (a stand-in for a large build graph), then times COUNT runs of
+"true" started directly with subprocess.Popen and COUNT runs started through
+a SpawnHelper which was forked before anything was allocated.
+"""
+
+import getopt
+import subprocess
+import sys
+import time
+
+from sebs.spawner import SpawnHelper
+
+class UsageError(Exception):
+  pass
+
+# Roughly how many bytes a one-element list of a distinct small int costs.
+_BYTES_PER_OBJECT = 100
+
+def _time_direct(count):
+  start = time.time()
+  for i in range(count):
+    subprocess.Popen(["true"]).wait()
+  return time.time() - start
+
+def _time_helper(helper, count):
+  start = time.time()
+  for i in range(count):
+    helper.call(["true"])
+  return time.time() - start
+
+def run_benchmark(count, heap_sizes):
+  """Returns a list of (heap_mb, direct_rate, helper_rate) tuples, where the
+  rates are spawns per second."""
+
+  helper = SpawnHelper()
+  try:
+    heap = []
+    results = []
+    for heap_mb in heap_sizes:
+      target = heap_mb * 1024 * 1024 / _BYTES_PER_OBJECT
+      while len(heap) < target:
+        heap.append([len(heap)])
+      results.append((heap_mb, count / _time_direct(count),
+                      count / _time_helper(helper, count)))
+    return results
+  finally:
+    helper.close()
+
+def main(argv):
+  try:
+    opts, args = getopt.getopt(argv[1:], "hn:m:", ["help"])
+  except getopt.error, message:
+    raise UsageError(message)
+
+  count = 200
+  heap_sizes = [0, 256, 1024]
+
+  for name, value in opts:
+    if name in ("-h", "--help"):
+      print __doc__
+      return 0
+    elif name == "-n":
+      count = int(value)
+    elif name == "-m":
+      heap_sizes = sorted([int(size) for size in value.split(",")])
+
+  print "%8s %14s %14s" % ("heap MB", "direct/s", "helper/s")
+  for heap_mb, direct_rate, helper_rate in run_benchmark(count, heap_sizes):
+    print "%8d %14.1f %14.1f" % (heap_mb, direct_rate, helper_rate)
+  return 0
+
+if __name__ == "__main__":
+  try:
+    sys.exit(main(sys.argv))
+  except UsageError, error:
+    print >>sys.stderr, error.message
+    print >>sys.stderr, "for help use --help"
+    sys.exit(2)
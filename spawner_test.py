@@ -0,0 +1,122 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from sebs.spawner import SpawnHelper
+
+class SpawnHelperTest(unittest.TestCase):
+  def setUp(self):
+    self.helper = SpawnHelper()
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.helper.close()
+    shutil.rmtree(self.tempdir)
+
+  def testPipes(self):
+    self.assertEqual((3, "out\n", "err\n"),
+        self.helper.call(["sh", "-c", "echo out; echo err >&2; exit 3"],
+                         stdout = subprocess.PIPE, stderr = subprocess.PIPE))
+    self.assertEqual((0, "out\nerr\n", None),
+        self.helper.call(["sh", "-c", "echo out; echo err >&2"],
+                         stdout = subprocess.PIPE, stderr = subprocess.STDOUT))
+    self.assertEqual((0, "foo", None),
+        self.helper.call(["cat"], stdin = "foo", stdout = subprocess.PIPE))
+
+  def testEnvironmentAndDirectory(self):
+    self.assertEqual((0, "bar %s\n" % os.path.realpath(self.tempdir), None),
+        self.helper.call(["sh", "-c", "echo $FOO `pwd -P`"],
+                         stdout = subprocess.PIPE, env = { "FOO": "bar" },
+                         cwd = self.tempdir))
+
+  def testFiles(self):
+    path = os.path.join(self.tempdir, "out")
+    out = open(path, "wb")
+    self.assertTrue(self.helper.can_call({ "stdout": out }))
+    self.assertEqual((0, None, None),
+        self.helper.call(["echo", "hello"], stdout = out))
+    out.close()
+    self.assertEqual("hello\n", open(path).read())
+
+    self.assertFalse(self.helper.can_call({ "stdout": 1 }))
+    self.assertFalse(self.helper.can_call({ "shell": True }))
+
+  def testSignalAll(self):
+    results = []
+    def run():
+      # The shell's child is in the same process group, so it dies too and
+      # the pipe is closed.
+      results.append(self.helper.call(["sh", "-c", "sleep 10; echo done"],
+                                      stdout = subprocess.PIPE))
+    thread = threading.Thread(target = run)
+    thread.start()
+    try:
+      for i in range(1000):
+        if self.helper.signal_all(0) > 0:
+          break
+        time.sleep(0.01)
+      # The helper handles the request to start the process before the
+      # request to signal it.
+      self.assertEqual(1, self.helper.signal_all(signal.SIGTERM))
+    finally:
+      thread.join()
+    self.assertEqual([(-signal.SIGTERM, "", None)], results)
+    self.assertEqual(0, self.helper.signal_all(0))
+
+  def testStartFailure(self):
+    self.assertRaises(OSError, self.helper.call, ["/nonexistent/program"])
+
+  def testThreads(self):
+    results = {}
+    def run(i):
+      results[i] = self.helper.call(["sh", "-c", "sleep 0.1; echo %d" % i],
+                                    stdout = subprocess.PIPE)
+
+    threads = [threading.Thread(target = run, args = [i]) for i in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    for i in range(8):
+      self.assertEqual((0, "%d\n" % i, None), results[i])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,222 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Persistent workers:  tools which are started once per build and then handed
+many requests, so that we don't pay the tool's startup cost on every action.
+
+A tool declares support for the protocol by accepting the --persistent_worker
+flag.  When started with that flag, the tool reads requests from stdin and
+writes responses to stdout, one JSON object per line:
+
+  request:   {"arguments": [...], "inputs": [...]}
+  response:  {"exit_code": 0, "output": "..."}
+
+"arguments" is the command line the tool would otherwise have been run with,
+minus the program name.  "inputs" lists the on-disk paths of the action's
+input files, so that a worker which caches things between requests knows what
+it must re-read.  "output" is whatever the tool would have written to stdout
+and stderr.  The worker exits when it reads EOF from stdin.
+
+A tool which supports the protocol must still work when run normally, since
+commands fall back to that when no WorkerPool is available.
+"""
+
+import json
+import os
+import signal
+import subprocess
+import threading
+
+WORKER_FLAG = "--persistent_worker"
+
+class WorkerError(Exception):
+  pass
+
+class _Worker(object):
+  def __init__(self, tool, env, cwd):
+    self.__proc = subprocess.Popen(list(tool) + [WORKER_FLAG],
+                                   stdin = subprocess.PIPE,
+                                   stdout = subprocess.PIPE,
+                                   env = env, cwd = cwd, close_fds = True,
+                                   preexec_fn = os.setpgrp)
+
+  def request(self, arguments, inputs):
+    """Sends one request and waits for its response.  Raises WorkerError if
+    the worker dies or misbehaves; the worker should not be reused after
+    that."""
+
+    line = json.dumps({"arguments": arguments, "inputs": inputs})
+    try:
+      self.__proc.stdin.write(line + "\n")
+      self.__proc.stdin.flush()
+      response = self.__proc.stdout.readline()
+    except IOError, e:
+      raise WorkerError("Lost connection to persistent worker: %s" % e)
+    if response == "":
+      raise WorkerError("Persistent worker exited unexpectedly.")
+
+    try:
+      response = json.loads(response)
+      return (int(response["exit_code"]),
+              response["output"].encode("utf-8"))
+    except (ValueError, KeyError, TypeError, AttributeError):
+      raise WorkerError("Malformed response from persistent worker: %r" %
+                        response)
+
+  def returncode(self):
+    return self.__proc.poll()
+
+  def signal(self, signum):
+    """Sends the signal to the worker's process group, unless the worker has
+    already been waited for."""
+    if self.__proc.returncode is None:
+      try:
+        os.killpg(self.__proc.pid, signum)
+      except OSError:
+        pass   # Already exited.
+
+  def close(self):
+    try:
+      self.__proc.stdin.close()
+    except IOError:
+      pass
+    self.__proc.wait()
+
+  def kill(self):
+    if self.__proc.poll() is None:
+      self.signal(signal.SIGKILL)
+    self.close()
+
+class WorkerPool(object):
+  """Starts persistent workers on demand and hands each request to an idle
+  worker for the same tool, starting another one if they are all busy.  So,
+  with -jN, at most N workers run per tool.  Workers are identified by the
+  tool's command, environment and working directory.  Thread-safe."""
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__idle = {}
+    self.__workers = set()
+    self.__busy = set()
+
+  def request(self, tool, arguments, inputs, env = None, cwd = None):
+    """Runs one request on a worker for the given tool, which is a list of
+    arguments starting the tool normally (usually just its path).  Returns a
+    pair:  (exit_code, output).  If the worker fails, it is discarded and
+    the request fails with a non-zero exit code; if the worker was killed by
+    a signal (e.g. by signal_busy()), the exit code is minus the signal
+    number, as with Popen."""
+
+    if env is None:
+      key = (tuple(tool), None, cwd)
+    else:
+      key = (tuple(tool), tuple(sorted(env.items())), cwd)
+
+    worker = None
+    self.__lock.acquire()
+    try:
+      idle = self.__idle.get(key)
+      if idle:
+        worker = idle.pop()
+        self.__busy.add(worker)
+    finally:
+      self.__lock.release()
+
+    if worker is None:
+      worker = _Worker(tool, env, cwd)
+      self.__lock.acquire()
+      try:
+        self.__workers.add(worker)
+        self.__busy.add(worker)
+      finally:
+        self.__lock.release()
+
+    try:
+      try:
+        result = worker.request(arguments, inputs)
+      finally:
+        self.__lock.acquire()
+        try:
+          self.__busy.discard(worker)
+        finally:
+          self.__lock.release()
+    except WorkerError, e:
+      self.__discard(worker)
+      # If the worker died of a signal, report that, but not the SIGKILL that
+      # __discard() sends to a worker which is merely misbehaving.
+      returncode = worker.returncode()
+      if returncode in (None, 0, -signal.SIGKILL):
+        returncode = 1
+      return (returncode, "%s\n" % e)
+
+    self.__lock.acquire()
+    try:
+      self.__idle.setdefault(key, []).append(worker)
+    finally:
+      self.__lock.release()
+    return result
+
+  def signal_busy(self, signum):
+    """Sends the given signal to every worker which is handling a request.
+    The requests fail.  Returns the number of workers signalled.  (So with
+    signal 0, this just counts them.)"""
+
+    self.__lock.acquire()
+    try:
+      for worker in self.__busy:
+        worker.signal(signum)
+      return len(self.__busy)
+    finally:
+      self.__lock.release()
+
+  def close(self):
+    """Shuts down all workers, waiting for them to exit."""
+
+    self.__lock.acquire()
+    try:
+      workers = list(self.__workers)
+      self.__workers.clear()
+      self.__idle.clear()
+    finally:
+      self.__lock.release()
+
+    for worker in workers:
+      worker.close()
+
+  def __discard(self, worker):
+    self.__lock.acquire()
+    try:
+      self.__workers.discard(worker)
+    finally:
+      self.__lock.release()
+    worker.kill()
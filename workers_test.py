@@ -0,0 +1,170 @@
+# Scalable Extendable Build System
+# Copyright (c) 2009 Kenton Varda and contributors.  All rights reserved.
+# Portions copyright Google, Inc.
+# http://code.google.com/p/sebs
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#     * Neither the name of the SEBS project nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from sebs.workers import WorkerPool
+
+# A worker which reports its pid along with its arguments, and exits with the
+# code given as the first argument.  "die" makes it exit without responding.
+# "wait DIR" creates DIR/started and then waits for DIR/go to exist.
+_WORKER_SCRIPT = """
+import json, os, sys, time
+assert sys.argv[1:] == ["--persistent_worker"]
+while True:
+  line = sys.stdin.readline()
+  if line == "":
+    break
+  request = json.loads(line)
+  arguments = request["arguments"]
+  if arguments[0] == "die":
+    sys.exit(3)
+  if arguments[0] == "wait":
+    open(os.path.join(arguments[1], "started"), "w").close()
+    while not os.path.exists(os.path.join(arguments[1], "go")):
+      time.sleep(0.01)
+    arguments = ["0"]
+  output = "%d %s %s" % (os.getpid(), " ".join(arguments),
+                         " ".join(request["inputs"]))
+  sys.stdout.write(json.dumps({"exit_code": int(arguments[0]),
+                               "output": output}) + "\\n")
+  sys.stdout.flush()
+"""
+
+class WorkerPoolTest(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    script = os.path.join(self.tempdir, "worker.py")
+    file = open(script, "w")
+    file.write(_WORKER_SCRIPT)
+    file.close()
+    self.tool = [sys.executable, script]
+    self.pool = WorkerPool()
+
+  def tearDown(self):
+    self.pool.close()
+    shutil.rmtree(self.tempdir)
+
+  def request(self, arguments, inputs = [], env = None):
+    exit_code, output = self.pool.request(self.tool, arguments, inputs,
+                                          env = env)
+    pid, rest = output.split(" ", 1)
+    return exit_code, int(pid), rest
+
+  def testReuse(self):
+    exit_code, pid, rest = self.request(["0", "foo"], ["in1", "in2"])
+    self.assertEquals(0, exit_code)
+    self.assertEquals("0 foo in1 in2", rest)
+
+    exit_code, pid2, rest = self.request(["2", "bar"])
+    self.assertEquals(2, exit_code)
+    self.assertEquals("2 bar ", rest)
+    self.assertEquals(pid, pid2)
+
+    # A different environment needs a different worker.
+    env = os.environ.copy()
+    env["SEBS_WORKER_TEST"] = "1"
+    exit_code, pid3, rest = self.request(["0"], env = env)
+    self.assertNotEquals(pid, pid3)
+    exit_code, pid4, rest = self.request(["0"], env = env)
+    self.assertEquals(pid3, pid4)
+
+  def testConcurrentRequests(self):
+    # While one worker is busy, a second request must start another.
+    results = []
+    def run():
+      results.append(self.request(["wait", self.tempdir]))
+    thread = threading.Thread(target = run)
+    thread.start()
+    try:
+      started = os.path.join(self.tempdir, "started")
+      for i in range(1000):
+        if os.path.exists(started):
+          break
+        time.sleep(0.01)
+      self.assertTrue(os.path.exists(started))
+
+      pid = self.request(["0"])[1]
+    finally:
+      open(os.path.join(self.tempdir, "go"), "w").close()
+      thread.join()
+
+    self.assertEquals(1, len(results))
+    self.assertEquals(0, results[0][0])
+    self.assertNotEquals(pid, results[0][1])
+
+    # Both workers are now idle and get reused.
+    self.assertTrue(self.request(["0"])[1] in (pid, results[0][1]))
+
+  def testSignalBusy(self):
+    results = []
+    def run():
+      results.append(self.pool.request(self.tool, ["wait", self.tempdir], []))
+    thread = threading.Thread(target = run)
+    thread.start()
+    try:
+      started = os.path.join(self.tempdir, "started")
+      for i in range(1000):
+        if os.path.exists(started):
+          break
+        time.sleep(0.01)
+      self.assertEqual(1, self.pool.signal_busy(signal.SIGTERM))
+    finally:
+      thread.join()
+    self.assertEqual(-signal.SIGTERM, results[0][0])
+    self.assertEqual(0, self.pool.signal_busy(0))
+
+  def testWorkerDies(self):
+    pid = self.request(["0"])[1]
+    exit_code, output = self.pool.request(self.tool, ["die"], [])
+    self.assertEquals(3, exit_code)
+    self.assertTrue("exited unexpectedly" in output)
+
+    # The dead worker is replaced.
+    exit_code, pid2, rest = self.request(["0"])
+    self.assertEquals(0, exit_code)
+    self.assertNotEquals(pid, pid2)
+
+  def testStartFailure(self):
+    self.assertRaises(OSError, self.pool.request,
+                      ["/nonexistent/program"], [], [])
+
+if __name__ == "__main__":
+  unittest.main()